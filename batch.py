@@ -0,0 +1,258 @@
+"""Fact-check a backlog of claims from a JSON lines file.
+
+Each input line is a JSON object with the claim under "claim" (or "content",
+as in exported Nostr notes) and optionally an "id" and "image_urls"; image
+URLs in the text are picked up as well. Claims are checked with bounded
+concurrency under the Mistral quota, and each result is appended to the
+output file as soon as it is ready, tagged with its input line number.
+Lines that are not a JSON object get an error result instead of stopping
+the run. Running the same command again after an interruption skips the
+lines that already have a result and retries the ones that failed.
+
+Usage: python batch.py INPUT OUTPUT [options]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from typing import IO, Iterator, List, Optional, Set, Tuple, Union
+
+from cache import ToolCache
+from factchecker import AsyncFactChecker, FactChecker
+from images import ImagePrefetcher, extract_image_urls
+from ratelimit import ApiRateLimiter
+
+
+def read_claims(path: str) -> Iterator[Tuple[int, Union[dict, ValueError]]]:
+    """Yield (line number, record) for every non-empty line, streaming the file.
+
+    A line that is not a JSON object is yielded with a ValueError in place of
+    the record, so the run can report it and carry on.
+    """
+    with open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                yield number, ValueError(f"invalid JSON: {error}")
+                continue
+            if not isinstance(record, dict):
+                yield number, ValueError("invalid claim: not a JSON object")
+                continue
+            yield number, record
+
+
+def completed_lines(path: str) -> Set[int]:
+    """Line numbers that already have a successful result in the output file.
+
+    A line cut short by a crash is truncated away so new results start on a
+    line of their own.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as file:
+        data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            file.truncate(end)
+    done: Set[int] = set()
+    for line in data[:end].splitlines():
+        record = json.loads(line)
+        if record.get("error") is None:
+            done.add(record["line"])
+    return done
+
+
+def claim_fields(record: dict) -> Tuple[Optional[str], str, List[str]]:
+    """Return the id, claim text without image URLs, and image URLs of a record."""
+    text = str(record.get("claim") or record.get("content") or "")
+    image_urls = list(record.get("image_urls") or [])
+    for image_url in extract_image_urls(text):
+        text = text.replace(image_url, "")
+        image_urls.append(image_url)
+    return record.get("id"), text.strip(), image_urls
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class BatchRun:
+    """Checks claims from `read_claims` with `concurrency` checks in flight."""
+
+    def __init__(
+        self,
+        checker: FactChecker,
+        output: IO[str],
+        concurrency: int = 4,
+        prefetcher: Optional[ImagePrefetcher] = None,
+        input_price: float = 0.0,
+        output_price: float = 0.0,
+    ):
+        self.checker = checker
+        self.output = output
+        self.concurrency = concurrency
+        self.prefetcher = prefetcher
+        # USD per million prompt and completion tokens.
+        self.input_price = input_price
+        self.output_price = output_price
+        self.stats: Counter = Counter()
+        self.latencies: List[float] = []
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens * self.input_price + completion_tokens * self.output_price) / 1e6
+
+    async def _check(self, text: str, image_urls: List[str], budget) -> str:
+        if self.prefetcher is not None and image_urls:
+            image_urls = [image.agent_input for image in await self.prefetcher.prepare(image_urls)]
+        if isinstance(self.checker, AsyncFactChecker):
+            return await self.checker.check_fact(text, image_urls=image_urls, budget=budget)
+        return await asyncio.to_thread(self.checker.check_fact, text, image_urls=image_urls, budget=budget)
+
+    def _write(self, result: dict) -> None:
+        # One complete line per result, on disk before the next one starts.
+        self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+    async def process(self, number: int, record: Union[dict, ValueError]) -> dict:
+        if isinstance(record, ValueError):
+            result = {"line": number, "id": None, "error": str(record)}
+            self.stats["failed"] += 1
+            self.stats["invalid"] += 1
+            self._write(result)
+            return result
+        id, text, image_urls = claim_fields(record)
+        budget = self.checker.new_budget(text)
+        started = time.monotonic()
+        result: dict = {"line": number, "id": id}
+        try:
+            result["result"] = await self._check(text, image_urls, budget)
+            result["error"] = None
+            self.stats["checked"] += 1
+        except Exception as error:
+            result["error"] = str(error)
+            self.stats["failed"] += 1
+        elapsed = time.monotonic() - started
+        self.latencies.append(elapsed)
+        self.stats["api_calls"] += budget.api_calls
+        self.stats["prompt_tokens"] += budget.prompt_tokens
+        self.stats["completion_tokens"] += budget.completion_tokens
+        result.update(
+            seconds=round(elapsed, 3),
+            api_calls=budget.api_calls,
+            prompt_tokens=budget.prompt_tokens,
+            completion_tokens=budget.completion_tokens,
+            cost=round(self.cost(budget.prompt_tokens, budget.completion_tokens), 6),
+        )
+        self._write(result)
+        return result
+
+    async def _worker(self, claims: Iterator[Tuple[int, Union[dict, ValueError]]]) -> None:
+        # Workers share one iterator, so the input is read as it is consumed.
+        for number, record in claims:
+            await self.process(number, record)
+
+    async def run(self, claims: Iterator[Tuple[int, Union[dict, ValueError]]]) -> None:
+        await asyncio.gather(*(self._worker(claims) for _ in range(self.concurrency)))
+
+    def summary(self, elapsed: float) -> dict:
+        processed = self.stats["checked"] + self.stats["failed"]
+        latencies = sorted(self.latencies)
+        cost = self.cost(self.stats["prompt_tokens"], self.stats["completion_tokens"])
+        return {
+            "checked": self.stats["checked"],
+            "failed": self.stats["failed"],
+            "invalid": self.stats["invalid"],
+            "skipped": self.stats["skipped"],
+            "seconds": round(elapsed, 3),
+            "claims_per_second": round(processed / elapsed, 3) if elapsed else 0.0,
+            "latency_p50": round(percentile(latencies, 0.5), 3),
+            "latency_p95": round(percentile(latencies, 0.95), 3),
+            "api_calls": self.stats["api_calls"],
+            "prompt_tokens": self.stats["prompt_tokens"],
+            "completion_tokens": self.stats["completion_tokens"],
+            "tokens_per_claim": round(
+                (self.stats["prompt_tokens"] + self.stats["completion_tokens"]) / processed, 1
+            ) if processed else 0.0,
+            "cost": round(cost, 6),
+            "cost_per_claim": round(cost / processed, 6) if processed else 0.0,
+        }
+
+
+async def run_batch(
+    checker: FactChecker,
+    input_path: str,
+    output_path: str,
+    concurrency: int = 4,
+    prefetcher: Optional[ImagePrefetcher] = None,
+    input_price: float = 0.0,
+    output_price: float = 0.0,
+) -> dict:
+    """Check every claim of `input_path` without a result in `output_path` yet."""
+    done = completed_lines(output_path)
+    with open(output_path, "a") as output:
+        batch = BatchRun(checker, output, concurrency, prefetcher, input_price, output_price)
+
+        def pending() -> Iterator[Tuple[int, Union[dict, ValueError]]]:
+            for number, record in read_claims(input_path):
+                if number in done:
+                    batch.stats["skipped"] += 1
+                else:
+                    yield number, record
+
+        started = time.monotonic()
+        await batch.run(pending())
+        return batch.summary(time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="claims, one JSON object per line")
+    parser.add_argument("output", help="results, appended one JSON object per line")
+    parser.add_argument("--concurrency", type=int, default=4, help="fact-checks in flight")
+    parser.add_argument("--engine", choices=["thread", "async"], default="async")
+    parser.add_argument("--rpm", type=float, default=float(os.environ.get("MISTRAL_RPM", "60")))
+    parser.add_argument("--tpm", type=float, default=float(os.environ.get("MISTRAL_TPM", "500000")))
+    parser.add_argument(
+        "--agent-id", default=os.environ.get("FACTCHECKER_AGENT_ID", "ag_019b704bddcc72079c3a26f9cb4891fa")
+    )
+    parser.add_argument("--server-url", default=os.environ.get("MISTRAL_SERVER_URL"),
+                        help="Mistral-compatible endpoint, e.g. the load test's fake agent")
+    parser.add_argument("--tool-cache", default=os.environ.get("TOOL_CACHE_PATH", "tool_cache.sqlite3"))
+    parser.add_argument("--input-price", type=float, default=0.0, help="USD per million prompt tokens")
+    parser.add_argument("--output-price", type=float, default=0.0, help="USD per million completion tokens")
+    args = parser.parse_args()
+
+    api_key = os.environ.get("MISTRAL_API_KEY")
+    if api_key is None:
+        raise ValueError("MISTRAL_API_KEY environment variable not set")
+    checker_class = AsyncFactChecker if args.engine == "async" else FactChecker
+    checker = checker_class(
+        api_key=api_key,
+        agent_id=args.agent_id,
+        rate_limiter=ApiRateLimiter(requests_per_minute=args.rpm, tokens_per_minute=args.tpm),
+        tool_cache=ToolCache(args.tool_cache),
+        tool_workers=max(8, 2 * args.concurrency),
+        server_url=args.server_url,
+    )
+    summary = asyncio.run(run_batch(
+        checker,
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        prefetcher=ImagePrefetcher(),
+        input_price=args.input_price,
+        output_price=args.output_price,
+    ))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
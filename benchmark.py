@@ -0,0 +1,249 @@
+"""Offline micro-benchmarks for the bot's hot paths.
+
+Usage: python benchmark.py <name> [options]
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from cachetools import TTLCache
+from pynostr.base_relay import BaseRelay, RelayPolicy
+from pynostr.event import Event
+from pynostr.filters import Filters, FiltersList
+from pynostr.key import PrivateKey
+
+from factchecker import extract_paragraph_text, extract_paragraph_text_streaming
+from prefilter import FramePrefilter
+from similarity import ClaimIndex
+
+
+def random_claim(rng: random.Random, vocabulary: list, words: int = 40) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+def bench_similarity(args):
+    rng = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(20000)]
+    index = ClaimIndex()
+
+    claims = [random_claim(rng, vocabulary) for _ in range(args.claims)]
+    started = time.perf_counter()
+    for i, claim in enumerate(claims):
+        index.add(str(i), claim)
+    print(f"Indexed {len(index)} claims in {time.perf_counter() - started:.2f}s")
+
+    # Lightly edited copies of stored claims, and unrelated claims.
+    edited = []
+    for claim in rng.sample(claims, args.queries):
+        words = claim.split()
+        words[rng.randrange(len(words))] = "edited"
+        edited.append(" ".join(words))
+    unrelated = [random_claim(rng, vocabulary) for _ in range(args.queries)]
+
+    for name, queries in (("near-duplicate", edited), ("unrelated", unrelated)):
+        started = time.perf_counter()
+        hits = sum(1 for query in queries if index.query(query, threshold=0.6))
+        elapsed = time.perf_counter() - started
+        print(
+            f"{name}: {elapsed / len(queries) * 1e6:.1f} us/lookup, "
+            f"{hits}/{len(queries)} matched"
+        )
+
+
+def synthetic_page(rng: random.Random, paragraphs: int) -> bytes:
+    """A news-like page: heavy head, navigation, then article paragraphs."""
+    words = ["climate", "vaccine", "report", "study", "data", "officials", "said", "the", "of", "and"]
+    head = "<script>" + "var x = 1;" * 5000 + "</script><style>" + "p{}" * 5000 + "</style>"
+    nav = "<nav>" + "".join(f"<a href='/s{i}'>Section {i}</a>" for i in range(300)) + "</nav>"
+    body = "".join(
+        "<p>" + " ".join(rng.choice(words) for _ in range(60)) + " <a href='#'>link</a>.</p>"
+        for _ in range(paragraphs)
+    )
+    return f"<html><head>{head}</head><body>{nav}<article>{body}</article></body></html>".encode("utf-8")
+
+
+def load_pages(directory: str) -> list:
+    if directory:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.htm*"))):
+            with open(path, "rb") as page:
+                pages.append(page.read())
+        return pages
+    rng = random.Random(0)
+    return [synthetic_page(rng, paragraphs) for paragraphs in (20, 200, 2000, 8000) for _ in range(5)]
+
+
+def bench_html(args):
+    pages = load_pages(args.pages)
+    if not pages:
+        raise SystemExit(f"No .html pages found in {args.pages}")
+    total_mb = sum(len(page) for page in pages) / 1e6
+    print(f"{len(pages)} pages, {total_mb:.1f} MB, max_length={args.max_length}")
+
+    def full_parse(page: bytes) -> str:
+        return extract_paragraph_text(page.decode("utf-8", errors="replace"))[:args.max_length]
+
+    def streaming(page: bytes) -> str:
+        chunks = (page[i:i + 16384] for i in range(0, len(page), 16384))
+        return extract_paragraph_text_streaming(chunks, args.max_length, args.max_bytes)
+
+    for name, extract in (("html.parser (current)", full_parse), ("lxml streaming", streaming)):
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for page in pages:
+                extract(page)
+        elapsed = (time.perf_counter() - started) / (args.repeat * len(pages))
+
+        tracemalloc.start()
+        extract(max(pages, key=len))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name}: {elapsed * 1000:.2f} ms/page, peak {peak / 1e6:.1f} MB on the largest page")
+
+
+BOT_PUBKEY = "41351e3166e7b6ddddc4c0ad48e69351ec34502771a216dbe08ba9c683c4fe1c"
+
+
+def relay_frames(rng: random.Random, unique_events: int, mention_ratio: float, copies: int) -> list:
+    """Signed TEXT_NOTE frames as a set of relays would deliver them.
+
+    Every note arrives `copies` times (once per relay); `mention_ratio` of
+    them p-tag the bot.
+    """
+    keys = [PrivateKey() for _ in range(20)]
+    frames = []
+    for i in range(unique_events):
+        event = Event(content=f"note {i} " + "lorem ipsum " * rng.randrange(1, 40))
+        if rng.random() < mention_ratio:
+            event.tags.append(["p", BOT_PUBKEY])
+            event.content += " nostr:npub1gy63uvtxu7mdmhwyczk53e5n28krg5p8wx3pdklq3w5udq7ylcwqvrwygj"
+        event.sign(rng.choice(keys).hex())
+        frame = json.dumps(["EVENT", "firehose", event.to_dict()])
+        frames.extend([frame] * copies)
+    return frames
+
+
+def bench_prefilter(args):
+    rng = random.Random(0)
+    frames = relay_frames(rng, args.events, args.mention_ratio, args.copies)
+    print(f"{len(frames)} frames ({args.events} notes x {args.copies} relays, {args.mention_ratio:.0%} mentions)")
+
+    def make_relay(prefiltered: bool) -> BaseRelay:
+        dedup = TTLCache(maxsize=100000, ttl=600)
+
+        def on_message(message_json, url):
+            # What main.on_message does before the fact-check queue.
+            event = Event.from_dict(message_json[2])
+            if event.id in dedup:
+                return
+            dedup[event.id] = True
+
+        relay = BaseRelay("wss://bench", RelayPolicy(), message_callback=on_message, message_callback_url=True)
+        relay.add_subscription("firehose", FiltersList([Filters(kinds=[1])]))
+        if prefiltered:
+            FramePrefilter(
+                pubkey=BOT_PUBKEY,
+                mention_texts=["@factchecker"],
+                is_duplicate=lambda event_id: event_id in dedup,
+                is_wanted=lambda event_id: False,
+            ).install(relay)
+        return relay
+
+    for name, prefiltered in (("before (full parse)", False), ("after (prefilter)", True)):
+        relay = make_relay(prefiltered)
+        started = time.perf_counter()
+        for frame in frames:
+            relay._on_message(frame)
+        elapsed = time.perf_counter() - started
+        print(f"{name}: {len(frames) / elapsed:,.0f} frames/s on one core")
+
+
+def bench_streaming(args):
+    # The load test's fake services live in loadtest.py, which imports this module.
+    from loadtest import FakeServices, LoadTestAsyncFactChecker, LoadTestFactChecker, percentile
+    from ratelimit import ApiRateLimiter
+
+    services = FakeServices(
+        rounds=args.rounds,
+        api_latency=args.api_latency,
+        search_latency=args.tool_latency,
+        page_latency=args.tool_latency,
+    )
+    services.start()
+    checker_class = LoadTestAsyncFactChecker if args.engine == "async" else LoadTestFactChecker
+    try:
+        for name, stream in (("non-streaming", False), ("streaming", True)):
+            checker = checker_class(
+                search_url=f"{services.url}/search",
+                api_key="benchmark",
+                agent_id="benchmark",
+                server_url=services.url,
+                rate_limiter=ApiRateLimiter(requests_per_minute=1e9),
+                stream_responses=stream,
+            )
+            first_tool, end_to_end = [], []
+
+            async def run_checks():
+                for i in range(args.checks):
+                    budget = checker.new_budget(f"claim {i}")
+                    started = time.perf_counter()
+                    if args.engine == "async":
+                        await checker.check_fact(f"claim {i}", budget=budget)
+                    else:
+                        checker.check_fact(f"claim {i}", budget=budget)
+                    end_to_end.append(time.perf_counter() - started)
+                    first_tool.append(budget.first_tool_seconds or 0.0)
+
+            asyncio.run(run_checks())
+            first_tool.sort()
+            end_to_end.sort()
+            print(
+                f"{name}: time to first tool p50 {percentile(first_tool, 0.5) * 1000:.0f} ms, "
+                f"end to end p50 {percentile(end_to_end, 0.5) * 1000:.0f} ms, "
+                f"p95 {percentile(end_to_end, 0.95) * 1000:.0f} ms"
+            )
+    finally:
+        services.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    similarity = subparsers.add_parser("similarity", help="near-duplicate claim lookups")
+    similarity.add_argument("--claims", type=int, default=100000)
+    similarity.add_argument("--queries", type=int, default=1000)
+    similarity.set_defaults(func=bench_similarity)
+
+    html = subparsers.add_parser("html", help="webpage paragraph extraction")
+    html.add_argument("--pages", default="", help="directory of saved .html pages (default: synthetic corpus)")
+    html.add_argument("--max-length", type=int, default=10000)
+    html.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024)
+    html.add_argument("--repeat", type=int, default=3)
+    html.set_defaults(func=bench_html)
+
+    prefilter = subparsers.add_parser("prefilter", help="raw relay frame prefiltering")
+    prefilter.add_argument("--events", type=int, default=2000)
+    prefilter.add_argument("--copies", type=int, default=5)
+    prefilter.add_argument("--mention-ratio", type=float, default=0.01)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    streaming = subparsers.add_parser("streaming", help="streamed vs complete agent responses (fake agent)")
+    streaming.add_argument("--checks", type=int, default=20)
+    streaming.add_argument("--rounds", type=int, default=2)
+    streaming.add_argument("--api-latency", type=float, default=1.0, help="generation time of one agent response")
+    streaming.add_argument("--tool-latency", type=float, default=0.3)
+    streaming.add_argument("--engine", choices=["thread", "async"], default="thread")
+    streaming.set_defaults(func=bench_streaming)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
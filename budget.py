@@ -0,0 +1,144 @@
+import json
+import re
+import time
+from typing import Dict, List, Optional
+
+from ratelimit import estimate_tokens
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def claim_terms(claim_text: str) -> set:
+    """Lowercased words of a claim that are long enough to be informative."""
+    return {word for word in _WORD_RE.findall(claim_text.lower()) if len(word) > 2}
+
+
+def relevance(text: str, terms: set) -> int:
+    """Number of distinct claim terms found in `text`."""
+    return len(terms.intersection(_WORD_RE.findall(text.lower())))
+
+
+def split_passages(text: str, passage_chars: int) -> List[str]:
+    """Group the sentences of `text` into passages of about `passage_chars`."""
+    passages: List[str] = []
+    current = ""
+    for sentence in _SENTENCE_END_RE.split(text):
+        if current and len(current) + len(sentence) + 1 > passage_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence[:passage_chars]
+    if current:
+        passages.append(current)
+    return passages
+
+
+def relevant_passages(text: str, terms: set, keep: int, passage_chars: int) -> str:
+    """Keep the `keep` passages of `text` most relevant to the claim, in page order."""
+    passages = split_passages(text, passage_chars)
+    ranked = sorted(range(len(passages)), key=lambda index: (-relevance(passages[index], terms), index))
+    return " … ".join(passages[index] for index in sorted(ranked[:keep]))
+
+
+class ConversationBudget:
+    """Keeps one `check_fact` conversation within a token, round and time budget.
+
+    Before each agent call `fit` compacts tool results, those of earlier
+    turns first, until the conversation is estimated to fit in `max_tokens`:
+    page text is cut down to its `keep_passages` passages sharing the most
+    words with the claim, and search results to the `keep_results` most
+    relevant ones with shortened snippets. Once `max_rounds` tool turns have
+    run or `max_seconds` have passed, `exhausted` is true and the agent has to
+    answer without further tool calls.
+    """
+
+    def __init__(
+        self,
+        claim_text: str,
+        max_tokens: int = 8000,
+        max_rounds: int = 6,
+        max_seconds: float = 120.0,
+        keep_passages: int = 4,
+        passage_chars: int = 400,
+        keep_results: int = 4,
+        snippet_chars: int = 200,
+    ):
+        self.terms = claim_terms(claim_text)
+        self.max_tokens = max_tokens
+        self.max_rounds = max_rounds
+        self.max_seconds = max_seconds
+        self.keep_passages = keep_passages
+        self.passage_chars = passage_chars
+        self.keep_results = keep_results
+        self.snippet_chars = snippet_chars
+        self.started = time.monotonic()
+        self.rounds = 0
+        # Message index -> estimated tokens saved by compacting it; counted
+        # again for every later call that resends the message.
+        self.compacted: Dict[int, int] = {}
+        self.tokens_saved = 0
+        self.api_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Seconds from the start of the check until its first tool call ran.
+        self.first_tool_seconds: Optional[float] = None
+
+    def tool_started(self) -> None:
+        if self.first_tool_seconds is None:
+            self.first_tool_seconds = time.monotonic() - self.started
+
+    def record_usage(self, response) -> None:
+        """Add the token usage reported with an agent response."""
+        usage = getattr(response, "usage", None)
+        self.api_calls += 1
+        if usage is not None:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+
+    @property
+    def exhausted(self) -> bool:
+        return self.rounds >= self.max_rounds or time.monotonic() - self.started >= self.max_seconds
+
+    def compact_tool_result(self, content: str) -> Optional[str]:
+        """Return a shorter version of a tool result, or None to keep it as is."""
+        try:
+            result = json.loads(content)
+        except ValueError:
+            return None
+        if isinstance(result, dict) and isinstance(result.get("content"), str):
+            text = relevant_passages(result["content"], self.terms, self.keep_passages, self.passage_chars)
+            return json.dumps({"url": result.get("url"), "content": text, "compacted": True})
+        if isinstance(result, list):
+            results = [item for item in result if isinstance(item, dict)]
+            results.sort(key=lambda item: -relevance(f"{item.get('title', '')} {item.get('body', '')}", self.terms))
+            return json.dumps([
+                {**item, "body": str(item.get("body", ""))[:self.snippet_chars]}
+                for item in results[:self.keep_results]
+            ])
+        return None
+
+    def fit(self, messages: list) -> list:
+        """Compact `messages` in place until they fit the token budget."""
+        if estimate_tokens(messages) > self.max_tokens:
+            last_turn = max(
+                (index for index, message in enumerate(messages) if message.get("role") == "assistant"),
+                default=len(messages),
+            )
+            candidates = [
+                index
+                for index, message in enumerate(messages)
+                if message.get("role") == "tool" and index not in self.compacted
+            ]
+            # Results of earlier turns go first; the agent has already read them.
+            candidates.sort(key=lambda index: index > last_turn)
+            for index in candidates:
+                content = str(messages[index]["content"])
+                compacted = self.compact_tool_result(content)
+                if compacted is None or len(compacted) >= len(content):
+                    continue
+                messages[index] = {**messages[index], "content": compacted}
+                self.compacted[index] = (len(content) - len(compacted)) // 4
+                if estimate_tokens(messages) <= self.max_tokens:
+                    break
+        self.tokens_saved += sum(self.compacted.values())
+        return messages
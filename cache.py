@@ -0,0 +1,344 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+def normalize_claim(text: str) -> str:
+    """Lowercase a claim and collapse whitespace so trivial edits hash the same."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def claim_cache_key(claim_text: str, image_urls: Optional[List[str]] = None) -> str:
+    payload = normalize_claim(claim_text) + "\n" + "\n".join(sorted(image_urls or []))
+    return "claim:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Persistent SQLite cache of fact-check verdicts.
+
+    Each verdict is stored under the target event id and under a hash of the
+    normalized claim text plus image URLs, so the same note and copies of its
+    content both hit. Entries older than `ttl` seconds are ignored and pruned.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)"
+        )
+        # Claim text behind each claim key, used to rebuild the near-duplicate
+        # index (see similarity.ClaimIndex) after a restart.
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS claims ("
+            " key TEXT PRIMARY KEY,"
+            " claim_text TEXT NOT NULL,"
+            " image_urls TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS claims_created_at ON claims (created_at)"
+        )
+        self.db.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT result FROM results WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_by_key(self, key: str) -> Optional[str]:
+        with self.lock:
+            return self._get(key)
+
+    def get_by_event(self, target_event_id: str) -> Optional[str]:
+        """Verdict stored for a note, found without its claim text."""
+        with self.lock:
+            return self._get("event:" + target_event_id)
+
+    def get_claim_text(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT claim_text FROM claims WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def iter_claims(self) -> Iterator[Tuple[str, str, List[str]]]:
+        """Yield (claim key, claim text, image URLs) of every unexpired claim."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, claim_text, image_urls FROM claims WHERE created_at >= ?",
+                (time.time() - self.ttl,),
+            ).fetchall()
+        for key, claim_text, image_urls in rows:
+            yield key, claim_text, json.loads(image_urls)
+
+    def get(
+        self,
+        target_event_id: Optional[str],
+        claim_text: str,
+        image_urls: Optional[List[str]] = None,
+    ) -> Optional[str]:
+        with self.lock:
+            if target_event_id:
+                result = self._get("event:" + target_event_id)
+                if result is not None:
+                    return result
+            return self._get(claim_cache_key(claim_text, image_urls))
+
+    def put(
+        self,
+        target_event_id: Optional[str],
+        claim_text: str,
+        image_urls: Optional[List[str]],
+        result: str,
+    ) -> None:
+        now = time.time()
+        claim_key = claim_cache_key(claim_text, image_urls)
+        keys = [claim_key]
+        if target_event_id:
+            keys.append("event:" + target_event_id)
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO results (key, result, created_at) VALUES (?, ?, ?)",
+                [(key, result, now) for key in keys],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO claims (key, claim_text, image_urls, created_at) VALUES (?, ?, ?, ?)",
+                (claim_key, claim_text, json.dumps(image_urls or []), now),
+            )
+            self.db.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+            self.db.execute("DELETE FROM claims WHERE created_at < ?", (now - self.ttl,))
+            self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalize a URL so trivially different spellings share a cache entry."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith(_TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+def search_cache_key(query: str, num_results: int) -> str:
+    return f"search:{num_results}:{normalize_claim(query)}"
+
+
+def page_cache_key(url: str) -> str:
+    return "page:" + canonicalize_url(url)
+
+
+@dataclass
+class CacheEntry:
+    value: str
+    stored_at: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.value.encode("utf-8"))
+
+    def validators(self) -> Dict[str, str]:
+        """Headers for a conditional request revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ToolCache:
+    """Two-tier cache for web search results and webpage content.
+
+    The first tier is an in-memory LRU, the second a SQLite file. Each tier
+    has its own TTL and byte budget. Expired disk entries that carry an ETag
+    or Last-Modified header are kept so callers can revalidate them with a
+    conditional request instead of downloading them again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        memory_ttl: float = 600,
+        memory_max_bytes: int = 32 * 1024 * 1024,
+        disk_ttl: float = 24 * 3600,
+        disk_max_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.memory_ttl = memory_ttl
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_ttl = disk_ttl
+        self.disk_max_bytes = disk_max_bytes
+        self.lock = threading.Lock()
+        # key -> (entry, time it entered the memory tier)
+        self.memory: "OrderedDict[str, Tuple[CacheEntry, float]]" = OrderedDict()
+        self.memory_bytes = 0
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stale": 0,
+            "revalidated": 0,
+            "evictions": 0,
+        }
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " size INTEGER NOT NULL,"
+            " stored_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS tool_cache_accessed_at ON tool_cache (accessed_at)"
+        )
+        self.db.commit()
+        self.disk_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tool_cache"
+        ).fetchone()[0]
+
+    def _memory_put(self, key: str, entry: CacheEntry) -> None:
+        if entry.size > self.memory_max_bytes:
+            return
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= previous[0].size
+        self.memory[key] = (entry, time.time())
+        self.memory_bytes += entry.size
+        while self.memory_bytes > self.memory_max_bytes:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.size
+            self.stats["evictions"] += 1
+
+    def _disk_delete(self, key: str) -> None:
+        row = self.db.execute("SELECT size FROM tool_cache WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM tool_cache WHERE key = ?", (key,))
+            self.disk_bytes -= row[0]
+
+    def _disk_evict(self) -> None:
+        while self.disk_bytes > self.disk_max_bytes:
+            rows = self.db.execute(
+                "SELECT key, size FROM tool_cache ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self.disk_bytes = 0
+                break
+            for key, size in rows:
+                self.db.execute("DELETE FROM tool_cache WHERE key = ?", (key,))
+                self.disk_bytes -= size
+                self.stats["evictions"] += 1
+                if self.disk_bytes <= self.disk_max_bytes:
+                    break
+
+    def lookup(self, key: str) -> Tuple[Optional[CacheEntry], bool]:
+        """Return (entry, fresh).
+
+        A stale entry is only returned when it can be revalidated; the caller
+        should then send `entry.validators()` and call `revalidated` on a 304.
+        """
+        now = time.time()
+        with self.lock:
+            cached = self.memory.get(key)
+            if cached is not None:
+                entry, inserted_at = cached
+                if now - inserted_at < self.memory_ttl:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry, True
+                self.memory_bytes -= entry.size
+                del self.memory[key]
+
+            row = self.db.execute(
+                "SELECT value, stored_at, etag, last_modified FROM tool_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None, False
+
+            entry = CacheEntry(value=row[0], stored_at=row[1], etag=row[2], last_modified=row[3])
+            if now - entry.stored_at < self.disk_ttl:
+                self.db.execute("UPDATE tool_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self.db.commit()
+                self._memory_put(key, entry)
+                self.stats["disk_hits"] += 1
+                return entry, True
+
+            if entry.validators():
+                self.stats["stale"] += 1
+                return entry, False
+
+            self._disk_delete(key)
+            self.db.commit()
+            self.stats["misses"] += 1
+            return None, False
+
+    def put(
+        self,
+        key: str,
+        value: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        now = time.time()
+        entry = CacheEntry(value=value, stored_at=now, etag=etag, last_modified=last_modified)
+        with self.lock:
+            self._memory_put(key, entry)
+            if entry.size > self.disk_max_bytes:
+                return
+            self._disk_delete(key)
+            self.db.execute(
+                "INSERT INTO tool_cache (key, value, etag, last_modified, size, stored_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, value, etag, last_modified, entry.size, now, now),
+            )
+            self.disk_bytes += entry.size
+            self._disk_evict()
+            self.db.commit()
+
+    def revalidated(self, key: str, entry: CacheEntry) -> None:
+        """Mark a stale entry as fresh again after a 304 Not Modified."""
+        with self.lock:
+            self.stats["revalidated"] += 1
+        self.put(key, entry.value, entry.etag, entry.last_modified)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
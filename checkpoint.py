@@ -0,0 +1,163 @@
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Iterator, Optional
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    Uses `capacity` and `error_rate` to size the bit array; adding more keys
+    than `capacity` only raises the false positive rate.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class EventLog:
+    """Persistent log of fact-check requests plus the relay subscription cursor.
+
+    A request is logged with `add` when it is accepted and marked with `done`
+    once it has been answered (or given up on). Membership tests go through an
+    in-memory Bloom filter first, so the common "never seen" answer needs no
+    disk access and memory stays bounded whatever the traffic. Rows older than
+    `retention` seconds are pruned.
+
+    Requests a previous run accepted but never finished are forgotten on
+    startup, and `catch_up_since` reaches back far enough for the relays to
+    deliver them again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retention: float = 7 * 24 * 3600,
+        bloom_capacity: int = 100000,
+        bloom_error_rate: float = 0.001,
+    ):
+        self.retention = retention
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.stats: Counter = Counter()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS processed_events ("
+            " event_id TEXT PRIMARY KEY,"
+            " created_at INTEGER NOT NULL,"
+            " processed_at REAL NOT NULL,"
+            " done INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS processed_events_processed_at ON processed_events (processed_at)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " name TEXT PRIMARY KEY,"
+            " value INTEGER NOT NULL)"
+        )
+        row = self.db.execute(
+            "SELECT MIN(created_at) FROM processed_events WHERE done = 0"
+        ).fetchone()
+        self.oldest_unfinished: Optional[int] = row[0]
+        self.db.execute("DELETE FROM processed_events WHERE done = 0")
+        self.db.commit()
+        self.prune(force=True)
+
+    def _rebuild_bloom(self) -> None:
+        bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        for (event_id,) in self.db.execute("SELECT event_id FROM processed_events"):
+            bloom.add(event_id)
+        self.bloom = bloom
+
+    def prune(self, force: bool = False) -> int:
+        """Drop rows past the retention period, rebuilding the Bloom filter if needed."""
+        with self.lock:
+            deleted = self.db.execute(
+                "DELETE FROM processed_events WHERE processed_at < ?",
+                (time.time() - self.retention,),
+            ).rowcount
+            self.db.commit()
+            if deleted or force:
+                self._rebuild_bloom()
+        return deleted
+
+    def __contains__(self, event_id: str) -> bool:
+        if event_id not in self.bloom:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM processed_events WHERE event_id = ?", (event_id,)
+            ).fetchone()
+        if row is None:
+            self.stats["bloom_false_positives"] += 1
+        return row is not None
+
+    def add(self, event_id: str, created_at: int) -> bool:
+        """Log an accepted request; returns False if it was already logged."""
+        with self.lock:
+            added = self.db.execute(
+                "INSERT OR IGNORE INTO processed_events (event_id, created_at, processed_at) VALUES (?, ?, ?)",
+                (event_id, int(created_at), time.time()),
+            ).rowcount
+            self.db.commit()
+            self.bloom.add(event_id)
+        self.stats["added" if added else "duplicates"] += 1
+        return bool(added)
+
+    def done(self, event_id: str) -> None:
+        with self.lock:
+            self.db.execute("UPDATE processed_events SET done = 1 WHERE event_id = ?", (event_id,))
+            self.db.commit()
+
+    def checkpoint(self) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute("SELECT value FROM checkpoints WHERE name = 'cursor'").fetchone()
+        return row[0] if row else None
+
+    def save_checkpoint(self, timestamp: Optional[int] = None) -> None:
+        """Record that every event up to `timestamp` (default: now) was received."""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints (name, value) VALUES ('cursor', ?)",
+                (int(time.time() if timestamp is None else timestamp),),
+            )
+            self.db.commit()
+
+    def catch_up_since(self, margin: float, max_age: float, now: Optional[float] = None) -> int:
+        """`since` for the mention subscription after a restart.
+
+        Starts `margin` seconds before the last checkpoint, or before the
+        oldest request left unfinished, but never more than `max_age` ago.
+        """
+        now = time.time() if now is None else now
+        cursor = self.checkpoint()
+        if cursor is None:
+            return int(now)
+        if self.oldest_unfinished is not None:
+            cursor = min(cursor, self.oldest_unfinished)
+        return int(max(now - max_age, min(now, cursor - margin)))
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,147 @@
+import json
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+from cachetools import LRUCache
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from pynostr.event import Event
+from pynostr.filters import Filters, FiltersList
+
+
+class EventResolver:
+    """Resolve events by id with as few relay subscriptions as possible.
+
+    Lookups requested within `batch_window` seconds of each other share one
+    `Filters(ids=[...])` REQ. The subscription is CLOSEd as soon as every id
+    in it has been received, or after `timeout` seconds. Events already seen
+    on other subscriptions (parsed, or as raw frames the prefilter skipped)
+    are kept in a bounded LRU store and resolve without a network round-trip.
+    """
+
+    def __init__(
+        self,
+        relay_manager,
+        timeout: float = 10.0,
+        batch_window: float = 0.05,
+        max_batch_size: int = 100,
+        store_size: int = 5000,
+    ):
+        self.relay_manager = relay_manager
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.store: LRUCache = LRUCache(maxsize=store_size)
+        self.waiters: Dict[str, List[Future]] = {}
+        self.queued_ids: List[str] = []
+        self.flush_scheduled = False
+        # Open lookup subscription id -> ids still unanswered in it.
+        self.subscriptions: Dict[str, Set[str]] = {}
+        self.id_subscription: Dict[str, str] = {}
+        self.stats: Counter = Counter()
+
+    def remember(self, event: Event) -> None:
+        self.store[event.id] = event
+
+    def remember_raw(self, event_id: str, frame: str) -> None:
+        """Store an unparsed EVENT frame; it is only decoded if looked up."""
+        if event_id not in self.store:
+            self.store[event_id] = frame
+
+    def _from_store(self, event_id: str) -> Optional[Event]:
+        event = self.store.get(event_id)
+        if isinstance(event, str):
+            try:
+                event = Event.from_dict(json.loads(event)[2])
+            except (ValueError, IndexError, KeyError, TypeError):
+                event = None
+            if event is None or event.id != event_id or not event.verify():
+                self.store.pop(event_id, None)
+                return None
+            self.store[event_id] = event
+        return event
+
+    @gen.coroutine
+    def resolve(self, event_id: str):
+        """Return the event with `event_id`, or None if no relay had it in time."""
+        event = self._from_store(event_id)
+        if event is not None:
+            self.stats["store_hits"] += 1
+            return event
+
+        self.stats["lookups"] += 1
+        future: Future = Future()
+        if event_id not in self.waiters:
+            self.waiters[event_id] = []
+            if event_id not in self.id_subscription:
+                self.queued_ids.append(event_id)
+                self._schedule_flush()
+        self.waiters[event_id].append(future)
+        event = yield future
+        return event
+
+    def _schedule_flush(self) -> None:
+        if self.flush_scheduled:
+            return
+        self.flush_scheduled = True
+        IOLoop.current().call_later(self.batch_window, self._flush)
+
+    def _flush(self) -> None:
+        self.flush_scheduled = False
+        ids, self.queued_ids = self.queued_ids, []
+        for start in range(0, len(ids), self.max_batch_size):
+            batch = ids[start:start + self.max_batch_size]
+            subscription_id = uuid.uuid4().hex
+            self.subscriptions[subscription_id] = set(batch)
+            for event_id in batch:
+                self.id_subscription[event_id] = subscription_id
+            filters = FiltersList([Filters(ids=batch, limit=len(batch))])
+            self.relay_manager.add_subscription_on_all_relays(subscription_id, filters)
+            self.stats["batches"] += 1
+            IOLoop.current().call_later(self.timeout, self._expire, subscription_id)
+
+    def _resolve_waiters(self, event_id: str, event: Optional[Event]) -> bool:
+        futures = self.waiters.pop(event_id, None)
+        for future in futures or []:
+            if not future.done():
+                future.set_result(event)
+        return futures is not None
+
+    def _close(self, subscription_id: str) -> None:
+        self.subscriptions.pop(subscription_id, None)
+        self.relay_manager.close_subscription_on_all_relays(subscription_id)
+        self.stats["closed"] += 1
+
+    def _expire(self, subscription_id: str) -> None:
+        remaining = self.subscriptions.get(subscription_id)
+        if remaining is None:
+            return
+        for event_id in remaining:
+            self.id_subscription.pop(event_id, None)
+            self._resolve_waiters(event_id, None)
+            self.stats["timeouts"] += 1
+        self._close(subscription_id)
+
+    def on_event(self, subscription_id: str, event: Event) -> bool:
+        """Feed an event received from a relay.
+
+        Returns True when the event answered a lookup and should not be
+        processed any further.
+        """
+        self.remember(event)
+        is_lookup = subscription_id in self.subscriptions
+        if self._resolve_waiters(event.id, event):
+            self.stats["resolved"] += 1
+            is_lookup = True
+
+        lookup_subscription_id = self.id_subscription.pop(event.id, None)
+        if lookup_subscription_id is not None:
+            remaining = self.subscriptions.get(lookup_subscription_id)
+            if remaining is not None:
+                remaining.discard(event.id)
+                if not remaining:
+                    self._close(lookup_subscription_id)
+        return is_lookup
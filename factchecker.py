@@ -1,10 +1,14 @@
-from typing import Dict, List, Optional, cast
+from typing import Callable, Dict, Generator, Iterable, List, NamedTuple, Optional, Set, Tuple, Union, cast
 from mistralai import (
     AgentsCompletionRequestMessages,
     AgentsCompletionRequestMessagesTypedDict,
     AssistantMessage,
     AssistantMessageTypedDict,
+    ChatCompletionChoice,
+    ChatCompletionResponse,
+    CompletionChunk,
     ContentChunk,
+    FunctionCall,
     ImageURLChunk,
     ImageURLChunkTypedDict,
     Mistral,
@@ -14,91 +18,413 @@ from mistralai import (
     ToolMessageTypedDict,
     UserMessageTypedDict,
     ToolCall,
+    UsageInfo,
 )
 from ddgs import DDGS
+import asyncio
 import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
-import requests
+import httpx
 from bs4 import BeautifulSoup
+from lxml import etree
+from http_pool import AsyncPooledSession, PooledSession
+from budget import ConversationBudget
+from metrics import TOKEN_BUCKETS, metrics
+from cache import CacheEntry, ToolCache, page_cache_key, search_cache_key
+from ratelimit import ApiRateLimiter, estimate_tokens, is_rate_limit_error, retry_after_seconds
+
+log = logging.getLogger("NostrFactCheckerBot")
+
+
+def extract_paragraph_text(html: str) -> str:
+    """Return the joined text of all <p> elements of an HTML document."""
+    soup = BeautifulSoup(html, 'html.parser')
+    return ' '.join(p.get_text().replace('\n', ' ').strip() for p in soup.find_all("p"))
+
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+
+
+def is_html_content_type(content_type: str) -> bool:
+    # Servers that send no Content-Type at all are given the benefit of the doubt.
+    return not content_type or content_type.split(";")[0].strip().lower() in HTML_CONTENT_TYPES
+
+
+def content_type_charset(content_type: str) -> Optional[str]:
+    match = _CHARSET_RE.search(content_type or "")
+    return match.group(1) if match else None
+
+
+class ParagraphExtractor:
+    """Incrementally collect <p> text from an HTML byte stream with lxml.
+
+    Produces the same text as `extract_paragraph_text`, but parses chunks as
+    they arrive and reports `done` once `max_length` characters are collected,
+    so the rest of the download and parse can be skipped.
+    """
+
+    def __init__(self, max_length: int, encoding: Optional[str] = None):
+        self.max_length = max_length
+        try:
+            self.parser = etree.HTMLPullParser(events=("end",), tag="p", encoding=encoding)
+        except LookupError:
+            self.parser = etree.HTMLPullParser(events=("end",), tag="p")
+        self.paragraphs: List[str] = []
+        self.length = 0
+
+    @property
+    def done(self) -> bool:
+        return self.length >= self.max_length
+
+    def _collect(self) -> None:
+        for _, element in self.parser.read_events():
+            text = "".join(element.itertext()).replace("\n", " ").strip()
+            self.paragraphs.append(text)
+            self.length += len(text) + 1
+            # Drop the paragraph's subtree; its text has been copied out.
+            element.clear(keep_tail=True)
+            if self.done:
+                break
+
+    def feed(self, data: bytes) -> bool:
+        """Parse another chunk and return True once enough text was collected."""
+        if not self.done:
+            self.parser.feed(data)
+            self._collect()
+        return self.done
+
+    def close(self) -> str:
+        if not self.done:
+            try:
+                self.parser.close()
+            except etree.LxmlError:
+                pass
+            self._collect()
+        return " ".join(self.paragraphs)[:self.max_length]
+
+
+def extract_paragraph_text_streaming(
+    chunks: Iterable[bytes], max_length: int, max_bytes: int, encoding: Optional[str] = None
+) -> str:
+    """Feed byte chunks to a ParagraphExtractor, stopping early when possible."""
+    extractor = ParagraphExtractor(max_length, encoding)
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        if received > max_bytes:
+            chunk = chunk[:len(chunk) - (received - max_bytes)]
+        if extractor.feed(chunk) or received >= max_bytes:
+            break
+    return extractor.close()
+
+
+def _text(content) -> str:
+    """Text of a streamed content delta (a string or a list of chunks)."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(chunk.text for chunk in content if isinstance(chunk, TextChunk))
+    return ""
+
+
+class StreamedResponse:
+    """Rebuilds a chat completion from the chunks of a streamed agent response.
+
+    Tool calls arrive as deltas keyed by index whose arguments may be split
+    over several chunks. `add` returns each tool call as soon as its
+    arguments are complete JSON, so it can start while the agent is still
+    generating the next one.
+    """
+
+    def __init__(self):
+        self.calls: Dict[int, dict] = {}
+        self.dispatched: Set[int] = set()
+        self.content: List[str] = []
+        self.finish_reason: Optional[str] = None
+        self.last_chunk: Optional[CompletionChunk] = None
+        self.usage: Optional[UsageInfo] = None
+
+    def _tool_call(self, index: int) -> ToolCall:
+        call = self.calls[index]
+        return ToolCall(
+            id=call["id"] or f"call{index}",
+            index=index,
+            function=FunctionCall(name=call["name"], arguments=call["arguments"]),
+        )
+
+    def add(self, chunk: CompletionChunk) -> Tuple[str, List[ToolCall]]:
+        """Account one chunk; returns its content and the tool calls it completed."""
+        self.last_chunk = chunk
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        text = ""
+        completed: List[ToolCall] = []
+        for choice in chunk.choices:
+            self.finish_reason = choice.finish_reason or self.finish_reason
+            text += _text(choice.delta.content)
+            for delta in choice.delta.tool_calls or []:
+                index = delta.index or 0
+                call = self.calls.setdefault(index, {"id": None, "name": "", "arguments": ""})
+                if delta.id and delta.id != "null":
+                    call["id"] = delta.id
+                call["name"] += delta.function.name or ""
+                arguments = delta.function.arguments
+                call["arguments"] += arguments if isinstance(arguments, str) else json.dumps(arguments)
+                if index in self.dispatched or not call["name"]:
+                    continue
+                try:
+                    json.loads(call["arguments"])
+                except ValueError:
+                    continue
+                self.dispatched.add(index)
+                completed.append(self._tool_call(index))
+        self.content.append(text)
+        return text, completed
+
+    def response(self) -> ChatCompletionResponse:
+        chunk = self.last_chunk
+        tool_calls = [self._tool_call(index) for index in sorted(self.calls)]
+        return ChatCompletionResponse(
+            id=chunk.id if chunk else "",
+            object="chat.completion",
+            model=chunk.model if chunk else "",
+            created=(chunk.created if chunk else None) or int(time.time()),
+            usage=self.usage or UsageInfo(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+            choices=[
+                ChatCompletionChoice(
+                    index=0,
+                    message=AssistantMessage(content="".join(self.content), tool_calls=tool_calls or None),
+                    finish_reason=self.finish_reason or "stop",
+                )
+            ],
+        )
+
+
+class ApiTurn(NamedTuple):
+    """An agent API call requested by `FactChecker._agent_turns`."""
+
+    messages: list[AgentsCompletionRequestMessagesTypedDict]
+    tool_choice: Optional[str]
+
 
 class FactChecker:
-    def __init__(self, api_key: str, agent_id: str):
-        self.client = Mistral(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        agent_id: str,
+        tool_workers: int = 8,
+        tool_turn_timeout: float = 20.0,
+        rate_limiter: Optional[ApiRateLimiter] = None,
+        tool_cache: Optional[ToolCache] = None,
+        stream_pages: bool = True,
+        max_download_bytes: int = 2 * 1024 * 1024,
+        max_connections: int = 100,
+        max_connections_per_host: int = 6,
+        http_session=None,
+        server_url: Optional[str] = None,
+        context_max_tokens: int = 8000,
+        max_rounds: int = 6,
+        max_check_seconds: float = 120.0,
+        stream_responses: bool = False,
+    ):
+        self.client = Mistral(api_key=api_key, server_url=server_url)
         self.agent_id = agent_id
+        # Share one limiter between every FactChecker using the same API key.
+        self.rate_limiter = rate_limiter or ApiRateLimiter()
+        # Tool calls of a single agent turn run in parallel on this pool and
+        # must all finish within tool_turn_timeout seconds.
+        self.tool_executor = self._create_tool_executor(tool_workers)
+        self.tool_turn_timeout = tool_turn_timeout
+        # Optional cache of search results and page text shared across checks.
+        self.tool_cache = tool_cache
+        # Streamed pages are parsed incrementally with lxml and abandoned once
+        # enough paragraph text is collected or max_download_bytes is reached.
+        self.stream_pages = stream_pages
+        self.max_download_bytes = max_download_bytes
+        # Page fetches reuse keep-alive connections from one pooled session.
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.http_session = http_session or self._create_http_session()
+        # Each check's conversation is kept under context_max_tokens by
+        # compacting tool results; after max_rounds tool turns or
+        # max_check_seconds the agent must answer with what it has.
+        self.context_max_tokens = context_max_tokens
+        self.max_rounds = max_rounds
+        self.max_check_seconds = max_check_seconds
+        self.context_stats: Counter = Counter()
+        self.context_stats_lock = threading.Lock()
+        # Streamed agent responses start each tool call as soon as its
+        # arguments are complete instead of after the whole message.
+        self.stream_responses = stream_responses
         self.warning_message = (
             "Caution: I’m just a tool. I don’t hold absolute truth or authority. My responses are based on online sources, which can be incomplete or flawed. Always verify independently."
         )
 
+    def _create_tool_executor(self, tool_workers: int) -> Optional[ThreadPoolExecutor]:
+        return ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="factchecker-tool")
+
+    def _create_http_session(self) -> PooledSession:
+        return PooledSession(
+            max_connections=self.max_connections,
+            max_connections_per_host=self.max_connections_per_host,
+        )
+
+    def close(self) -> None:
+        self.http_session.close()
+
+    def _lookup_tool_cache(self, key: str) -> Tuple[Optional[CacheEntry], bool]:
+        if self.tool_cache is None:
+            return None, False
+        return self.tool_cache.lookup(key)
+
+    def _store_page(self, key: str, text: str, response: httpx.Response) -> None:
+        if self.tool_cache is not None:
+            self.tool_cache.put(
+                key,
+                text,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+
+    @staticmethod
+    def _page_result(url: str, text: str, max_length: int) -> str:
+        return json.dumps({"url": url, "content": text[:max_length]})
+
+    @staticmethod
+    def _unsupported_page(response: httpx.Response) -> Optional[str]:
+        """Error result for a streamed page that is not HTML, None otherwise."""
+        content_type = response.headers.get("Content-Type", "")
+        if is_html_content_type(content_type):
+            return None
+        return json.dumps({"error": f"Unsupported content type: {content_type}"})
+
     def get_webpage_content(self, url: str, max_length: int = 10000) -> str:
         """Fetch and return the text content of a webpage."""
+        key = page_cache_key(url)
+        cached, fresh = self._lookup_tool_cache(key)
+        if cached is not None and fresh:
+            return self._page_result(url, cached.value, max_length)
+
         try:
-            response = requests.get(url, timeout=5)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-            text = ' '.join(p.get_text().replace('\n', ' ').strip() for p in soup.find_all("p"))
-            return json.dumps({"url": url, "content": text[:max_length]})
-        except requests.RequestException as error:
+            headers = cached.validators() if cached is not None else {}
+            with self.http_session.stream("GET", url, headers=headers) as response:
+                if cached is not None and response.status_code == 304:
+                    self.tool_cache.revalidated(key, cached)
+                    return self._page_result(url, cached.value, max_length)
+                response.raise_for_status()
+                if self.stream_pages:
+                    unsupported = self._unsupported_page(response)
+                    if unsupported is not None:
+                        return unsupported
+                    text = extract_paragraph_text_streaming(
+                        response.iter_bytes(16384),
+                        max_length,
+                        self.max_download_bytes,
+                        content_type_charset(response.headers.get("Content-Type", "")),
+                    )
+                else:
+                    response.read()
+                    text = extract_paragraph_text(response.text)
+            self._store_page(key, text, response)
+            return self._page_result(url, text, max_length)
+        except httpx.HTTPError as error:
             return json.dumps({"error": f"Failed to fetch webpage content: {error}"})
 
 
+    def _search_results(self, query: str, num_results: int) -> List[dict]:
+        """Search DuckDuckGo and return url/title/body dicts."""
+        return [
+            {"url": result["href"], "title": result["title"], "body": result["body"]}
+            for result in DDGS().text(query, max_results=num_results)
+        ]
+
     def perform_web_search(self, query: str, num_results: int = 7) -> str:
         if num_results <= 0:
             return json.dumps({"error": "num_results must be a positive integer"})
 
+        key = search_cache_key(query, num_results)
+        cached, fresh = self._lookup_tool_cache(key)
+        if cached is not None and fresh:
+            return cached.value
+
         try:
-            results = []
-            search_results = DDGS().text(query, max_results=num_results)
-            for result in search_results:
-                results.append({"url": result["href"], "title": result["title"], "body": result["body"]})
-            return json.dumps(results)
+            results_json = json.dumps(self._search_results(query, num_results))
+            if self.tool_cache is not None:
+                self.tool_cache.put(key, results_json)
+            return results_json
         except Exception as error:
             return json.dumps({"error": f"Web search failed: {error}"})
 
-    def handle_tool_calls(
-        self, tool_calls: List[ToolCall], messages: list[AgentsCompletionRequestMessagesTypedDict]
-    ) -> list[AgentsCompletionRequestMessagesTypedDict]:
-        """Process tool calls and return formatted tool results."""
-        for tool_call in tool_calls:
-            if tool_call.function.name in ["web_search", "search_web"] :
+    def run_tool_call(self, tool_call: ToolCall) -> str:
+        """Execute a single tool call and return its result as a string."""
+        if tool_call.function.name in ["web_search", "search_web"] :
+            try:
                 query = json.loads(str(tool_call.function.arguments))["query"]
-                try:
-                    search_results = self.perform_web_search(query)
-                except Exception as e:
-                    search_results = json.dumps({"error": f"Web search failed: {e}"})
-             #   print("Search results:", search_results)
-                messages.append(
-                    ToolMessageTypedDict(
-                        role="tool",
-                        content=search_results,
-                        tool_call_id=tool_call.id,
-                        name=tool_call.function.name,
-                    )
-                )
-                
-            elif tool_call.function.name == "get_webpage_content":
+                search_results = self.perform_web_search(query)
+            except Exception as e:
+                search_results = json.dumps({"error": f"Web search failed: {e}"})
+         #   print("Search results:", search_results)
+            return search_results
+
+        elif tool_call.function.name == "get_webpage_content":
+            try:
                 url = json.loads(str(tool_call.function.arguments))["url"]
-                try:
-                    webpage_content = self.get_webpage_content(url)
-                except Exception as e:
-                    webpage_content = json.dumps({"error": f"Failed to get webpage content: {e}"})
-                messages.append(
-                    ToolMessageTypedDict(
-                        role="tool",
-                        content=webpage_content,
-                        tool_call_id=tool_call.id,
-                        name=tool_call.function.name,
-                    )
-                )
-                print("Webpage content:", webpage_content)
+                webpage_content = self.get_webpage_content(url)
+            except Exception as e:
+                webpage_content = json.dumps({"error": f"Failed to get webpage content: {e}"})
+            return webpage_content
+        else:
+            return f"Error: Unknown tool '{tool_call.function.name}'"
+
+    def _run_timed_tool_call(self, tool_call: ToolCall) -> str:
+        with metrics.stage("tool", tool=tool_call.function.name):
+            return self.run_tool_call(tool_call)
+
+    def _tool_timeout_result(self) -> str:
+        return json.dumps({"error": f"Tool call timed out after {self.tool_turn_timeout} seconds"})
+
+    @staticmethod
+    def _tool_message(tool_call: ToolCall, content: str) -> ToolMessageTypedDict:
+        return ToolMessageTypedDict(
+            role="tool",
+            content=content,
+            tool_call_id=tool_call.id,
+            name=tool_call.function.name,
+        )
+
+    def start_tool_call(self, tool_call: ToolCall) -> Future:
+        return self.tool_executor.submit(self._run_timed_tool_call, tool_call)
+
+    def handle_tool_calls(
+        self,
+        tool_calls: List[ToolCall],
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        started: Optional[Dict[str, Future]] = None,
+    ) -> list[AgentsCompletionRequestMessagesTypedDict]:
+        """Run the tool calls of one turn concurrently and append their results.
+
+        Results are appended in the order of `tool_calls`; a call still running
+        when the turn deadline expires is reported to the agent as timed out.
+        Calls already started while the response streamed are in `started`.
+        """
+        started = started or {}
+        futures = [started.get(tool_call.id) or self.start_tool_call(tool_call) for tool_call in tool_calls]
+        done, _ = wait(futures, timeout=self.tool_turn_timeout)
+
+        for tool_call, future in zip(tool_calls, futures):
+            if future in done:
+                content = future.result()
             else:
-                messages.append(
-                    ToolMessageTypedDict(
-                        role="tool",
-                        content=f"Error: Unknown tool '{tool_call.function.name}'",
-                        tool_call_id=tool_call.id,
-                        name=tool_call.function.name,
-                    )
-                )
+                future.cancel()
+                content = self._tool_timeout_result()
+            messages.append(self._tool_message(tool_call, content))
         return messages
 
 
@@ -108,43 +434,119 @@ class FactChecker:
         return f"Fact-Check Results:\n{result}\n\n{self.warning_message}"
 
 
+    def new_budget(self, statement: str) -> ConversationBudget:
+        return ConversationBudget(
+            statement,
+            max_tokens=self.context_max_tokens,
+            max_rounds=self.max_rounds,
+            max_seconds=self.max_check_seconds,
+        )
+
+    def _record_budget(self, budget: ConversationBudget, forced: bool) -> None:
+        with self.context_stats_lock:
+            self.context_stats["checks"] += 1
+            self.context_stats["tokens_saved"] += budget.tokens_saved
+            self.context_stats["compacted_results"] += len(budget.compacted)
+            self.context_stats["forced_answers"] += forced
+        metrics.observe("context_tokens_saved", budget.tokens_saved, buckets=TOKEN_BUCKETS)
+        if budget.first_tool_seconds is not None:
+            metrics.observe("time_to_first_tool_seconds", budget.first_tool_seconds)
+        if forced:
+            metrics.inc("forced_answers_total")
+
+    def _record_usage(self, estimated_tokens: int, response) -> None:
+        usage = getattr(response, "usage", None)
+        self.rate_limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+        if usage is not None:
+            metrics.inc("api_tokens_total", usage.prompt_tokens or 0, direction="prompt")
+            metrics.inc("api_tokens_total", usage.completion_tokens or 0, direction="completion")
+
+    def _retry_or_raise(self, error: Exception, attempt: int, max_retries: int) -> None:
+        """Re-raise a failed API call unless it was rate limited and may be retried.
+
+        A retry is paced by the shared rate limiter's backoff, which the next
+        `acquire` waits out.
+        """
+        if not is_rate_limit_error(error):
+            # Not a rate limit error, re-raise immediately
+            raise error
+        if attempt == max_retries - 1:
+            raise RuntimeError(f"Rate limit exceeded after {max_retries} attempts") from error
+        wait_time = self.rate_limiter.backoff(attempt, retry_after_seconds(error))
+        metrics.observe("api_retry_wait_seconds", wait_time)
+        log.warning(
+            "Rate limited. Retrying in %.1f seconds... (attempt %d/%d)", wait_time, attempt + 1, max_retries
+        )
+
+    def _stream_response(
+        self,
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        tool_choice: Optional[str],
+        on_tool_call: Optional[Callable[[ToolCall], None]],
+        on_content: Optional[Callable[[str], None]],
+    ) -> ChatCompletionResponse:
+        streamed = StreamedResponse()
+        with self.client.agents.stream(
+            messages=list(messages), agent_id=self.agent_id, tool_choice=tool_choice
+        ) as events:
+            for event in events:
+                text, tool_calls = streamed.add(event.data)
+                if text and on_content is not None:
+                    on_content(text)
+                for tool_call in tool_calls:
+                    if on_tool_call is not None:
+                        on_tool_call(tool_call)
+        return streamed.response()
+
     def _call_api_with_retry(
-        self, messages: list[AgentsCompletionRequestMessagesTypedDict], max_retries: int = 3
+        self,
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        max_retries: int = 3,
+        tool_choice: Optional[str] = None,
+        on_tool_call: Optional[Callable[[ToolCall], None]] = None,
+        on_content: Optional[Callable[[str], None]] = None,
     ):
-        """Call the API with exponential backoff retry logic."""
-        import time
-        
+        """Call the API under the shared rate limiter, retrying on rate limits.
+
+        `tool_choice="none"` makes the agent answer without calling tools.
+        When responses are streamed, `on_tool_call` receives each tool call as
+        soon as its arguments are complete and `on_content` each piece of text.
+        """
         for attempt in range(max_retries):
+            estimated_tokens = estimate_tokens(messages)
+            with metrics.stage("api_quota_wait"):
+                self.rate_limiter.acquire(estimated_tokens)
             try:
-                response = self.client.agents.complete(
-                    messages=list(messages),
-                    agent_id=self.agent_id,
-                    stream=False,
-                )
-                # Base delay to avoid rate limiting
-                time.sleep(2.0)
-                return response
-            except Exception as error:
-                error_str = str(error)
-                # Check if it's a rate limit error
-                if "429" in error_str or "rate limit" in error_str.lower() or "capacity exceeded" in error_str.lower():
-                    if attempt < max_retries - 1:
-                        # Exponential backoff: 5s, 15s, 45s
-                        wait_time = 5 * (3 ** attempt)
-                        print(f"Rate limited. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
-                        time.sleep(wait_time)
+                with metrics.stage("api_call"):
+                    if self.stream_responses:
+                        response = self._stream_response(messages, tool_choice, on_tool_call, on_content)
                     else:
-                        raise RuntimeError(f"Rate limit exceeded after {max_retries} attempts") from error
-                else:
-                    # Not a rate limit error, re-raise immediately
-                    raise
+                        response = self.client.agents.complete(
+                            messages=list(messages),
+                            agent_id=self.agent_id,
+                            stream=False,
+                            tool_choice=tool_choice,
+                        )
+            except Exception as error:
+                self._retry_or_raise(error, attempt, max_retries)
+                continue
+
+            self._record_usage(estimated_tokens, response)
+            return response
         
         raise RuntimeError("API call failed after all retry attempts")
 
-    def check_fact(
-        self, statement: str, image_urls: Optional[List[str]] = None
-    ) -> str:
-        """Main method to check a factual statement."""
+    def build_messages(
+        self,
+        statement: str,
+        image_urls: Optional[List[str]] = None,
+        context: Optional[str] = None,
+    ) -> list[AgentsCompletionRequestMessagesTypedDict]:
+        """Build the initial conversation for a statement and optional images.
+
+        `context` is an earlier verdict on a similar claim, given to the agent
+        as a hint it still has to verify.
+        """
         sanitized_statement = statement.strip().replace('"', "'").replace("\n", " ")
 
         # Initialize messages with system prompt and user query
@@ -164,6 +566,22 @@ class FactChecker:
                 ],
             )
         )
+        if context:
+            messages.append(
+                SystemMessageTypedDict(
+                    role="system",
+                    content=[
+                        TextChunkTypedDict(
+                            type="text",
+                            text=(
+                                "A very similar claim was fact-checked earlier. "
+                                "Its result may not apply exactly, verify before reusing it:\n"
+                                f"{context}"
+                            ),
+                        )
+                    ],
+                )
+            )
         messages.append(
               UserMessageTypedDict(
                 role="user",
@@ -182,30 +600,275 @@ class FactChecker:
                         ]
                     )
             )
+        return messages
+
+    def _agent_turns(
+        self,
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        budget: ConversationBudget,
+    ) -> Generator[Union[ApiTurn, List[ToolCall]], Optional[ChatCompletionResponse], str]:
+        """The agent loop of a check, without doing any I/O itself.
+
+        Yields an `ApiTurn` for each API call, expecting its response back,
+        and the tool calls of each turn, expecting their results appended to
+        `messages`. Returns the formatted answer. `check_fact` drives it, so
+        the blocking and the asyncio checker share one loop.
+        """
+        tool_choice = None
+        response = yield ApiTurn(messages, tool_choice)
+        while True:
+            budget.record_usage(response)
+            message = response.choices[0].message
+            messages.append(cast(AssistantMessageTypedDict, message.model_dump()))
+            # Handle tool calls if present, until the budget forces an answer
+            if not message.tool_calls or tool_choice is not None:
+                break
+            budget.tool_started()
+            yield message.tool_calls
+            budget.rounds += 1
+            if budget.exhausted:
+                tool_choice = "none"
+            response = yield ApiTurn(budget.fit(messages), tool_choice)
+        self._record_budget(budget, forced=tool_choice is not None)
+
+        if not message.content:
+            raise RuntimeError("No content returned after tool calls.")
+        return self.formate_result(str(message.content))
+
+    def check_fact(
+        self,
+        statement: str,
+        image_urls: Optional[List[str]] = None,
+        context: Optional[str] = None,
+        budget: Optional[ConversationBudget] = None,
+        on_content: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Main method to check a factual statement.
+
+        Pass a `budget` from `new_budget` to read the check's token usage.
+        With streamed responses, `on_content` receives the agent's text as it
+        is generated.
+        """
+        messages = self.build_messages(statement, image_urls, context)
+        budget = budget or self.new_budget(statement)
+        # Tool calls started while the agent's response was streaming.
+        started: Dict[str, Future] = {}
+
+        def start(tool_call: ToolCall) -> None:
+            budget.tool_started()
+            started[tool_call.id] = self.start_tool_call(tool_call)
 
         try:
-            # Initial API call with retry logic
-            response = self._call_api_with_retry(messages)
+            turns = self._agent_turns(messages, budget)
+            turn = next(turns)
+            while True:
+                if isinstance(turn, ApiTurn):
+                    response = self._call_api_with_retry(
+                        turn.messages, tool_choice=turn.tool_choice, on_tool_call=start, on_content=on_content
+                    )
+                else:
+                    self.handle_tool_calls(turn, messages, started)
+                    started.clear()
+                    response = None
+                turn = turns.send(response)
+        except StopIteration as finished:
+            return finished.value
+        except Exception as error:
+            raise RuntimeError(f"Fact-checking failed: {error}") from error
 
-            # Add the assistant's response to messages
-            messages.append(cast(AssistantMessageTypedDict, response.choices[0].message.model_dump()))
 
-            # Handle tool calls if present
-            while response.choices[0].message.tool_calls:
-                messages = self.handle_tool_calls(
-                    response.choices[0].message.tool_calls, messages
-                )
-                # Call the API again with tool results and retry logic
-                response = self._call_api_with_retry(messages)
+class AsyncFactChecker(FactChecker):
+    """FactChecker whose agent loop runs on asyncio instead of blocking a thread.
+
+    Mistral calls use `agents.complete_async`, page fetches share an
+    AsyncPooledSession, and DDGS searches and tool cache reads and writes run
+    in the default executor, so one event loop can keep many fact-checks in
+    flight. The agent loop itself is `FactChecker._agent_turns`.
+    """
+
+    def _create_http_session(self) -> AsyncPooledSession:
+        return AsyncPooledSession(
+            max_connections=self.max_connections,
+            max_connections_per_host=self.max_connections_per_host,
+        )
+
+    def _create_tool_executor(self, tool_workers: int) -> None:
+        # Tool calls run as asyncio tasks; blocking work uses the default executor.
+        return None
+
+    async def aclose(self) -> None:
+        await self.http_session.aclose()
+
+    async def get_webpage_content(self, url: str, max_length: int = 10000) -> str:
+        """Fetch and return the text content of a webpage."""
+        key = page_cache_key(url)
+        # The tool cache is SQLite; keep its reads and writes off the event loop.
+        cached, fresh = await asyncio.to_thread(self._lookup_tool_cache, key)
+        if cached is not None and fresh:
+            return self._page_result(url, cached.value, max_length)
+
+        try:
+            headers = cached.validators() if cached is not None else {}
+            async with self.http_session.stream("GET", url, headers=headers) as response:
+                if cached is not None and response.status_code == 304:
+                    await asyncio.to_thread(self.tool_cache.revalidated, key, cached)
+                    return self._page_result(url, cached.value, max_length)
+                response.raise_for_status()
+                if self.stream_pages:
+                    unsupported = self._unsupported_page(response)
+                    if unsupported is not None:
+                        return unsupported
+                    extractor = ParagraphExtractor(
+                        max_length, content_type_charset(response.headers.get("Content-Type", ""))
+                    )
+                    received = 0
+                    async for chunk in response.aiter_bytes(16384):
+                        received += len(chunk)
+                        if extractor.feed(chunk) or received >= self.max_download_bytes:
+                            break
+                    text = extractor.close()
+                else:
+                    await response.aread()
+                    text = extract_paragraph_text(response.text)
+            await asyncio.to_thread(self._store_page, key, text, response)
+            return self._page_result(url, text, max_length)
+        except httpx.HTTPError as error:
+            return json.dumps({"error": f"Failed to fetch webpage content: {error}"})
+
+    async def perform_web_search(self, query: str, num_results: int = 7) -> str:
+        # DDGS has no async API; keep it off the event loop.
+        return await asyncio.to_thread(super().perform_web_search, query, num_results)
+
+    async def run_tool_call(self, tool_call: ToolCall) -> str:
+        """Execute a single tool call and return its result as a string."""
+        if tool_call.function.name in ["web_search", "search_web"]:
+            try:
+                query = json.loads(str(tool_call.function.arguments))["query"]
+                return await self.perform_web_search(query)
+            except Exception as e:
+                return json.dumps({"error": f"Web search failed: {e}"})
+        elif tool_call.function.name == "get_webpage_content":
+            try:
+                url = json.loads(str(tool_call.function.arguments))["url"]
+                return await self.get_webpage_content(url)
+            except Exception as e:
+                return json.dumps({"error": f"Failed to get webpage content: {e}"})
+        else:
+            return f"Error: Unknown tool '{tool_call.function.name}'"
+
+    async def _run_timed_tool_call(self, tool_call: ToolCall) -> str:
+        with metrics.stage("tool", tool=tool_call.function.name):
+            return await self.run_tool_call(tool_call)
+
+    def start_tool_call(self, tool_call: ToolCall) -> asyncio.Future:
+        return asyncio.ensure_future(self._run_timed_tool_call(tool_call))
+
+    async def handle_tool_calls(
+        self,
+        tool_calls: List[ToolCall],
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        started: Optional[Dict[str, asyncio.Future]] = None,
+    ) -> list[AgentsCompletionRequestMessagesTypedDict]:
+        """Run the tool calls of one turn concurrently and append their results."""
+        started = started or {}
+        tasks = [started.get(tool_call.id) or self.start_tool_call(tool_call) for tool_call in tool_calls]
+        if tasks:
+            await asyncio.wait(tasks, timeout=self.tool_turn_timeout)
 
-                # Add the new response to messages
-                messages.append(cast(AssistantMessageTypedDict, response.choices[0].message.model_dump()))
+        for tool_call, task in zip(tool_calls, tasks):
+            if task.done():
+                content = task.result()
+            else:
+                task.cancel()
+                content = self._tool_timeout_result()
+            messages.append(self._tool_message(tool_call, content))
+        return messages
+
+    async def _stream_response(
+        self,
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        tool_choice: Optional[str],
+        on_tool_call: Optional[Callable[[ToolCall], None]],
+        on_content: Optional[Callable[[str], None]],
+    ) -> ChatCompletionResponse:
+        streamed = StreamedResponse()
+        events = await self.client.agents.stream_async(
+            messages=list(messages), agent_id=self.agent_id, tool_choice=tool_choice
+        )
+        async with events:
+            async for event in events:
+                text, tool_calls = streamed.add(event.data)
+                if text and on_content is not None:
+                    on_content(text)
+                for tool_call in tool_calls:
+                    if on_tool_call is not None:
+                        on_tool_call(tool_call)
+        return streamed.response()
 
-            # Return the final answer
-            if not response.choices[0].message.content:
-                raise RuntimeError("No content returned after tool calls.")
+    async def _call_api_with_retry(
+        self,
+        messages: list[AgentsCompletionRequestMessagesTypedDict],
+        max_retries: int = 3,
+        tool_choice: Optional[str] = None,
+        on_tool_call: Optional[Callable[[ToolCall], None]] = None,
+        on_content: Optional[Callable[[str], None]] = None,
+    ):
+        """Call the API under the shared rate limiter, retrying on rate limits."""
+        for attempt in range(max_retries):
+            estimated_tokens = estimate_tokens(messages)
+            with metrics.stage("api_quota_wait"):
+                await self.rate_limiter.acquire_async(estimated_tokens)
+            try:
+                with metrics.stage("api_call"):
+                    if self.stream_responses:
+                        response = await self._stream_response(messages, tool_choice, on_tool_call, on_content)
+                    else:
+                        response = await self.client.agents.complete_async(
+                            messages=list(messages),
+                            agent_id=self.agent_id,
+                            stream=False,
+                            tool_choice=tool_choice,
+                        )
+            except Exception as error:
+                self._retry_or_raise(error, attempt, max_retries)
+                continue
 
-            return self.formate_result(str(response.choices[0].message.content))
+            self._record_usage(estimated_tokens, response)
+            return response
 
+        raise RuntimeError("API call failed after all retry attempts")
+
+    async def check_fact(
+        self,
+        statement: str,
+        image_urls: Optional[List[str]] = None,
+        context: Optional[str] = None,
+        budget: Optional[ConversationBudget] = None,
+        on_content: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Main method to check a factual statement."""
+        messages = self.build_messages(statement, image_urls, context)
+        budget = budget or self.new_budget(statement)
+        started: Dict[str, asyncio.Future] = {}
+
+        def start(tool_call: ToolCall) -> None:
+            budget.tool_started()
+            started[tool_call.id] = self.start_tool_call(tool_call)
+
+        try:
+            turns = self._agent_turns(messages, budget)
+            turn = next(turns)
+            while True:
+                if isinstance(turn, ApiTurn):
+                    response = await self._call_api_with_retry(
+                        turn.messages, tool_choice=turn.tool_choice, on_tool_call=start, on_content=on_content
+                    )
+                else:
+                    await self.handle_tool_calls(turn, messages, started)
+                    started.clear()
+                    response = None
+                turn = turns.send(response)
+        except StopIteration as finished:
+            return finished.value
         except Exception as error:
-            raise RuntimeError(f"Fact-checking failed: {error}") from error
\ No newline at end of file
+            raise RuntimeError(f"Fact-checking failed: {error}") from error
@@ -0,0 +1,242 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, AsyncIterator, List, Optional, Tuple
+
+import httpcore
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class ConnectionStats:
+    """Counters showing how well pooled connections and DNS answers are reused."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self.http_versions: Counter = Counter()
+        self.connections_per_host: Counter = Counter()
+
+    def add(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": max(0, self.requests - self.connections_opened),
+                "dns_hits": self.dns_hits,
+                "dns_misses": self.dns_misses,
+                "http_versions": dict(self.http_versions),
+                "connections_per_host": dict(self.connections_per_host),
+            }
+
+
+class DnsCache:
+    """Process-local cache of resolved TCP addresses with a fixed TTL."""
+
+    def __init__(self, stats: ConnectionStats, ttl: float = 300):
+        self.ttl = ttl
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple[str, int], Tuple[float, List[str]]] = {}
+
+    def get(self, host: str, port: int) -> Optional[List[str]]:
+        with self.lock:
+            entry = self.entries.get((host, port))
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.stats.add("dns_misses")
+            return None
+        self.stats.add("dns_hits")
+        return entry[1]
+
+    def put(self, host: str, port: int, infos: list) -> List[str]:
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self.lock:
+            self.entries[(host, port)] = (time.monotonic(), addresses)
+        return addresses
+
+    def resolve(self, host: str, port: int) -> List[str]:
+        addresses = self.get(host, port)
+        if addresses is None:
+            addresses = self.put(host, port, socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        return addresses
+
+    async def resolve_async(self, host: str, port: int) -> List[str]:
+        addresses = self.get(host, port)
+        if addresses is None:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            addresses = self.put(host, port, infos)
+        return addresses
+
+
+class CachingSyncBackend(httpcore.SyncBackend):
+    """httpcore backend that resolves through a DnsCache and counts new connections.
+
+    TLS still verifies and sends SNI for the original host name, because
+    httpcore passes it to `start_tls` independently of the connected address.
+    """
+
+    def __init__(self, dns_cache: DnsCache, stats: ConnectionStats):
+        self.dns_cache = dns_cache
+        self.stats = stats
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = self.dns_cache.resolve(host, port)
+        except (OSError, UnicodeError) as exc:
+            # Surface like any other connection failure (httpx.ConnectError).
+            raise httpcore.ConnectError(f"Could not resolve {host}: {exc}") from exc
+        error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                stream = super().connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as exc:
+                error = exc
+                continue
+            self.stats.add("connections_opened")
+            with self.stats.lock:
+                self.stats.connections_per_host[host] += 1
+            return stream
+        raise error or httpcore.ConnectError(f"Could not resolve {host}")
+
+
+class CachingAsyncBackend(httpcore.AnyIOBackend):
+    """Async counterpart of CachingSyncBackend."""
+
+    def __init__(self, dns_cache: DnsCache, stats: ConnectionStats):
+        self.dns_cache = dns_cache
+        self.stats = stats
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await self.dns_cache.resolve_async(host, port)
+        except (OSError, UnicodeError) as exc:
+            # Surface like any other connection failure (httpx.ConnectError).
+            raise httpcore.ConnectError(f"Could not resolve {host}: {exc}") from exc
+        error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                stream = await super().connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as exc:
+                error = exc
+                continue
+            self.stats.add("connections_opened")
+            with self.stats.lock:
+                self.stats.connections_per_host[host] += 1
+            return stream
+        raise error or httpcore.ConnectError(f"Could not resolve {host}")
+
+
+def _limits(max_connections: int, keepalive_expiry: float) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+class PooledSession:
+    """Shared httpx client for page fetches.
+
+    Connections are kept alive and reused (over HTTP/2 when the server and the
+    `h2` package allow it). `max_connections` caps open connections across all
+    hosts and `max_connections_per_host` caps concurrent requests to one host.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 6,
+        keepalive_expiry: float = 30.0,
+        http2: bool = True,
+        dns_ttl: float = 300,
+        timeout: float = 5,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.stats = ConnectionStats()
+        self.dns_cache = DnsCache(self.stats, ttl=dns_ttl)
+        if transport is None:
+            transport = httpx.HTTPTransport(
+                http2=http2 and HTTP2_AVAILABLE,
+                limits=_limits(max_connections, keepalive_expiry),
+            )
+            # httpx has no public hook for the network backend of its pool.
+            transport._pool._network_backend = CachingSyncBackend(self.dns_cache, self.stats)
+        self.client = httpx.Client(transport=transport, timeout=timeout, follow_redirects=True)
+        self.max_connections_per_host = max_connections_per_host
+        self.host_slots: Dict[str, threading.BoundedSemaphore] = defaultdict(
+            lambda: threading.BoundedSemaphore(max_connections_per_host)
+        )
+        self.host_slots_lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        with self.host_slots_lock:
+            return self.host_slots[httpx.URL(url).host]
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs) -> Iterator[httpx.Response]:
+        with self._host_slot(url):
+            self.stats.add("requests")
+            with self.client.stream(method, url, **kwargs) as response:
+                with self.stats.lock:
+                    self.stats.http_versions[response.http_version] += 1
+                yield response
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class AsyncPooledSession:
+    """asyncio counterpart of PooledSession, shared by AsyncFactChecker."""
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 6,
+        keepalive_expiry: float = 30.0,
+        http2: bool = True,
+        dns_ttl: float = 300,
+        timeout: float = 5,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.stats = ConnectionStats()
+        self.dns_cache = DnsCache(self.stats, ttl=dns_ttl)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(
+                http2=http2 and HTTP2_AVAILABLE,
+                limits=_limits(max_connections, keepalive_expiry),
+            )
+            # httpx has no public hook for the network backend of its pool.
+            transport._pool._network_backend = CachingAsyncBackend(self.dns_cache, self.stats)
+        self.client = httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+        self.max_connections_per_host = max_connections_per_host
+        self.host_slots: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(max_connections_per_host)
+        )
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        async with self.host_slots[httpx.URL(url).host]:
+            self.stats.add("requests")
+            async with self.client.stream(method, url, **kwargs) as response:
+                with self.stats.lock:
+                    self.stats.http_versions[response.http_version] += 1
+                yield response
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,218 @@
+import asyncio
+import base64
+import hashlib
+import io
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import httpx
+from cachetools import TTLCache
+
+from http_pool import AsyncPooledSession
+
+try:
+    from PIL import Image
+
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Leading bytes of the formats the Mistral vision models accept.
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def extract_image_urls(content: str) -> List[str]:
+    if not content:
+        return []
+
+    return [
+        word for word in content.split()
+        if word.startswith(("http://", "https://"))
+        and word.lower().endswith((
+            ".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"
+        ))
+    ]
+
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Return the MIME type of an image from its first bytes, or None."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+
+def data_uri(content_type: str, data: bytes) -> str:
+    return f"data:{content_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def difference_hash(image, size: int = 8) -> str:
+    """64-bit dHash: survives re-encoding and resizing of the same picture."""
+    pixels = image.convert("L").resize((size + 1, size)).tobytes()
+    bits = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+def downscale(data: bytes, max_dimension: int, quality: int) -> Tuple[bytes, str]:
+    """Return the image as a JPEG no larger than `max_dimension`, and its dHash."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((max_dimension, max_dimension))
+        perceptual_hash = difference_hash(image)
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue(), perceptual_hash
+
+
+@dataclass
+class PreparedImage:
+    url: str
+    # "sha256:..." of the downloaded bytes; what results are cached under.
+    key: str
+    content_type: str
+    size: int
+    data_uri: Optional[str] = None
+    # dHash of the picture when Pillow is available. Unrelated images can
+    # share one (text screenshots often do), so it only dedupes within a note.
+    perceptual_hash: Optional[str] = None
+
+    @property
+    def agent_input(self) -> str:
+        """What to send to the agent: the inlined image, or its URL."""
+        return self.data_uri or self.url
+
+
+class ImagePrefetcher:
+    """Fetch, validate, shrink and dedupe the images of a note before a check.
+
+    All images of a note are fetched concurrently. Images that fail to load,
+    exceed `max_bytes` or are not a supported image format are dropped
+    instead of costing the agent a failed round. With Pillow installed, images
+    are downscaled to `max_dimension` and sent as JPEG data URIs; without it,
+    images up to `inline_max_bytes` are inlined as they are and larger ones
+    are passed by URL. Images are keyed by the SHA-256 of their bytes, so
+    copies of a file under different URLs share one key and one fact-check.
+    Within a note, re-encoded or resized copies of a picture are also dropped
+    by perceptual hash. Recently prepared images are kept, up to
+    `remembered_bytes` of inlined data, so their URLs are not fetched again.
+    """
+
+    def __init__(
+        self,
+        http_session: Optional[AsyncPooledSession] = None,
+        max_bytes: int = 10 * 1024 * 1024,
+        max_dimension: int = 1024,
+        jpeg_quality: int = 85,
+        inline_max_bytes: int = 1024 * 1024,
+        timeout: float = 10.0,
+        remembered_bytes: int = 64 * 1024 * 1024,
+        remember_for: float = 3600,
+    ):
+        self.http_session = http_session or AsyncPooledSession(timeout=timeout)
+        self.max_bytes = max_bytes
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.inline_max_bytes = inline_max_bytes
+        self.timeout = timeout
+        # Sized by the data URIs it holds, which dwarf everything else.
+        self.known: TTLCache = TTLCache(
+            maxsize=remembered_bytes, ttl=remember_for, getsizeof=lambda image: len(image.data_uri or "") + 1
+        )
+        self.stats = {"fetched": 0, "known": 0, "failed": 0, "too_large": 0, "not_image": 0, "duplicates": 0}
+
+    async def _download(self, url: str) -> Optional[bytes]:
+        async with self.http_session.stream("GET", url) as response:
+            if response.status_code != 200:
+                self.stats["failed"] += 1
+                return None
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if content_type and not content_type.startswith(("image/", "application/octet-stream")):
+                self.stats["not_image"] += 1
+                return None
+            try:
+                declared = int(response.headers.get("Content-Length") or 0)
+            except ValueError:
+                declared = 0
+            if declared > self.max_bytes:
+                self.stats["too_large"] += 1
+                return None
+            chunks = []
+            received = 0
+            async for chunk in response.aiter_bytes(65536):
+                received += len(chunk)
+                if received > self.max_bytes:
+                    self.stats["too_large"] += 1
+                    return None
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def _prepare(self, url: str) -> Optional[PreparedImage]:
+        if url in self.known:
+            self.stats["known"] += 1
+            return self.known[url]
+        try:
+            data = await asyncio.wait_for(self._download(url), self.timeout)
+        except (httpx.HTTPError, asyncio.TimeoutError, OSError, ValueError):
+            # One dead link only costs the note that image.
+            self.stats["failed"] += 1
+            return None
+        if data is None:
+            return None
+        content_type = sniff_image_type(data)
+        if content_type is None:
+            self.stats["not_image"] += 1
+            return None
+        self.stats["fetched"] += 1
+        key = "sha256:" + hashlib.sha256(data).hexdigest()
+
+        if PIL_AVAILABLE:
+            try:
+                # Decoding and re-encoding is CPU work; keep it off the IO loop.
+                jpeg, perceptual_hash = await asyncio.to_thread(
+                    downscale, data, self.max_dimension, self.jpeg_quality
+                )
+            except (OSError, ValueError):
+                self.stats["not_image"] += 1
+                return None
+            image = PreparedImage(
+                url, key, "image/jpeg", len(jpeg), data_uri("image/jpeg", jpeg), perceptual_hash
+            )
+        else:
+            inlined = data_uri(content_type, data) if len(data) <= self.inline_max_bytes else None
+            image = PreparedImage(url, key, content_type, len(data), inlined)
+        try:
+            self.known[url] = image
+        except ValueError:
+            pass  # Larger than the whole cache.
+        return image
+
+    async def prepare(self, urls: List[str]) -> List[PreparedImage]:
+        """Prepare the usable images among `urls`, without duplicates, in order."""
+        prepared = await asyncio.gather(*(self._prepare(url) for url in dict.fromkeys(urls)))
+        images: List[PreparedImage] = []
+        keys = set()
+        for image in prepared:
+            if image is None:
+                continue
+            image_keys = {image.key, image.perceptual_hash} - {None}
+            if image_keys & keys:
+                self.stats["duplicates"] += 1
+                continue
+            keys.update(image_keys)
+            images.append(image)
+        return images
+
+    async def aclose(self) -> None:
+        await self.http_session.aclose()
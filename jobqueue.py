@@ -0,0 +1,153 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class Job:
+    id: int
+    key: str
+    payload: dict
+    attempts: int
+    lease_token: str
+
+
+class JobQueue:
+    """Durable SQLite job queue shared by an ingestion process and its workers.
+
+    `claim` leases the oldest available job for `visibility_timeout` seconds
+    inside a write transaction, so concurrent workers (threads or processes
+    on the same host) never receive the same job. A job whose lease expires
+    without `ack` or `fail` becomes available again; after `max_attempts`
+    claims it is marked failed. Retries back off exponentially from
+    `retry_delay` up to `max_retry_delay`. Lease tokens make acknowledgements
+    from a worker that lost its lease no-ops.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        visibility_timeout: float = 300,
+        max_attempts: int = 3,
+        retry_delay: float = 10,
+        retention: float = 24 * 3600,
+        max_retry_delay: float = 3600,
+    ):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retention = retention
+        self.lock = threading.Lock()
+        # Transactions are managed explicitly so claims can take the write
+        # lock up front with BEGIN IMMEDIATE.
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT NOT NULL UNIQUE,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'queued',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " available_at REAL NOT NULL,"
+            " lease_token TEXT,"
+            " error TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state_available_at ON jobs (state, available_at)"
+        )
+
+    def enqueue(self, key: str, payload: dict) -> bool:
+        """Add a job; returns False if a job with this key was already queued."""
+        now = time.time()
+        with self.lock:
+            added = self.db.execute(
+                "INSERT OR IGNORE INTO jobs (key, payload, available_at, updated_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(payload), now, now),
+            ).rowcount
+        return bool(added)
+
+    def claim(self) -> Optional[Job]:
+        """Lease the next available job, or return None if there is none."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases that used up their attempts are given up on.
+                self.db.execute(
+                    "UPDATE jobs SET state = 'failed', error = 'lease expired', updated_at = ?"
+                    " WHERE state = 'leased' AND available_at <= ? AND attempts >= ?",
+                    (now, now, self.max_attempts),
+                )
+                row = self.db.execute(
+                    "SELECT id, key, payload, attempts FROM jobs"
+                    " WHERE state IN ('queued', 'leased') AND available_at <= ?"
+                    " ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    self.db.execute("COMMIT")
+                    return None
+                job_id, key, payload, attempts = row
+                token = uuid.uuid4().hex
+                self.db.execute(
+                    "UPDATE jobs SET state = 'leased', attempts = ?, available_at = ?,"
+                    " lease_token = ?, updated_at = ? WHERE id = ?",
+                    (attempts + 1, now + self.visibility_timeout, token, now, job_id),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return Job(job_id, key, json.loads(payload), attempts + 1, token)
+
+    def _update_leased(self, job: Job, assignments: str, params: tuple) -> bool:
+        with self.lock:
+            updated = self.db.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ?"
+                " WHERE id = ? AND state = 'leased' AND lease_token = ?",
+                params + (time.time(), job.id, job.lease_token),
+            ).rowcount
+        return bool(updated)
+
+    def extend(self, job: Job) -> bool:
+        """Renew the lease of a job that is still being worked on."""
+        return self._update_leased(job, "available_at = ?", (time.time() + self.visibility_timeout,))
+
+    def ack(self, job: Job) -> bool:
+        return self._update_leased(job, "state = 'done'", ())
+
+    def fail(self, job: Job, error: str) -> bool:
+        """Release a job after an error, to be retried with exponential backoff."""
+        if job.attempts >= self.max_attempts:
+            return self.give_up(job, error)
+        delay = min(self.max_retry_delay, self.retry_delay * (2 ** (job.attempts - 1)))
+        return self._update_leased(
+            job, "state = 'queued', available_at = ?, error = ?", (time.time() + delay, error)
+        )
+
+    def give_up(self, job: Job, error: str) -> bool:
+        """Mark a job failed without retrying it."""
+        return self._update_leased(job, "state = 'failed', error = ?", (error,))
+
+    def prune(self) -> int:
+        """Delete finished jobs older than the retention period."""
+        with self.lock:
+            return self.db.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - self.retention,),
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
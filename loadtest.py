@@ -0,0 +1,542 @@
+"""Offline load test of the whole bot pipeline.
+
+Relay frames (synthetic, or recorded with `--frames`) are replayed at a fixed
+rate through pynostr relay objects into `main.on_message`, the same path live
+frames take. Target lookups are answered by a fake relay manager, and the
+fact-checker talks to a local fake Mistral agent, search engine and web
+server, so no network access or API key is needed.
+
+Reports end-to-end latency (mention received to reply published), events per
+second, peak memory and IO loop stalls.
+
+Usage: python loadtest.py [options]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import tornado.web
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pynostr.base_relay import BaseRelay, RelayPolicy
+from pynostr.event import Event, EventKind
+from pynostr.filters import Filters, FiltersList
+from pynostr.key import PrivateKey
+
+from benchmark import random_claim, synthetic_page
+from factchecker import AsyncFactChecker, FactChecker
+
+
+# ============================================================
+# FAKE SERVICES
+# ============================================================
+
+class FakeAgentHandler(tornado.web.RequestHandler):
+    """`agents.complete` stand-in: `rounds` turns of tool calls, then a verdict.
+
+    Streamed requests get server-sent events: the first one after 30% of
+    `api_latency`, then the tool calls (each split over two chunks) or the
+    words of the verdict spread over the rest, like tokens being generated.
+    """
+
+    def initialize(self, services: "FakeServices"):
+        self.services = services
+
+    async def post(self):
+        request = json.loads(self.request.body)
+        messages = request["messages"]
+        round_number = sum(1 for message in messages if message.get("role") == "assistant")
+
+        if round_number < self.services.rounds and request.get("tool_choice") != "none":
+            page_url = f"{self.services.url}/page/{uuid.uuid4().hex}"
+            tool_calls = [
+                {
+                    "id": f"search{round_number}",
+                    "type": "function",
+                    "function": {"name": "web_search", "arguments": json.dumps({"query": f"round {round_number}"})},
+                },
+                {
+                    "id": f"page{round_number}",
+                    "type": "function",
+                    "function": {"name": "get_webpage_content", "arguments": json.dumps({"url": page_url})},
+                },
+            ]
+            message = {"role": "assistant", "content": "", "tool_calls": tool_calls}
+            finish_reason = "tool_calls"
+        else:
+            message = {"role": "assistant", "content": "Verdict: unverified (load test).", "tool_calls": None}
+            finish_reason = "stop"
+
+        prompt_tokens = len(self.request.body) // 4
+        response = {
+            "id": uuid.uuid4().hex,
+            "object": "chat.completion",
+            "model": "fake-agent",
+            "created": int(time.time()),
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+        }
+        if request.get("stream"):
+            await self._stream(response, message, finish_reason)
+            return
+        await asyncio.sleep(self.services.api_latency)
+        self.write({**response, "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]})
+
+    async def _stream(self, response: dict, message: dict, finish_reason: str) -> None:
+        deltas = []
+        for index, tool_call in enumerate(message["tool_calls"] or []):
+            arguments = tool_call["function"]["arguments"]
+            middle = len(arguments) // 2
+            deltas.append({"tool_calls": [{**tool_call, "index": index, "function": {
+                "name": tool_call["function"]["name"], "arguments": arguments[:middle]}}]})
+            deltas.append({"tool_calls": [{"id": "null", "index": index, "function": {
+                "name": "", "arguments": arguments[middle:]}}]})
+        if message["content"] or not deltas:
+            words = (message["content"] or "").split(" ")
+            deltas.extend({"content": (" " if i else "") + word} for i, word in enumerate(words))
+        deltas[0]["role"] = "assistant"
+
+        self.set_header("Content-Type", "text/event-stream")
+        await asyncio.sleep(0.3 * self.services.api_latency)
+        gap = 0.7 * self.services.api_latency / max(1, len(deltas))
+        for number, delta in enumerate(deltas):
+            chunk = {key: value for key, value in response.items() if key != "usage"}
+            last = number == len(deltas) - 1
+            chunk["choices"] = [{"index": 0, "delta": delta, "finish_reason": finish_reason if last else None}]
+            if last:
+                chunk["usage"] = response["usage"]
+            self.write(f"data: {json.dumps(chunk)}\n\n")
+            await self.flush()
+            if not last:
+                await asyncio.sleep(gap)
+        self.write("data: [DONE]\n\n")
+
+
+class FakeSearchHandler(tornado.web.RequestHandler):
+    def initialize(self, services: "FakeServices"):
+        self.services = services
+
+    async def get(self):
+        await asyncio.sleep(self.services.search_latency)
+        count = int(self.get_argument("n", "7"))
+        results = [
+            {"url": f"{self.services.url}/page/{uuid.uuid4().hex}", "title": f"Result {i}", "body": "Snippet."}
+            for i in range(count)
+        ]
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(results))
+
+
+class FakePageHandler(tornado.web.RequestHandler):
+    def initialize(self, services: "FakeServices"):
+        self.services = services
+
+    async def get(self, page_id):
+        await asyncio.sleep(self.services.page_latency)
+        self.set_header("Content-Type", "text/html; charset=utf-8")
+        self.write(self.services.page)
+
+
+class FakeServices:
+    """Fake Mistral, search and web endpoints served from a background thread.
+
+    They run on their own IO loop so their work does not show up as stalls of
+    the bot's loop.
+    """
+
+    def __init__(
+        self,
+        rounds: int = 2,
+        api_latency: float = 0.2,
+        search_latency: float = 0.05,
+        page_latency: float = 0.05,
+        page_paragraphs: int = 50,
+    ):
+        self.rounds = rounds
+        self.api_latency = api_latency
+        self.search_latency = search_latency
+        self.page_latency = page_latency
+        self.page = synthetic_page(random.Random(0), page_paragraphs)
+        self.url = ""
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.io_loop = IOLoop.current()
+        app = tornado.web.Application([
+            (r"/v1/agents/completions", FakeAgentHandler, {"services": self}),
+            (r"/search", FakeSearchHandler, {"services": self}),
+            (r"/page/(.*)", FakePageHandler, {"services": self}),
+        ])
+        sock, port = bind_unused_port()
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        self.url = f"http://127.0.0.1:{port}"
+        self.ready.set()
+        self.io_loop.start()
+
+    def start(self) -> None:
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self) -> None:
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+
+
+class FakeSearchMixin:
+    """Send the agent's web searches to the fake search endpoint."""
+
+    search_url: str
+    search_client: httpx.Client
+
+    def _search_results(self, query: str, num_results: int) -> List[dict]:
+        response = self.search_client.get(self.search_url, params={"q": query, "n": num_results})
+        response.raise_for_status()
+        return response.json()
+
+
+class LoadTestFactChecker(FakeSearchMixin, FactChecker):
+    def __init__(self, search_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.search_url = search_url
+        self.search_client = httpx.Client(timeout=10)
+
+
+class LoadTestAsyncFactChecker(FakeSearchMixin, AsyncFactChecker):
+    def __init__(self, search_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.search_url = search_url
+        self.search_client = httpx.Client(timeout=10)
+
+
+class ReplayRelayManager:
+    """RelayPool stand-in: every relay answers lookups from `store` and
+    acknowledges every publish."""
+
+    def __init__(self, relays: Dict[str, BaseRelay], store: Dict[str, dict], latency: float):
+        self.relays = relays
+        self.store = store
+        self.latency = latency
+        self.published: List[Tuple[float, Event]] = []
+        self.on_ok = None
+
+    def add_subscription_on_all_relays(self, id: str, filters: FiltersList) -> None:
+        for relay in self.relays.values():
+            relay.add_subscription(id, filters)
+        ids = filters.to_json_array()[0].get("ids", [])
+        IOLoop.current().call_later(self.latency, self._answer, id, ids)
+
+    def _answer(self, id: str, ids: List[str]) -> None:
+        for event_id in ids:
+            event = self.store.get(event_id)
+            if event is None:
+                continue
+            frame = json.dumps(["EVENT", id, event])
+            for relay in self.relays.values():
+                if id in relay.subscriptions:
+                    relay._on_message(frame)
+
+    def close_subscription_on_all_relays(self, id: str) -> None:
+        for relay in self.relays.values():
+            relay.close_subscription(id)
+
+    def ranked(self) -> List[str]:
+        return list(self.relays)
+
+    def publish_event(self, event: Event, urls: Optional[List[str]] = None) -> List[str]:
+        urls = urls or self.ranked()
+        self.published.append((time.monotonic(), event))
+        for url in urls:
+            IOLoop.current().call_later(self.latency, self.on_ok, url, event.id, True, "")
+        return urls
+
+    def publish_timed_out(self, url: str, event_id: str) -> None:
+        pass
+
+
+# ============================================================
+# WORKLOAD
+# ============================================================
+
+def synthetic_events(rng: random.Random, mentions: int, noise: int, users: int, npub: str, pubkey: str):
+    """Mentions asking to check distinct notes, shuffled with unrelated notes.
+
+    Returns the note stream and the target notes, keyed by id, that the fake
+    relays serve to lookups.
+    """
+    vocabulary = [f"word{i}" for i in range(20000)]
+    authors = [PrivateKey() for _ in range(20)]
+    requesters = [PrivateKey() for _ in range(users)]
+    targets: Dict[str, dict] = {}
+    stream: List[dict] = []
+
+    for _ in range(mentions):
+        target = Event(content=random_claim(rng, vocabulary))
+        target.sign(rng.choice(authors).hex())
+        targets[target.id] = target.to_dict()
+
+        mention = Event(content=f"nostr:{npub} is this true?")
+        mention.tags = [["e", target.id, "", "reply"], ["p", target.pubkey], ["p", pubkey]]
+        mention.sign(rng.choice(requesters).hex())
+        stream.append(mention.to_dict())
+
+    for _ in range(noise):
+        note = Event(content=random_claim(rng, vocabulary, words=rng.randrange(5, 60)))
+        note.sign(rng.choice(authors).hex())
+        stream.append(note.to_dict())
+
+    rng.shuffle(stream)
+    return stream, targets
+
+
+def recorded_events(path: str) -> List[dict]:
+    """Events from a file of raw relay frames or event objects, one per line."""
+    events = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if isinstance(message, list):
+                if message[0] != "EVENT":
+                    continue
+                message = message[2]
+            events.append(message)
+    return events
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class StallMonitor:
+    """Measures how late the IO loop wakes up from short sleeps."""
+
+    def __init__(self, interval: float = 0.01, threshold: float = 0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.running = False
+        self.stalls = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+    @gen.coroutine
+    def run(self):
+        self.running = True
+        while self.running:
+            started = time.monotonic()
+            yield gen.sleep(self.interval)
+            lag = time.monotonic() - started - self.interval
+            if lag > self.threshold:
+                self.stalls += 1
+                self.total += lag
+                self.longest = max(self.longest, lag)
+
+
+# ============================================================
+# RUN
+# ============================================================
+
+def configure_environment(args, services: FakeServices, directory: str) -> None:
+    """Settings for `main`, which reads them at import time."""
+    os.environ.update({
+        "FACTCHECKER_PRIVATE_KEY": PrivateKey().hex(),
+        "MISTRAL_API_KEY": "loadtest",
+        "MISTRAL_SERVER_URL": services.url,
+        "MISTRAL_RPM": "1000000",
+        "MISTRAL_TPM": "0",
+        "FACTCHECK_ENGINE": args.engine,
+        "FACTCHECK_WORKERS": str(args.workers),
+        "FACTCHECK_QUEUE_SIZE": str(args.queue_size),
+        "RATE_LIMIT_DELAY_MS": str(args.rate_limit_delay_ms),
+        "FIREHOSE_MAX_EVENTS_PER_SECOND": "1000000000",
+        "RESULT_CACHE_PATH": os.path.join(directory, "results.sqlite3"),
+        "TOOL_CACHE_PATH": os.path.join(directory, "tools.sqlite3"),
+        "EVENT_LOG_PATH": os.path.join(directory, "events.sqlite3"),
+        "JOB_QUEUE_PATH": os.path.join(directory, "jobs.sqlite3"),
+        "REPUBLISH_QUEUE_PATH": os.path.join(directory, "republish.sqlite3"),
+    })
+
+
+def run(args) -> None:
+    services = FakeServices(
+        rounds=args.rounds,
+        api_latency=args.api_latency,
+        search_latency=args.search_latency,
+        page_latency=args.page_latency,
+        page_paragraphs=args.page_paragraphs,
+    )
+    services.start()
+    configure_environment(args, services, tempfile.mkdtemp(prefix="factchecker-loadtest-"))
+
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main.log.setLevel(logging.WARNING)
+
+    checker_class = LoadTestAsyncFactChecker if args.engine == "async" else LoadTestFactChecker
+    main.factchecker = checker_class(
+        search_url=f"{services.url}/search",
+        api_key="loadtest",
+        agent_id=main.FACTCHECKER_AGENT_ID,
+        rate_limiter=main.mistral_rate_limiter,
+        tool_cache=main.tool_cache,
+        server_url=services.url,
+        context_max_tokens=main.CONTEXT_MAX_TOKENS,
+        max_rounds=main.FACTCHECK_MAX_ROUNDS,
+        max_check_seconds=main.FACTCHECK_MAX_SECONDS,
+        stream_responses=args.stream,
+    )
+
+    rng = random.Random(args.seed)
+    if args.frames:
+        stream = recorded_events(args.frames)
+        store = {event["id"]: event for event in stream}
+    else:
+        stream, store = synthetic_events(
+            rng, args.mentions, args.noise, args.users, main.FACTCHECKER_NPUB, main.FACTCHECKER_PUBKEY
+        )
+
+    relays = {
+        url: BaseRelay(url, RelayPolicy(), close_on_eose=False, message_callback=main.on_message, message_callback_url=True)
+        for url in (f"wss://relay{i}.loadtest" for i in range(args.copies))
+    }
+    manager = ReplayRelayManager(relays, store, args.relay_latency)
+    main.setup_pipeline(manager)
+    for relay in relays.values():
+        relay.add_subscription(
+            main.mention_subscription_id,
+            FiltersList([Filters(kinds=[EventKind.TEXT_NOTE], pubkey_refs=[main.FACTCHECKER_PUBKEY])]),
+        )
+        relay.add_subscription(main.firehose_subscription_id, FiltersList([Filters(kinds=[EventKind.TEXT_NOTE])]))
+        main.frame_prefilter.install(relay)
+
+    # Every note is delivered once per relay; mentions are tracked by the
+    # note they ask about, which is what the reply references.
+    frames: List[Tuple[str, str, Optional[str]]] = []
+    for event_dict in stream:
+        event = Event.from_dict(event_dict)
+        is_mention = main.FACTCHECKER_PUBKEY in (tag[0] for tag in event.get_tag_list("p"))
+        subscription_id = main.mention_subscription_id if is_mention else main.firehose_subscription_id
+        target_id = None
+        if is_mention and main.should_handle_event(event):
+            replies = [tag[0] for tag in event.get_tag_list("e")]
+            target_id = replies[0] if replies else None
+        frame = json.dumps(["EVENT", subscription_id, event_dict])
+        frames.extend((url, frame, target_id) for url in relays)
+    print(f"Replaying {len(frames)} frames ({len(stream)} notes x {args.copies} relays) at {args.rate:g} frames/s")
+
+    received_at: Dict[str, float] = {}
+    monitor = StallMonitor()
+
+    @gen.coroutine
+    def drive():
+        IOLoop.current().spawn_callback(monitor.run)
+        for _ in range(main.FACTCHECK_WORKERS):
+            IOLoop.current().spawn_callback(main.factcheck_worker)
+
+        started = time.monotonic()
+        for index, (url, frame, target_id) in enumerate(frames):
+            delay = started + index / args.rate - time.monotonic()
+            if delay > 0:
+                yield gen.sleep(delay)
+            if target_id is not None:
+                received_at.setdefault(target_id, time.monotonic())
+            relays[url]._on_message(frame)
+        ingest_elapsed = time.monotonic() - started
+
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline and (
+            main.factcheck_scheduler.depth or len(manager.published) < main.factcheck_scheduler.stats["dispatched"]
+        ):
+            yield gen.sleep(0.05)
+        monitor.running = False
+        return ingest_elapsed, time.monotonic() - started
+
+    ingest_elapsed, total_elapsed = IOLoop.current().run_sync(drive)
+    services.stop()
+
+    latencies = sorted(
+        published_at - received_at[reply.get_tag_list("e")[0][0]]
+        for published_at, reply in manager.published
+        if reply.get_tag_list("e") and reply.get_tag_list("e")[0][0] in received_at
+    )
+    frame_stats: Counter = sum(main.frame_prefilter.stats.values(), Counter())
+    queue = main.factcheck_scheduler.metrics()
+
+    print(
+        f"Engine: {args.engine}{' (streaming)' if args.stream else ''}, "
+        f"{main.FACTCHECK_WORKERS} workers, {args.rounds} tool rounds"
+    )
+    print(f"Ingestion: {len(frames) / ingest_elapsed:,.0f} frames/s offered over {ingest_elapsed:.2f}s")
+    print(
+        f"Frames: {frame_stats['events']} events, {frame_stats['duplicates']} duplicates and "
+        f"{frame_stats['irrelevant']} irrelevant dropped before parsing"
+    )
+    print(
+        f"Fact-checks: {len(manager.published)} published, {queue.get('accepted', 0)} accepted, "
+        f"{queue.get('shed_queue_full', 0) + queue.get('shed_pubkey_quota', 0)} shed, "
+        f"{len(manager.published) / total_elapsed:.2f}/s over {total_elapsed:.2f}s"
+    )
+    print(
+        f"End-to-end latency: p50 {percentile(latencies, 0.5):.3f}s, p95 {percentile(latencies, 0.95):.3f}s, "
+        f"p99 {percentile(latencies, 0.99):.3f}s, max {latencies[-1] if latencies else 0:.3f}s"
+    )
+    print(f"Queue wait: p50 {queue['wait_p50']}s, p95 {queue['wait_p95']}s, max {queue['wait_max']}s")
+    context = main.factchecker.context_stats
+    print(
+        f"Context budget: {context['tokens_saved']:,} prompt tokens saved over {context['checks']} checks, "
+        f"{context['compacted_results']} tool results compacted, {context['forced_answers']} answers forced"
+    )
+    print(
+        f"IO loop stalls over {monitor.threshold * 1000:g} ms: {monitor.stalls}, "
+        f"{monitor.total:.3f}s in total, longest {monitor.longest * 1000:.1f} ms"
+    )
+    # ru_maxrss is in KiB on Linux; it includes the fake services' thread.
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", help="replay recorded relay frames (JSON lines) instead of synthetic ones")
+    parser.add_argument("--mentions", type=int, default=200, help="synthetic fact-check requests")
+    parser.add_argument("--noise", type=int, default=2000, help="synthetic unrelated notes")
+    parser.add_argument("--users", type=int, default=100, help="distinct requesters")
+    parser.add_argument("--copies", type=int, default=3, help="relays delivering every note")
+    parser.add_argument("--rate", type=float, default=2000, help="frames per second")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--rate-limit-delay-ms", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=2, help="tool-call rounds per fact-check")
+    parser.add_argument("--stream", action="store_true", help="stream agent responses")
+    parser.add_argument("--api-latency", type=float, default=0.2)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--page-latency", type=float, default=0.05)
+    parser.add_argument("--page-paragraphs", type=int, default=50)
+    parser.add_argument("--relay-latency", type=float, default=0.05, help="delay before lookups are answered")
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,34 @@ import datetime
 import uuid
 import sys
 import os
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
 from cachetools import TTLCache
 from tornado import gen
-from tornado.queues import Queue
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 from pynostr.event import EventKind, Event
 from pynostr.filters import Filters, FiltersList
 from pynostr.message_type import RelayMessageType
-from pynostr.relay_list import RelayList
 from pynostr.relay_manager import RelayManager
 
-from factchecker import FactChecker
+from event_resolver import EventResolver
+from jobqueue import Job, JobQueue
+from metrics import metrics, metrics_app
+from factchecker import AsyncFactChecker, FactChecker
+from images import ImagePrefetcher, PreparedImage, extract_image_urls
+from prefilter import FramePrefilter
+from publisher import ReplyPublisher
+from relay_pool import RelayPool
+from ratelimit import ApiRateLimiter, TokenBucket
+from scheduler import RequestScheduler
+from cache import ResultCache, ToolCache, claim_cache_key
+from checkpoint import EventLog
+from similarity import ClaimIndex, meaning_changes
 from pynostr.key import PublicKey 
 from pynostr.bech32 import bech32_encode
 
@@ -50,8 +65,141 @@ FACTCHECKER_AGENT_ID = "ag_019b704bddcc72079c3a26f9cb4891fa"
 FACTCHECKER_NPUB = "npub1gy63uvtxu7mdmhwyczk53e5n28krg5p8wx3pdklq3w5udq7ylcwqvrwygj"
 FACTCHECKER_PUBKEY = "41351e3166e7b6ddddc4c0ad48e69351ec34502771a216dbe08ba9c683c4fe1c"
 
-RATE_LIMIT_DELAY = datetime.timedelta(milliseconds=5000)
+# Minimum delay between two fact-check requests taken off the queue, across
+# all requesters.
+RATE_LIMIT_DELAY = datetime.timedelta(milliseconds=int(os.environ.get("RATE_LIMIT_DELAY_MS", "5000")))
 FETCH_EVENT_TIMEOUT = 10.0
+# Lookups issued within this many seconds share one REQ; recently seen events
+# are kept locally so they resolve without asking the relays.
+FETCH_EVENT_BATCH_WINDOW = float(os.environ.get("FETCH_EVENT_BATCH_WINDOW", "0.05"))
+EVENT_STORE_SIZE = int(os.environ.get("EVENT_STORE_SIZE", "5000"))
+
+# Mentions that p-tag the bot are filtered by the relays themselves. Plain
+# "@factchecker" text mentions need the unfiltered TEXT_NOTE firehose, which is
+# optional, only opened on a few relays and capped in events per second.
+ENABLE_MENTION_FIREHOSE = os.environ.get("ENABLE_MENTION_FIREHOSE", "true").lower() == "true"
+FIREHOSE_RELAY_COUNT = int(os.environ.get("FIREHOSE_RELAY_COUNT", "2"))
+FIREHOSE_MAX_EVENTS_PER_SECOND = float(os.environ.get("FIREHOSE_MAX_EVENTS_PER_SECOND", "50"))
+RELAY_STATS_INTERVAL = float(os.environ.get("RELAY_STATS_INTERVAL", "60"))
+
+# Relays are probed concurrently at startup and then scored on live latency,
+# errors and how many events they deliver first. Lookups go to the best
+# RELAY_LOOKUP_FANOUT relays, and to all others once those answered EOSE
+# without the event or after RELAY_LOOKUP_FALLBACK seconds. Replies are
+# published to the best RELAY_PUBLISH_FANOUT.
+RELAY_PROBE_TIMEOUT = float(os.environ.get("RELAY_PROBE_TIMEOUT", "3"))
+RELAY_LOOKUP_FANOUT = int(os.environ.get("RELAY_LOOKUP_FANOUT", "4"))
+RELAY_LOOKUP_FALLBACK = float(os.environ.get("RELAY_LOOKUP_FALLBACK", "2"))
+RELAY_PUBLISH_FANOUT = int(os.environ.get("RELAY_PUBLISH_FANOUT", "6"))
+
+# A reply counts as delivered once REPLY_QUORUM relays acknowledged it with an
+# OK. Each publish round waits REPLY_ACK_TIMEOUT seconds before trying other
+# relays; replies that still fall short are re-published every
+# REPUBLISH_INTERVAL seconds from the REPUBLISH_QUEUE_PATH queue, backing off
+# to at most REPUBLISH_MAX_DELAY between attempts, and dropped once they are
+# REPUBLISH_MAX_AGE seconds old.
+REPLY_QUORUM = int(os.environ.get("REPLY_QUORUM", "2"))
+REPLY_ACK_TIMEOUT = float(os.environ.get("REPLY_ACK_TIMEOUT", "10"))
+REPLY_PUBLISH_ROUNDS = int(os.environ.get("REPLY_PUBLISH_ROUNDS", "3"))
+REPUBLISH_QUEUE_PATH = os.environ.get("REPUBLISH_QUEUE_PATH", "republish.sqlite3")
+REPUBLISH_INTERVAL = float(os.environ.get("REPUBLISH_INTERVAL", "60"))
+REPUBLISH_MAX_DELAY = float(os.environ.get("REPUBLISH_MAX_DELAY", "3600"))
+REPUBLISH_MAX_AGE = float(os.environ.get("REPUBLISH_MAX_AGE", str(6 * 3600)))
+
+# Prometheus-style /metrics endpoint, disabled when the port is 0. Stage spans
+# are also exported over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+# Handled requests and the time up to which mentions were received survive
+# restarts. On startup the mention subscription resumes CATCH_UP_MARGIN
+# seconds before that checkpoint, but never more than CATCH_UP_MAX_AGE ago.
+EVENT_LOG_PATH = os.environ.get("EVENT_LOG_PATH", "event_log.sqlite3")
+EVENT_LOG_RETENTION = float(os.environ.get("EVENT_LOG_RETENTION", str(7 * 24 * 3600)))
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "10"))
+CATCH_UP_MARGIN = float(os.environ.get("CATCH_UP_MARGIN", "300"))
+CATCH_UP_MAX_AGE = float(os.environ.get("CATCH_UP_MAX_AGE", str(24 * 3600)))
+
+# Number of fact-checks allowed to run in parallel, how many accepted
+# requests may wait for a free worker before new ones are shed, and how many
+# of those may come from the same requester.
+FACTCHECK_WORKERS = int(os.environ.get("FACTCHECK_WORKERS", "4"))
+FACTCHECK_QUEUE_SIZE = int(os.environ.get("FACTCHECK_QUEUE_SIZE", "100"))
+FACTCHECK_MAX_PENDING_PER_PUBKEY = int(os.environ.get("FACTCHECK_MAX_PENDING_PER_PUBKEY", "3"))
+
+# Requests for notes already in the result cache are answered without
+# queueing, up to CACHED_REPLIES_PER_MINUTE overall and
+# CACHED_REPLIES_PER_PUBKEY_PER_MINUTE per requester; beyond that they take
+# the normal queue with its per-requester quota and pacing.
+CACHED_REPLIES_PER_MINUTE = float(os.environ.get("CACHED_REPLIES_PER_MINUTE", "30"))
+CACHED_REPLIES_PER_PUBKEY_PER_MINUTE = float(os.environ.get("CACHED_REPLIES_PER_PUBKEY_PER_MINUTE", "2"))
+
+# "all" listens to relays and fact-checks in one process. For scale-out, run
+# one "ingest" process that listens to relays and queues accepted requests in
+# the shared JOB_QUEUE_PATH database, and any number of "worker" processes
+# that claim and answer them. RATE_LIMIT_DELAY_MS paces the ingest process
+# and MISTRAL_RPM/MISTRAL_TPM apply per worker, so split both accordingly.
+FACTCHECK_ROLE = os.environ.get("FACTCHECK_ROLE", "all")
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.sqlite3")
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", "120"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+
+# "thread" runs the blocking FactChecker on a thread pool, "async" awaits
+# AsyncFactChecker directly on the IO loop.
+FACTCHECK_ENGINE = os.environ.get("FACTCHECK_ENGINE", "thread")
+
+# Mistral quota shared by all concurrent fact-checks.
+MISTRAL_RPM = float(os.environ.get("MISTRAL_RPM", "60"))
+MISTRAL_TPM = float(os.environ.get("MISTRAL_TPM", "500000"))
+# Alternative Mistral-compatible API endpoint (the load-test harness uses a
+# local fake one).
+MISTRAL_SERVER_URL = os.environ.get("MISTRAL_SERVER_URL")
+
+# Per-check budget of the agent loop: tool results are compacted to the
+# passages most relevant to the claim once a conversation exceeds
+# CONTEXT_MAX_TOKENS, and the agent has to answer after FACTCHECK_MAX_ROUNDS
+# tool turns or FACTCHECK_MAX_SECONDS.
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "8000"))
+FACTCHECK_MAX_ROUNDS = int(os.environ.get("FACTCHECK_MAX_ROUNDS", "6"))
+FACTCHECK_MAX_SECONDS = float(os.environ.get("FACTCHECK_MAX_SECONDS", "120"))
+# Stream the agent's responses and start each tool call as soon as its
+# arguments have been generated.
+FACTCHECK_STREAM_RESPONSES = os.environ.get("FACTCHECK_STREAM_RESPONSES", "false").lower() == "true"
+
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "factcheck_cache.sqlite3")
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Search results and page text fetched by the agent's tools.
+TOOL_CACHE_PATH = os.environ.get("TOOL_CACHE_PATH", "tool_cache.sqlite3")
+TOOL_CACHE_MEMORY_TTL = float(os.environ.get("TOOL_CACHE_MEMORY_TTL", "600"))
+TOOL_CACHE_MEMORY_MAX_BYTES = int(os.environ.get("TOOL_CACHE_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+TOOL_CACHE_DISK_TTL = float(os.environ.get("TOOL_CACHE_DISK_TTL", str(24 * 3600)))
+TOOL_CACHE_DISK_MAX_BYTES = int(os.environ.get("TOOL_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Pooled connections used by the agent's page fetches.
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "6"))
+
+# Images in a claim are fetched before the check. Those that fail to load,
+# are larger than IMAGE_MAX_BYTES or are not images are left out; the others
+# are downscaled to IMAGE_MAX_DIMENSION pixels (with Pillow installed) and
+# sent to the agent inline.
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_INLINE_MAX_BYTES = int(os.environ.get("IMAGE_INLINE_MAX_BYTES", str(1024 * 1024)))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", "10"))
+# Prepared images are kept in memory for an hour, up to this many bytes of
+# inlined data, so repeated URLs are not fetched again.
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Estimated Jaccard similarity above which an earlier verdict is given to the
+# agent as context, and above which it may be reused as is. Reuse is off by
+# default: shingles cannot tell a claim from its negation, so even with it on
+# claims differing in a negation or a number are always checked again.
+ENABLE_NEAR_DUPLICATE_REUSE = os.environ.get("ENABLE_NEAR_DUPLICATE_REUSE", "false").lower() == "true"
+NEAR_DUPLICATE_REUSE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_REUSE_THRESHOLD", "0.9"))
+NEAR_DUPLICATE_CONTEXT_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_CONTEXT_THRESHOLD", "0.6"))
 
 
 # ============================================================
@@ -84,21 +232,133 @@ MUTED_PUBKEYS = {
 }
 
 
+# ============================================================
+# PRIORITY USERS
+# ============================================================
+
+# Requests from these pubkeys (comma-separated hex), like those from people
+# asking for the first time, are served before everybody else's.
+FOLLOWED_PUBKEYS = {
+    pubkey.strip()
+    for pubkey in os.environ.get("FOLLOWED_PUBKEYS", "").split(",")
+    if pubkey.strip()
+}
+
+
 # ============================================================
 # GLOBAL STATE
 # ============================================================
 
 event_dedup_cache = TTLCache(maxsize=1000, ttl=60)
-pending_event_requests: Dict[str, Queue] = {}
+# Owned by the process that listens for mentions; workers never open it.
+event_log: Optional[EventLog] = None
+if FACTCHECK_ROLE != "worker":
+    event_log = EventLog(EVENT_LOG_PATH, retention=EVENT_LOG_RETENTION)
+
+mention_subscription_id = uuid.uuid4().hex
+firehose_subscription_id = uuid.uuid4().hex
+firehose_bucket = TokenBucket(FIREHOSE_MAX_EVENTS_PER_SECOND, FIREHOSE_MAX_EVENTS_PER_SECOND)
+
+cached_reply_bucket = TokenBucket(CACHED_REPLIES_PER_MINUTE / 60, CACHED_REPLIES_PER_MINUTE)
+# Requester pubkey -> its TokenBucket for cached replies; idle ones expire.
+cached_reply_pubkey_buckets = TTLCache(maxsize=100000, ttl=3600)
+
+# Per relay: "received" EVENT frames (of which "firehose" came from the
+# firehose subscription and "firehose_dropped" exceeded its cap),
+# "duplicates" and "handled" fact-check requests.
+relay_stats: Dict[str, Counter] = defaultdict(Counter)
+
+# check_fact is blocking (LLM calls, page fetches, searches), so it runs on
+# this pool instead of the IO loop that reads the relay sockets.
+factcheck_executor = ThreadPoolExecutor(
+    max_workers=FACTCHECK_WORKERS,
+    thread_name_prefix="factcheck",
+)
+factcheck_scheduler = RequestScheduler(
+    min_interval=RATE_LIMIT_DELAY.total_seconds(),
+    max_depth=FACTCHECK_QUEUE_SIZE,
+    max_per_pubkey=FACTCHECK_MAX_PENDING_PER_PUBKEY,
+    is_priority=lambda pubkey: pubkey in FOLLOWED_PUBKEYS,
+)
+
+result_cache = ResultCache(RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL)
+claim_index = ClaimIndex()
+inflight_factchecks: Dict[str, Future] = {}
+
+mistral_rate_limiter = ApiRateLimiter(
+    requests_per_minute=MISTRAL_RPM,
+    tokens_per_minute=MISTRAL_TPM,
+)
 
-last_sent_message_time = datetime.datetime.min
+tool_cache = ToolCache(
+    TOOL_CACHE_PATH,
+    memory_ttl=TOOL_CACHE_MEMORY_TTL,
+    memory_max_bytes=TOOL_CACHE_MEMORY_MAX_BYTES,
+    disk_ttl=TOOL_CACHE_DISK_TTL,
+    disk_max_bytes=TOOL_CACHE_DISK_MAX_BYTES,
+)
 
-factchecker = FactChecker(
-    api_key=MISTRAL_API_KEY,
-    agent_id=FACTCHECKER_AGENT_ID
+image_prefetcher = ImagePrefetcher(
+    max_bytes=IMAGE_MAX_BYTES,
+    max_dimension=IMAGE_MAX_DIMENSION,
+    inline_max_bytes=IMAGE_INLINE_MAX_BYTES,
+    timeout=IMAGE_FETCH_TIMEOUT,
+    remembered_bytes=IMAGE_CACHE_MAX_BYTES,
+)
+
+if FACTCHECK_ENGINE == "async":
+    factchecker = AsyncFactChecker(
+        api_key=MISTRAL_API_KEY,
+        agent_id=FACTCHECKER_AGENT_ID,
+        rate_limiter=mistral_rate_limiter,
+        tool_cache=tool_cache,
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_connections_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        server_url=MISTRAL_SERVER_URL,
+        context_max_tokens=CONTEXT_MAX_TOKENS,
+        max_rounds=FACTCHECK_MAX_ROUNDS,
+        max_check_seconds=FACTCHECK_MAX_SECONDS,
+        stream_responses=FACTCHECK_STREAM_RESPONSES,
+    )
+elif FACTCHECK_ENGINE == "thread":
+    factchecker = FactChecker(
+        api_key=MISTRAL_API_KEY,
+        agent_id=FACTCHECKER_AGENT_ID,
+        rate_limiter=mistral_rate_limiter,
+        tool_cache=tool_cache,
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_connections_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        server_url=MISTRAL_SERVER_URL,
+        context_max_tokens=CONTEXT_MAX_TOKENS,
+        max_rounds=FACTCHECK_MAX_ROUNDS,
+        max_check_seconds=FACTCHECK_MAX_SECONDS,
+        stream_responses=FACTCHECK_STREAM_RESPONSES,
+    )
+else:
+    raise ValueError(f"Unknown FACTCHECK_ENGINE: {FACTCHECK_ENGINE}")
+
+if FACTCHECK_ROLE not in ("all", "ingest", "worker"):
+    raise ValueError(f"Unknown FACTCHECK_ROLE: {FACTCHECK_ROLE}")
+
+job_queue: Optional[JobQueue] = None
+if FACTCHECK_ROLE != "all":
+    job_queue = JobQueue(
+        JOB_QUEUE_PATH,
+        visibility_timeout=JOB_VISIBILITY_TIMEOUT,
+        max_attempts=JOB_MAX_ATTEMPTS,
+    )
+
+republish_queue = JobQueue(
+    REPUBLISH_QUEUE_PATH,
+    max_attempts=20,
+    retry_delay=REPUBLISH_INTERVAL,
+    max_retry_delay=REPUBLISH_MAX_DELAY,
 )
 
 relay_manager: RelayManager
+event_resolver: EventResolver
+frame_prefilter: FramePrefilter
+reply_publisher: ReplyPublisher
 
 
 # ============================================================
@@ -108,40 +368,14 @@ relay_manager: RelayManager
 def pubkey_to_npub(pubkey: str) -> str:
     return PublicKey(bytes.fromhex(pubkey)).bech32()
 
-def extract_image_urls(content: str) -> List[str]:
-    if not content:
-        return []
-
-    return [
-        word for word in content.split()
-        if word.startswith(("http://", "https://"))
-        and word.lower().endswith((
-            ".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"
-        ))
-    ]
-
 
 @gen.coroutine
-def fetch_event_by_id(event_id: str, timeout: float = FETCH_EVENT_TIMEOUT):
-    queue = Queue()
-    pending_event_requests[event_id] = queue
-
-    subscription_id = uuid.uuid4().hex
-    filters = FiltersList([Filters(ids=[event_id])])
-
-    relay_manager.add_subscription_on_all_relays(subscription_id, filters)
-
-    try:
-        event = yield gen.with_timeout(
-            datetime.timedelta(seconds=timeout),
-            queue.get()
-        )
-        return event
-    except TimeoutError:
+def fetch_event_by_id(event_id: str):
+    with metrics.stage("fetch_event"):
+        event = yield event_resolver.resolve(event_id)
+    if event is None:
         log.warning(f"Timeout while fetching event {event_id}")
-        return None
-    finally:
-        pending_event_requests.pop(event_id, None)
+    return event
 
 
 def should_handle_event(event: Event) -> bool:
@@ -168,115 +402,440 @@ def should_handle_event(event: Event) -> bool:
 # CORE MESSAGE HANDLER
 # ============================================================
 
+def take_cached_reply(pubkey: str) -> bool:
+    """Whether `pubkey` may be answered from the result cache right now."""
+    now = time.monotonic()
+    bucket = cached_reply_pubkey_buckets.get(pubkey)
+    if bucket is None:
+        bucket = cached_reply_pubkey_buckets[pubkey] = TokenBucket(
+            CACHED_REPLIES_PER_PUBKEY_PER_MINUTE / 60, CACHED_REPLIES_PER_PUBKEY_PER_MINUTE
+        )
+    if not bucket.try_take(1, now):
+        return False
+    if not cached_reply_bucket.try_take(1, now):
+        bucket.refund(1, now)
+        return False
+    return True
+
+
 @gen.coroutine
 def on_message(message_json, relay_url):
-    global last_sent_message_time
-
     if message_json[0] != RelayMessageType.EVENT:
         return
 
+    stats = relay_stats[relay_url]
+    stats["received"] += 1
+    metrics.inc("relay_events_total", relay=relay_url)
+    if message_json[1] == firehose_subscription_id:
+        stats["firehose"] += 1
+        if not firehose_bucket.try_take(1, time.monotonic()):
+            stats["firehose_dropped"] += 1
+            metrics.inc("requests_total", outcome="firehose_dropped")
+            return
+
     event = Event.from_dict(message_json[2])
 
-    if event.id in pending_event_requests:
-        pending_event_requests[event.id].put(event)
+    if event_resolver.on_event(message_json[1], event):
+        return
+
+    if FACTCHECK_ROLE == "worker":
         return
 
     if event.id in event_dedup_cache:
+        stats["duplicates"] += 1
+        metrics.inc("requests_total", outcome="duplicate")
         return
     event_dedup_cache[event.id] = True
 
     if not should_handle_event(event):
         return
 
+    if not event_log.add(event.id, event.created_at):
+        stats["duplicates"] += 1
+        metrics.inc("requests_total", outcome="duplicate")
+        return
+
+    stats["handled"] += 1
     log.info(f"Fact-check request from {event.pubkey}")
 
-    while datetime.datetime.now() - last_sent_message_time < RATE_LIMIT_DELAY:
-        yield gen.sleep(0.1)
+    # Notes checked before are answered right away instead of waiting for
+    # the fact-check queue and its rate limit.
+    target_event_id = reply_target_id(event)
+    cached_result = result_cache.get_by_event(target_event_id) if target_event_id else None
+    if cached_result is not None and take_cached_reply(event.pubkey):
+        log.info(f"Answering {event.id} with the cached fact-check of {target_event_id}")
+        metrics.inc("requests_total", outcome="cached")
+        relay_manager.io_loop.spawn_callback(reply_from_cache, event, target_event_id, cached_result)
+        return
+
+    if not factcheck_scheduler.submit(event.pubkey, event):
+        log.warning(f"Fact-check queue full for {event.pubkey}, dropping request {event.id}")
+        metrics.inc("requests_total", outcome="shed")
+        event_log.done(event.id)
+    else:
+        metrics.inc("requests_total", outcome="accepted")
+
+
+# ============================================================
+# FACT-CHECK WORKERS
+# ============================================================
+
+@gen.coroutine
+def factcheck_worker():
+    while True:
+        event = yield factcheck_scheduler.get()
+        try:
+            with metrics.stage("request"):
+                yield handle_factcheck_request(event)
+        except Exception as exc:
+            log.error(f"Fact-checking failed: {exc}")
+        finally:
+            event_log.done(event.id)
+
+
+@gen.coroutine
+def job_dispatcher():
+    """Ingest role: hand scheduled requests over to the shared job queue."""
+    while True:
+        event = yield factcheck_scheduler.get()
+        if not job_queue.enqueue(event.id, event.to_dict()):
+            log.info(f"Request {event.id} is already queued")
+        event_log.done(event.id)
 
-    last_sent_message_time = datetime.datetime.now()
 
-    reply_event: Optional[Event] = None
+@gen.coroutine
+def job_worker():
+    """Worker role: claim queued requests and answer them."""
+    io_loop = IOLoop.current()
+    while True:
+        # Queue writes can wait on other processes' SQLite locks, so they
+        # run off the IO loop.
+        job: Optional[Job] = yield io_loop.run_in_executor(None, job_queue.claim)
+        if job is None:
+            yield gen.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        # Keep the lease while the fact-check runs longer than the timeout.
+        heartbeat = PeriodicCallback(
+            lambda: io_loop.run_in_executor(None, job_queue.extend, job), JOB_VISIBILITY_TIMEOUT * 1000 / 3
+        )
+        heartbeat.start()
+        try:
+            with metrics.stage("request"):
+                yield handle_factcheck_request(Event.from_dict(job.payload))
+            yield io_loop.run_in_executor(None, job_queue.ack, job)
+        except Exception as exc:
+            log.error(f"Fact-checking job {job.key} failed (attempt {job.attempts}): {exc}")
+            yield io_loop.run_in_executor(None, job_queue.fail, job, str(exc))
+        finally:
+            heartbeat.stop()
+
+
+@gen.coroutine
+def run_factcheck(claim_text: str, image_urls: List[str], context: Optional[str] = None):
+    if isinstance(factchecker, AsyncFactChecker):
+        result = yield factchecker.check_fact(
+            claim_text,
+            image_urls=image_urls,
+            context=context,
+        )
+    else:
+        result = yield IOLoop.current().run_in_executor(
+            factcheck_executor,
+            lambda: factchecker.check_fact(claim_text, image_urls=image_urls, context=context),
+        )
+    return result
+
+
+@gen.coroutine
+def get_factcheck_result(target_event_id: str, claim_text: str, images: List[PreparedImage]):
+    # Images are identified by the SHA-256 of their bytes, so the same file
+    # under another URL finds the earlier verdict.
+    image_urls = [image.key for image in images]
+    cached_result = result_cache.get(target_event_id, claim_text, image_urls)
+    if cached_result is not None:
+        log.info(f"Using cached fact-check for {target_event_id}")
+        return cached_result
+
+    context: Optional[str] = None
+    match = claim_index.query(claim_text, image_urls, threshold=NEAR_DUPLICATE_CONTEXT_THRESHOLD)
+    if match is not None:
+        similar_key, similarity = match
+        similar_result = result_cache.get_by_key(similar_key)
+        if similar_result is not None:
+            similar_text = result_cache.get_claim_text(similar_key)
+            if (
+                ENABLE_NEAR_DUPLICATE_REUSE
+                and similarity >= NEAR_DUPLICATE_REUSE_THRESHOLD
+                and similar_text is not None
+                and not meaning_changes(claim_text, similar_text)
+            ):
+                log.info(f"Reusing fact-check of a near-duplicate claim for {target_event_id} ({similarity:.2f})")
+                return similar_result
+            context = similar_result
+
+    # Requests for the same claim that arrive while it is being checked wait
+    # for that check instead of starting another one.
+    key = claim_cache_key(claim_text, image_urls)
+    if key in inflight_factchecks:
+        log.info(f"Waiting for in-flight fact-check of {target_event_id}")
+        result = yield inflight_factchecks[key]
+        return result
+
+    future: Future = Future()
+    inflight_factchecks[key] = future
+    try:
+        result = yield run_factcheck(claim_text, [image.agent_input for image in images], context)
+        result_cache.put(target_event_id, claim_text, image_urls, result)
+        claim_index.add(key, claim_text, image_urls)
+        future.set_result(result)
+        return result
+    except Exception as exc:
+        future.set_exception(exc)
+        future.exception()  # Mark as retrieved when nobody else is waiting.
+        raise
+    finally:
+        inflight_factchecks.pop(key, None)
+
+
+def reply_target_id(event: Event) -> Optional[str]:
+    """Id of the note a fact-check request replies to, if any."""
     etags = event.get_tag_list("e")
-   
+
     reply_to_ids = [etag[0] for etag in etags if len(etag) >= 3 and etag[2] == "reply"]
     if len(reply_to_ids) == 0:
         reply_to_ids = [etag[0] for etag in etags if len(etag) >= 3 and etag[2] == "root"]
 
-    is_reply = len(reply_to_ids) > 0
-    reply_to_id = reply_to_ids[0] if is_reply else None
-   
+    return reply_to_ids[0] if reply_to_ids else None
+
+
+@gen.coroutine
+def send_factcheck_reply(event: Event, target_event: Event, factcheck_result: str):
+    tagger_npub = pubkey_to_npub(event.pubkey or "")
+    reply_event = Event(f"{factcheck_result}\n\n\nnostr:{tagger_npub}")
+    reply_event.tags.append(["e", str(target_event.id), "", "reply"])
+    reply_event.tags.append(["p", str(event.pubkey), "mention"])
+    reply_event.tags.append(["p", str(target_event.pubkey), "mention"])
+
+    reply_event.sign(str(FACTCHECKER_PRIVATE_KEY))
+    log.info(f"Sending fact-check reply event: {reply_event.to_dict()}")
+    with metrics.stage("publish"):
+        accepted_by = yield reply_publisher.publish(reply_event)
+
+    if accepted_by:
+        log.info(f"Fact-check reply accepted by {', '.join(accepted_by)}")
+    else:
+        log.warning(f"Fact-check reply {reply_event.id} did not reach {REPLY_QUORUM} relays, queued for re-publishing")
+
+
+@gen.coroutine
+def reply_from_cache(event: Event, target_event_id: str, factcheck_result: str):
+    """Answer a request for an already checked note without queueing it."""
     try:
-        if is_reply:
-            target_event_id = reply_to_id
+        with metrics.stage("request"):
             target_event = yield fetch_event_by_id(target_event_id)
-          #  print(target_event)
-            if not target_event:
-                return
-
-            claim_text = target_event.content or ""
-            image_urls = extract_image_urls(claim_text)
-            for image_url in image_urls:
-                claim_text = claim_text.replace(image_url, "")
-
-            factcheck_result = factchecker.check_fact(
-                claim_text,
-                image_urls=image_urls
-            )
+            if target_event:
+                yield send_factcheck_reply(event, target_event, factcheck_result)
+    except Exception as exc:
+        log.error(f"Replying from cache failed: {exc}")
+    finally:
+        event_log.done(event.id)
 
-            tagger_npub = pubkey_to_npub(event.pubkey or "")
-            reply_event = Event(f"{factcheck_result}\n\n\nnostr:{tagger_npub}")
-            reply_event.tags.append(["e", str(target_event_id), "", "reply"])
-            reply_event.tags.append(["p", str(event.pubkey), "mention"])
-            reply_event.tags.append(["p", str(target_event.pubkey), "mention"])
 
-            reply_event.sign(str(FACTCHECKER_PRIVATE_KEY))
-            log.info(f"Sending fact-check reply event: {reply_event.to_dict()}")
-            relay_manager.publish_event(reply_event)
-            
-            log.info("Fact-check reply sent")
-        else:
-            log.info("No reply_to event found, skipping fact-checking.")
+@gen.coroutine
+def handle_factcheck_request(event: Event):
+    target_event_id = reply_target_id(event)
+
+    if target_event_id is not None:
+        target_event = yield fetch_event_by_id(target_event_id)
+      #  print(target_event)
+        if not target_event:
+            # Usually a passing relay problem; the job queue retries it later.
+            raise LookupError(f"Could not fetch target event {target_event_id}")
+
+        claim_text = target_event.content or ""
+        image_urls = extract_image_urls(claim_text)
+        for image_url in image_urls:
+            claim_text = claim_text.replace(image_url, "")
+
+        with metrics.stage("images"):
+            images = yield image_prefetcher.prepare(image_urls)
+        if len(images) < len(image_urls):
+            log.info(f"Using {len(images)} of {len(image_urls)} images of {target_event_id}")
+
+        with metrics.stage("factcheck"):
+            factcheck_result = yield get_factcheck_result(
+                target_event_id, claim_text, images
+            )
 
-    except Exception as exc:
-        log.error(f"Fact-checking failed: {exc}")
-        return
+        yield send_factcheck_reply(event, target_event, factcheck_result)
+        log.info(f"Tool cache stats: {tool_cache.stats}")
+        log.info(f"HTTP connection stats: {factchecker.http_session.stats.as_dict()}")
+        log.info(f"Context budget stats: {dict(factchecker.context_stats)}")
+        log.info(f"Image stats: {image_prefetcher.stats}")
+    else:
+        log.info("No reply_to event found, skipping fact-checking.")
 
 
 # ============================================================
 # STARTUP
 # ============================================================
 
-def start():
-    global relay_manager
+def log_relay_stats():
+    for url in sorted(set(relay_stats) | set(frame_prefilter.stats)):
+        stats = relay_stats[url]
+        frames = frame_prefilter.stats[url]
+        log.info(
+            f"{url}: frames={frames['events']} prefiltered_duplicates={frames['duplicates']} "
+            f"prefiltered_irrelevant={frames['irrelevant']} received={stats['received']} "
+            f"firehose={stats['firehose']} firehose_dropped={stats['firehose_dropped']} "
+            f"duplicates={stats['duplicates']} handled={stats['handled']}"
+        )
+    if isinstance(relay_manager, RelayPool):
+        for url, summary in relay_manager.summary().items():
+            log.info(f"{url}: {summary}")
+    for url, stats in sorted(reply_publisher.stats.items()):
+        log.info(f"{url}: publishes={dict(stats)}")
+    log.info(f"Event lookups: {dict(event_resolver.stats)}")
+    log.info(f"Fact-check queue: {factcheck_scheduler.metrics()}")
+    if event_log is not None:
+        log.info(f"Event log: {dict(event_log.stats)}")
+    if job_queue is not None:
+        log.info(f"Job queue: {job_queue.counts()}")
+
+
+def save_checkpoint():
+    event_log.save_checkpoint()
+    event_log.prune()
+    if job_queue is not None:
+        job_queue.prune()
+
+
+@gen.coroutine
+def republish_replies():
+    delivered = yield reply_publisher.republish_pending()
+    if delivered:
+        log.info(f"Re-published {delivered} queued fact-check replies")
+
 
-    log.info("Connecting to relays...")
+def setup_pipeline(manager, lookup_relays=None) -> None:
+    """Wire event lookups, frame prefiltering and publishing to a relay manager.
 
-    relay_list = RelayList()
-    relay_list.append_url_list(RELAYS)
-    relay_list.update_relay_information(timeout=1)
-    relay_list.drop_empty_metadata()
+    Lookups use `lookup_relays` when given, else every relay of `manager`.
+    """
+    global relay_manager, event_resolver, frame_prefilter, reply_publisher
+
+    relay_manager = manager
+    event_resolver = EventResolver(
+        lookup_relays or relay_manager,
+        timeout=FETCH_EVENT_TIMEOUT,
+        batch_window=FETCH_EVENT_BATCH_WINDOW,
+        store_size=EVENT_STORE_SIZE,
+    )
+
+    # Drop duplicate and irrelevant EVENT frames before pynostr parses and
+    # verifies them; skipped frames stay available to event lookups.
+    frame_prefilter = FramePrefilter(
+        pubkey=FACTCHECKER_PUBKEY,
+        mention_texts=["@factchecker", FACTCHECKER_NPUB],
+        is_duplicate=lambda event_id: event_id in event_dedup_cache or (
+            event_log is not None and event_id in event_log
+        ),
+        is_wanted=lambda event_id: event_id in event_resolver.waiters,
+        on_dropped=event_resolver.remember_raw,
+    )
+    reply_publisher = ReplyPublisher(
+        relay_manager,
+        quorum=REPLY_QUORUM,
+        ack_timeout=REPLY_ACK_TIMEOUT,
+        max_rounds=REPLY_PUBLISH_ROUNDS,
+        retry_queue=republish_queue,
+        max_age=REPUBLISH_MAX_AGE,
+    )
 
-    log.info(f"Connected to {len(relay_list.data)} relays")
 
-    relay_manager = RelayManager(error_threshold=3, timeout=0)
-    relay_manager.add_relay_list(
-        relay_list,
-        close_on_eose=False,
-        message_callback=on_message,
-        message_callback_url=True,
+def start():
+    for key, claim_text, image_urls in result_cache.iter_claims():
+        claim_index.add(key, claim_text, image_urls)
+    log.info(f"Loaded {len(claim_index)} claims into the near-duplicate index")
+
+    manager = RelayManager(timeout=0)
+    for url in RELAYS:
+        manager.add_relay(
+            url,
+            close_on_eose=False,
+            message_callback=on_message,
+            message_callback_url=True,
+        )
+    relay_pool = RelayPool(
+        manager,
+        lookup_fanout=RELAY_LOOKUP_FANOUT,
+        lookup_fallback=RELAY_LOOKUP_FALLBACK,
+        publish_fanout=RELAY_PUBLISH_FANOUT,
+        probe_timeout=RELAY_PROBE_TIMEOUT,
     )
+    setup_pipeline(relay_pool, lookup_relays=relay_pool.lookups)
+    for relay in relay_pool.relays.values():
+        frame_prefilter.install(relay)
+    relay_pool.install()
+
+    log.info("Probing relays...")
+    reachable = relay_pool.io_loop.run_sync(relay_pool.probe)
+    log.info(f"{sum(reachable.values())}/{len(reachable)} relays answered the probe")
+
+    PeriodicCallback(log_relay_stats, RELAY_STATS_INTERVAL * 1000).start()
+    PeriodicCallback(republish_replies, REPUBLISH_INTERVAL * 1000).start()
+
+    if METRICS_PORT:
+        metrics.enabled = True
+        metrics.gauge("queue_depth", lambda: factcheck_scheduler.depth)
+        metrics.gauge("inflight_factchecks", lambda: len(inflight_factchecks))
+        metrics_app().listen(METRICS_PORT, address=METRICS_HOST)
+        log.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") and not metrics.enable_otlp():
+        log.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but the OpenTelemetry SDK is not installed")
+
+    if FACTCHECK_ROLE == "worker":
+        # Workers only look up target events and publish replies.
+        for _ in range(FACTCHECK_WORKERS):
+            relay_manager.io_loop.spawn_callback(job_worker)
+        relay_pool.start()
+        relay_pool.io_loop.start()
+        return
+
+    since = int(datetime.datetime.now().timestamp())
+    catch_up_since = event_log.catch_up_since(CATCH_UP_MARGIN, CATCH_UP_MAX_AGE)
+    log.info(f"Catching up on mentions since {datetime.datetime.fromtimestamp(catch_up_since)}")
 
-    filters = FiltersList([
+    mention_filters = FiltersList([
         Filters(
-            since=int(datetime.datetime.now().timestamp()),
+            since=catch_up_since,
             kinds=[EventKind.TEXT_NOTE],
+            pubkey_refs=[FACTCHECKER_PUBKEY],
         )
     ])
+    relay_manager.add_subscription_on_all_relays(mention_subscription_id, mention_filters)
+
+    if ENABLE_MENTION_FIREHOSE:
+        firehose_filters = FiltersList([
+            Filters(
+                since=since,
+                kinds=[EventKind.TEXT_NOTE],
+            )
+        ])
+        for url in relay_pool.by_latency()[:FIREHOSE_RELAY_COUNT]:
+            relay_manager.add_subscription_on_relay(url, firehose_subscription_id, firehose_filters)
+
+    PeriodicCallback(save_checkpoint, CHECKPOINT_INTERVAL * 1000).start()
 
-    subscription_id = uuid.uuid4().hex
-    relay_manager.add_subscription_on_all_relays(subscription_id, filters)
+    if FACTCHECK_ROLE == "ingest":
+        relay_manager.io_loop.spawn_callback(job_dispatcher)
+    else:
+        for _ in range(FACTCHECK_WORKERS):
+            relay_manager.io_loop.spawn_callback(factcheck_worker)
 
-    relay_manager.run_sync()
+    relay_pool.start()
+    relay_pool.io_loop.start()
 
 
 if __name__ == "__main__":
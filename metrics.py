@@ -0,0 +1,158 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import tornado.web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (0, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_NOOP = nullcontext()
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters, latency histograms and optional OpenTelemetry spans.
+
+    Everything is a no-op until `enabled` is set or a tracer is configured
+    with `enable_otlp`, so instrumented code costs one attribute check when
+    metrics are off. `render` produces the Prometheus text format.
+    """
+
+    def __init__(self, enabled: bool = False, prefix: str = "factchecker"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.tracer = None
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self.lock:
+            series = self.counters[name]
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels) -> None:
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self.lock:
+            series = self.histograms[name]
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def gauge(self, name: str, read: Callable[[], float]) -> None:
+        """Register a value that is read each time the metrics are rendered."""
+        self.gauges[name] = read
+
+    @contextmanager
+    def _stage(self, name: str, labels: dict) -> Iterator[None]:
+        span = (
+            self.tracer.start_as_current_span(name, attributes=labels)
+            if self.tracer is not None
+            else _NOOP
+        )
+        start = time.perf_counter()
+        with span:
+            try:
+                yield
+            finally:
+                self.observe("stage_seconds", time.perf_counter() - start, stage=name, **labels)
+
+    def stage(self, name: str, **labels):
+        """Context manager timing one pipeline stage (and tracing it as a span)."""
+        if not self.enabled and self.tracer is None:
+            return _NOOP
+        return self._stage(name, labels)
+
+    def enable_otlp(self, endpoint: Optional[str] = None, service_name: str = "nostr-factchecker") -> bool:
+        """Export stage spans over OTLP/HTTP; returns False if the SDK is missing."""
+        try:
+            from opentelemetry import trace
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            return False
+
+        provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        trace.set_tracer_provider(provider)
+        self.tracer = trace.get_tracer(self.prefix)
+        return True
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{metric}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        for name, read in sorted(self.gauges.items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {read():g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, registry: Metrics):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.render())
+
+
+def metrics_app(registry: Metrics = metrics) -> tornado.web.Application:
+    return tornado.web.Application([(r"/metrics", MetricsHandler, {"registry": registry})])
@@ -0,0 +1,70 @@
+import re
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterable, Optional
+
+_EVENT_PREFIX = re.compile(r'\s*\[\s*"EVENT"')
+_EVENT_ID = re.compile(r'"id"\s*:\s*"([0-9a-f]{64})"')
+
+
+class FramePrefilter:
+    """Cheap string checks on raw relay frames before pynostr parses them.
+
+    pynostr json-decodes every frame and verifies every event signature before
+    calling our message callback. The prefilter runs first, on the raw text:
+    EVENT frames whose id was already handled, or that neither reference the
+    bot pubkey nor contain one of `mention_texts`, are dropped without being
+    parsed. Ids answering a pending lookup always pass.
+    """
+
+    def __init__(
+        self,
+        pubkey: str,
+        mention_texts: Iterable[str],
+        is_duplicate: Callable[[str], bool],
+        is_wanted: Callable[[str], bool],
+        on_dropped: Callable[[str, str], None] = lambda event_id, frame: None,
+    ):
+        self.pubkey = pubkey
+        self.mention_re = re.compile("|".join(re.escape(text) for text in mention_texts), re.IGNORECASE)
+        self.is_duplicate = is_duplicate
+        self.is_wanted = is_wanted
+        self.on_dropped = on_dropped
+        # Relay url -> counts of "events", "duplicates", "irrelevant", "candidates".
+        self.stats: Dict[str, Counter] = defaultdict(Counter)
+
+    def accept(self, frame: str, stats: Optional[Counter] = None) -> bool:
+        if not frame or not _EVENT_PREFIX.match(frame):
+            return True
+        if stats is None:
+            stats = Counter()
+        stats["events"] += 1
+
+        match = _EVENT_ID.search(frame)
+        if match is None:
+            # Unusual layout; let the full parser decide.
+            return True
+        event_id = match.group(1)
+
+        if self.is_wanted(event_id):
+            return True
+        if self.is_duplicate(event_id):
+            stats["duplicates"] += 1
+            return False
+        if self.pubkey in frame or self.mention_re.search(frame):
+            stats["candidates"] += 1
+            return True
+
+        stats["irrelevant"] += 1
+        self.on_dropped(event_id, frame)
+        return False
+
+    def install(self, relay) -> None:
+        """Run the prefilter in front of a pynostr relay's message handling."""
+        handle_message = relay._on_message
+        stats = self.stats[relay.url]
+
+        def _on_message(message):
+            if self.accept(message, stats):
+                handle_message(message)
+
+        relay._on_message = _on_message
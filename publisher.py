@@ -0,0 +1,132 @@
+import datetime
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set
+
+from tornado import gen
+from tornado.locks import Event as Signal
+
+from pynostr.event import Event
+
+from jobqueue import JobQueue
+from metrics import metrics
+
+
+class PendingPublish:
+    def __init__(self, quorum: int):
+        self.quorum = quorum
+        self.sent_at: Dict[str, float] = {}
+        self.accepted: Set[str] = set()
+        self.rejected: Set[str] = set()
+        self.settled = Signal()
+
+    def update(self) -> None:
+        answered = self.accepted | self.rejected
+        if len(self.accepted) >= self.quorum or answered >= set(self.sent_at):
+            self.settled.set()
+
+
+class ReplyPublisher:
+    """Publish events until a quorum of relays acknowledged them (NIP-20 OK).
+
+    `relays` is a RelayPool (or anything with `ranked`, `publish_event`,
+    `publish_timed_out` and an `on_ok` hook). Each round waits `ack_timeout`
+    seconds for OK messages; if fewer than `quorum` relays accepted the event,
+    it is sent to relays not tried yet. Events still short of the quorum after
+    `max_rounds` go to `retry_queue` and are re-published later by
+    `republish_pending`, unless they are older than `max_age` seconds by then.
+    """
+
+    def __init__(
+        self,
+        relays,
+        quorum: int = 2,
+        ack_timeout: float = 10.0,
+        max_rounds: int = 3,
+        retry_queue: Optional[JobQueue] = None,
+        max_age: Optional[float] = None,
+    ):
+        self.relays = relays
+        self.quorum = quorum
+        self.ack_timeout = ack_timeout
+        self.max_rounds = max_rounds
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+        self.pending: Dict[str, PendingPublish] = {}
+        # Relay url -> "sent", "accepted", "rejected" and "timeouts" counts.
+        self.stats: Dict[str, Counter] = defaultdict(Counter)
+        relays.on_ok = self.on_ok
+
+    def on_ok(self, url: str, event_id: str, accepted: bool, message: str = "") -> None:
+        pending = self.pending.get(event_id)
+        if pending is None or url not in pending.sent_at:
+            return
+        latency = time.monotonic() - pending.sent_at[url]
+        outcome = "accepted" if accepted else "rejected"
+        (pending.accepted if accepted else pending.rejected).add(url)
+        self.stats[url][outcome] += 1
+        metrics.inc("relay_publish_total", relay=url, outcome=outcome)
+        metrics.observe("relay_publish_seconds", latency, relay=url)
+        pending.update()
+
+    def _next_relays(self, pending: PendingPublish, count: int) -> List[str]:
+        return [url for url in self.relays.ranked() if url not in pending.sent_at][:count]
+
+    @gen.coroutine
+    def publish(self, event: Event, queue_on_failure: bool = True):
+        """Publish `event`; returns the relays that accepted it if it reached the quorum."""
+        pending = self.pending[event.id] = PendingPublish(self.quorum)
+        try:
+            urls: List[str] = []
+            for round_number in range(self.max_rounds):
+                if round_number == 0:
+                    urls = self.relays.publish_event(event)
+                else:
+                    urls = self._next_relays(pending, max(len(urls), self.quorum))
+                    if not urls:
+                        break
+                    self.relays.publish_event(event, urls)
+                now = time.monotonic()
+                for url in urls:
+                    pending.sent_at[url] = now
+                    self.stats[url]["sent"] += 1
+                pending.settled.clear()
+                pending.update()
+
+                try:
+                    yield pending.settled.wait(timeout=datetime.timedelta(seconds=self.ack_timeout))
+                except gen.TimeoutError:
+                    pass
+                for url in urls:
+                    if url not in pending.accepted and url not in pending.rejected:
+                        self.stats[url]["timeouts"] += 1
+                        metrics.inc("relay_publish_total", relay=url, outcome="timeout")
+                        self.relays.publish_timed_out(url, event.id)
+                if len(pending.accepted) >= self.quorum:
+                    return sorted(pending.accepted)
+
+            if queue_on_failure and self.retry_queue is not None:
+                self.retry_queue.enqueue(event.id, event.to_dict())
+            return None
+        finally:
+            self.pending.pop(event.id, None)
+
+    @gen.coroutine
+    def republish_pending(self):
+        """Retry queued events; returns how many reached the quorum this time."""
+        delivered = 0
+        while True:
+            job = self.retry_queue.claim()
+            if job is None:
+                return delivered
+            event = Event.from_dict(job.payload)
+            if self.max_age is not None and time.time() - event.created_at > self.max_age:
+                # A reply showing up hours after the request does more harm than good.
+                self.retry_queue.give_up(job, "too old")
+                continue
+            accepted = yield self.publish(event, queue_on_failure=False)
+            if accepted:
+                self.retry_queue.ack(job)
+                delivered += 1
+            else:
+                self.retry_queue.fail(job, "quorum not reached")
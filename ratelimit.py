@@ -0,0 +1,166 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+
+# HTTP statuses Mistral uses when a request is over quota or the model is
+# overloaded ("capacity exceeded").
+RATE_LIMIT_STATUS_CODES = {429, 503}
+
+
+# Tokens counted for each image chunk. The length of an inlined data URI says
+# nothing about what the model spends on the picture, which the image
+# prefetcher has already downscaled.
+IMAGE_TOKENS = 1500
+
+
+def _without_images(value, images: list):
+    """Copy of `value` with image chunks left out; each one is appended to `images`."""
+    if isinstance(value, dict):
+        return {key: _without_images(item, images) for key, item in value.items()}
+    if isinstance(value, list):
+        kept = []
+        for item in value:
+            if isinstance(item, dict) and item.get("type") == "image_url":
+                images.append(item)
+            else:
+                kept.append(_without_images(item, images))
+        return kept
+    return value
+
+
+def estimate_tokens(messages: list) -> int:
+    """Rough token count of a conversation.
+
+    Text counts about 4 characters per token, and each image IMAGE_TOKENS.
+    """
+    images: list = []
+    text = json.dumps(_without_images(messages, images), default=str)
+    return max(1, len(text) // 4 + len(images) * IMAGE_TOKENS)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) in RATE_LIMIT_STATUS_CODES
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Return the delay requested by a `Retry-After` header, if any."""
+    headers = getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Reservation-based token bucket.
+
+    `reserve` always takes the tokens and returns how long the caller must wait
+    before using them, so concurrent callers are served in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def try_take(self, amount: float, now: float) -> bool:
+        """Take tokens only if they are available right now."""
+        self._refill(now)
+        if self.level < amount:
+            return False
+        self.level -= amount
+        return True
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ApiRateLimiter:
+    """Process-wide scheduler for Mistral requests.
+
+    Requests and tokens are metered by two token buckets derived from the
+    configured RPM/TPM quota. A rate-limit response blocks every caller until
+    the `Retry-After` delay (or a jittered exponential backoff) has passed.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 60,
+        tokens_per_minute: Optional[float] = None,
+        burst: int = 1,
+        backoff_base: float = 5.0,
+        backoff_max: float = 60.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute / 60.0, max(1, burst))
+        self.tokens = (
+            TokenBucket(tokens_per_minute / 60.0, tokens_per_minute)
+            if tokens_per_minute
+            else None
+        )
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserve quota for one request and return the seconds to wait first."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.requests.reserve(1, now)
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return max(delay, self.blocked_until - now, 0.0)
+
+    def acquire(self, tokens: int = 0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens: int = 0) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Correct the token bucket once the real usage of a request is known."""
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self.lock:
+            self.tokens.refund(estimated_tokens - actual_tokens, time.monotonic())
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Block all callers after a rate-limit response and return the delay."""
+        if retry_after is None:
+            retry_after = min(self.backoff_max, self.backoff_base * (3 ** attempt))
+            retry_after *= random.uniform(0.5, 1.5)
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        return retry_after
@@ -0,0 +1,394 @@
+import json
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from cachetools import LRUCache
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.websocket import WebSocketClosedError, websocket_connect
+
+from pynostr.event import Event
+from pynostr.filters import FiltersList
+from pynostr.relay_manager import RelayException
+
+_EVENT_ID = re.compile(r'"id"\s*:\s*"([0-9a-f]{64})"')
+
+
+@gen.coroutine
+def probe_relay(url: str, timeout: float):
+    """Open a websocket and time the handshake and a one-event REQ until EOSE.
+
+    Returns (connect seconds, EOSE seconds), or None if the relay failed.
+    """
+    io_loop = IOLoop.current()
+    deadline = io_loop.time() + timeout
+    started = time.monotonic()
+    try:
+        ws = yield gen.with_timeout(deadline, websocket_connect(url))
+    except Exception:
+        return None
+    connected = time.monotonic()
+    try:
+        ws.write_message(json.dumps(["REQ", "probe", {"limit": 1}]))
+        while True:
+            message = yield gen.with_timeout(deadline, ws.read_message())
+            if message is None:
+                return None
+            if message.startswith('["EOSE"'):
+                return connected - started, time.monotonic() - connected
+    except Exception:
+        return None
+    finally:
+        ws.close()
+
+
+@dataclass
+class RelayScore:
+    latency: float = 1.0
+    error_rate: float = 0.0
+    events: int = 0
+    first_seen: int = 0
+    sessions: int = 0
+    failures: int = 0
+    next_retry: float = 0.0
+
+    def sample_latency(self, seconds: float, alpha: float = 0.2) -> None:
+        self.latency = (1 - alpha) * self.latency + alpha * seconds
+
+    def sample_outcome(self, error: bool, alpha: float = 0.1) -> None:
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (1.0 if error else 0.0)
+
+
+class RelayPool:
+    """Scores the relays of a pynostr RelayManager and routes traffic by score.
+
+    Relays are probed concurrently at startup. Each relay's score then follows
+    live round-trip times (handshakes, EOSE after a REQ, OK after a publish),
+    its error rate and the share of events it delivered first. Lower is
+    better. Event lookups (through `lookups`) go to the `lookup_fanout` best
+    relays first, and to all other relays once those sent EOSE without the
+    lookup being closed, or after `lookup_fallback` seconds. Publishes go to
+    the `publish_fanout` best relays; other subscriptions
+    still go to every relay. Disconnected relays are reconnected with jittered
+    exponential backoff instead of pynostr's fixed one-second retry.
+
+    The pool offers the subscription and publish methods of RelayManager, so
+    it can be used in its place.
+    """
+
+    def __init__(
+        self,
+        relay_manager,
+        lookup_fanout: int = 4,
+        lookup_fallback: float = 2.0,
+        publish_fanout: int = 6,
+        probe_timeout: float = 3.0,
+        connect_timeout: float = 10.0,
+        reconnect_base: float = 2.0,
+        reconnect_max: float = 300.0,
+        stable_after: float = 60.0,
+        check_interval: float = 5.0,
+    ):
+        self.relay_manager = relay_manager
+        self.lookup_fanout = lookup_fanout
+        self.lookup_fallback = lookup_fallback
+        self.publish_fanout = publish_fanout
+        self.probe_timeout = probe_timeout
+        self.connect_timeout = connect_timeout
+        self.reconnect_base = reconnect_base
+        self.reconnect_max = reconnect_max
+        self.stable_after = stable_after
+        self.check_interval = check_interval
+        self.scores: Dict[str, RelayScore] = {url: RelayScore() for url in relay_manager.relays}
+        self.sessions: Dict[str, Future] = {}
+        # Requests waiting for an answer: (url, subscription id) -> sent at,
+        # and (url, event id) -> published at.
+        self.pending_eose: Dict[Tuple[str, str], float] = {}
+        self.pending_ok: Dict[Tuple[str, str], float] = {}
+        self.subscription_relays: Dict[str, Set[str]] = {}
+        # Lookups sent to the fastest relays only, until they are widened.
+        self.lookup_filters: Dict[str, FiltersList] = {}
+        self.first_seen_by: LRUCache = LRUCache(maxsize=50000)
+        # Called with (url, event id, accepted, message) for each OK message.
+        self.on_ok: Optional[Callable[[str, str, bool, str], None]] = None
+
+        for relay in relay_manager.relays.values():
+            # The pool schedules reconnections itself.
+            relay.error_threshold = 0
+            relay.timeout_error_threshold = 0
+            relay.timeout = connect_timeout
+
+    @property
+    def relays(self):
+        return self.relay_manager.relays
+
+    @property
+    def io_loop(self) -> IOLoop:
+        return self.relay_manager.io_loop
+
+    # ------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------
+
+    def install(self) -> None:
+        """Watch the raw frames of every relay.
+
+        Call it after installing other frame hooks such as the prefilter, so
+        the pool also sees the frames they drop.
+        """
+        for url, relay in self.relays.items():
+            handle_message = relay._on_message
+
+            def _on_message(message, url=url, handle_message=handle_message):
+                self.observe(url, message)
+                handle_message(message)
+
+            relay._on_message = _on_message
+
+    def observe(self, url: str, message: str) -> None:
+        """Account a raw frame received from `url`."""
+        score = self.scores[url]
+        if message.startswith('["EVENT"'):
+            score.events += 1
+            match = _EVENT_ID.search(message)
+            if match is not None and match.group(1) not in self.first_seen_by:
+                self.first_seen_by[match.group(1)] = url
+                score.first_seen += 1
+        elif message.startswith(('["EOSE"', '["OK"')):
+            try:
+                message_json = json.loads(message)
+                kind, id = message_json[0], message_json[1]
+                accepted = kind == "EOSE" or message_json[2] is True
+                reason = str(message_json[3]) if len(message_json) > 3 else ""
+            except (ValueError, IndexError, TypeError):
+                return
+            pending = self.pending_eose if kind == "EOSE" else self.pending_ok
+            sent_at = pending.pop((url, id), None)
+            if sent_at is not None:
+                score.sample_latency(time.monotonic() - sent_at)
+                score.sample_outcome(error=not accepted)
+            if kind == "OK" and self.on_ok is not None:
+                self.on_ok(url, id, accepted, reason)
+            elif kind == "EOSE" and id in self.lookup_filters and not any(
+                (other, id) in self.pending_eose for other in self.subscription_relays.get(id, ())
+            ):
+                # The fast relays are done and the lookup is still open.
+                self._widen_lookup(id)
+
+    def score(self, url: str) -> float:
+        if not self.relays[url].is_connected:
+            return float("inf")
+        stats = self.scores[url]
+        total_first_seen = sum(score.first_seen for score in self.scores.values())
+        first_share = stats.first_seen / total_first_seen if total_first_seen else 0.0
+        return stats.latency * (1 + 4 * stats.error_rate) / (1 + first_share)
+
+    def ranked(self) -> List[str]:
+        """Connected relays, best first."""
+        connected = [url for url, relay in self.relays.items() if relay.is_connected]
+        return sorted(connected, key=self.score)
+
+    def by_latency(self) -> List[str]:
+        """All relays, lowest measured latency first (usable before connecting)."""
+        return sorted(self.relays, key=lambda url: self.scores[url].latency)
+
+    def best(self, count: int) -> List[str]:
+        # With nothing connected yet, queue on every relay.
+        return self.ranked()[:count] or list(self.relays)
+
+    def summary(self) -> Dict[str, dict]:
+        return {
+            url: {
+                "connected": self.relays[url].is_connected,
+                "score": round(self.score(url), 3),
+                "latency": round(stats.latency, 3),
+                "error_rate": round(stats.error_rate, 3),
+                "events": stats.events,
+                "first_seen": stats.first_seen,
+                "sessions": stats.sessions,
+            }
+            for url, stats in self.scores.items()
+        }
+
+    # ------------------------------------------------------------
+    # RelayManager interface
+    # ------------------------------------------------------------
+
+    def _flush(self, url: str) -> None:
+        """Write the messages queued for `url` if it is connected.
+
+        pynostr's connection loop only sends one queued message after each
+        frame it receives, so a quiet relay would never get them.
+        """
+        relay = self.relays[url]
+        while relay.is_connected and not relay.outgoing_messages.empty():
+            message = relay.outgoing_messages.get_nowait()
+            try:
+                relay.ws.write_message(message)
+            except WebSocketClosedError:
+                # Sent again once the relay is reconnected.
+                relay.outgoing_messages.put(message)
+                return
+            relay.num_sent_events += 1
+
+    def _send(self, url: str, message: str) -> None:
+        self.relays[url].publish(message)
+        self._flush(url)
+
+    def _subscribe(self, urls: List[str], id: str, filters: FiltersList) -> None:
+        now = time.monotonic()
+        for url in urls:
+            # Queues the REQ and registers the subscription for reconnects.
+            self.relays[url].add_subscription(id, filters)
+            self._flush(url)
+            self.pending_eose[(url, id)] = now
+        self.subscription_relays.setdefault(id, set()).update(urls)
+
+    def add_subscription_on_all_relays(self, id: str, filters: FiltersList) -> None:
+        self._subscribe([url for url, relay in self.relays.items() if relay.policy.should_read], id, filters)
+
+    def add_subscription_on_relay(self, url: str, id: str, filters: FiltersList) -> None:
+        self._subscribe([url], id, filters)
+
+    def add_subscription_on_fastest_relays(self, id: str, filters: FiltersList) -> None:
+        urls = self.best(self.lookup_fanout)
+        self._subscribe(urls, id, filters)
+        if len(urls) < len(self.relays):
+            self.lookup_filters[id] = filters
+            self.io_loop.call_later(self.lookup_fallback, self._widen_lookup, id)
+
+    def _widen_lookup(self, id: str) -> None:
+        """Send a lookup the fastest relays could not answer to every other relay."""
+        filters = self.lookup_filters.pop(id, None)
+        if filters is None or id not in self.subscription_relays:
+            return
+        asked = self.subscription_relays[id]
+        self._subscribe(
+            [url for url, relay in self.relays.items() if url not in asked and relay.policy.should_read],
+            id,
+            filters,
+        )
+
+    def close_subscription_on_all_relays(self, id: str) -> None:
+        self.lookup_filters.pop(id, None)
+        for url in self.subscription_relays.pop(id, set()):
+            relay = self.relays[url]
+            relay.close_subscription(id)
+            self._send(url, json.dumps(["CLOSE", id]))
+            self.pending_eose.pop((url, id), None)
+
+    def publish_event(self, event: Event, urls: Optional[List[str]] = None) -> List[str]:
+        """Publish to `urls`, by default the best `publish_fanout` relays."""
+        if event.sig is None or not event.verify():
+            raise RelayException(f"Could not publish {event.id}: must be validly signed")
+        urls = urls or self.best(self.publish_fanout)
+        message = event.to_message()
+        now = time.monotonic()
+        for url in urls:
+            self._send(url, message)
+            self.pending_ok[(url, event.id)] = now
+        return urls
+
+    def publish_timed_out(self, url: str, event_id: str) -> None:
+        """Count a publish that `url` never acknowledged as an error."""
+        if self.pending_ok.pop((url, event_id), None) is not None:
+            self.scores[url].sample_outcome(error=True)
+
+    @property
+    def lookups(self) -> "FastestRelays":
+        return FastestRelays(self)
+
+    # ------------------------------------------------------------
+    # Connections
+    # ------------------------------------------------------------
+
+    def _backoff(self, failures: int) -> float:
+        delay = min(self.reconnect_max, self.reconnect_base * (2 ** max(0, failures - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _connect(self, url: str) -> None:
+        relay = self.relays[url]
+        score = self.scores[url]
+        if score.sessions:
+            # A new connection has to repeat the open subscriptions.
+            now = time.monotonic()
+            for id, subscription in relay.subscriptions.items():
+                relay.publish(subscription.to_message())
+                self.pending_eose[(url, id)] = now
+        score.sessions += 1
+        started = time.monotonic()
+        previous_ws = relay.ws
+        session = relay.connect()
+        self.sessions[url] = session
+        session.add_done_callback(lambda future: self._session_ended(url, started))
+        self.io_loop.add_callback(self._flush_when_connected, url, session, previous_ws)
+
+    @gen.coroutine
+    def _flush_when_connected(self, url: str, session: Future, previous_ws, poll: float = 0.05):
+        """Send what was queued while `url` was down once `session` is connected."""
+        relay = self.relays[url]
+        while not session.done():
+            if relay.ws is not previous_ws and relay.is_connected:
+                self._flush(url)
+                return
+            yield gen.sleep(poll)
+
+    def _session_ended(self, url: str, started: float) -> None:
+        self.sessions.pop(url, None)
+        score = self.scores[url]
+        if time.monotonic() - started >= self.stable_after:
+            score.failures = 0
+        score.failures += 1
+        score.sample_outcome(error=True)
+        score.next_retry = time.monotonic() + self._backoff(score.failures)
+
+    def check_connections(self) -> None:
+        now = time.monotonic()
+        for url in self.relays:
+            if url not in self.sessions and now >= self.scores[url].next_retry:
+                self._connect(url)
+
+    @gen.coroutine
+    def probe(self):
+        """Probe every relay concurrently; returns url -> whether it answered.
+
+        Relays that did not answer are not dropped: they start in backoff.
+        """
+        results = yield gen.multi({url: probe_relay(url, self.probe_timeout) for url in self.relays})
+        now = time.monotonic()
+        for url, result in results.items():
+            score = self.scores[url]
+            if result is None:
+                score.failures += 1
+                score.sample_outcome(error=True)
+                score.next_retry = now + self._backoff(score.failures)
+            else:
+                connect_time, eose_time = result
+                score.latency = connect_time + eose_time
+        return {url: result is not None for url, result in results.items()}
+
+    def start(self) -> None:
+        """Connect the relays and keep reconnecting them.
+
+        Messages for a relay that is not connected yet are queued and
+        written as soon as its connection is open.
+        """
+        self.check_connections()
+        PeriodicCallback(self.check_connections, self.check_interval * 1000).start()
+
+
+class FastestRelays:
+    """RelayManager-like view of a RelayPool sending subscriptions to its fastest relays."""
+
+    def __init__(self, pool: RelayPool):
+        self.pool = pool
+
+    def add_subscription_on_all_relays(self, id: str, filters: FiltersList) -> None:
+        self.pool.add_subscription_on_fastest_relays(id, filters)
+
+    def close_subscription_on_all_relays(self, id: str) -> None:
+        self.pool.close_subscription_on_all_relays(id)
@@ -0,0 +1,109 @@
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, Tuple
+
+from cachetools import LRUCache
+from tornado import gen
+from tornado.locks import Condition
+
+from metrics import metrics
+
+
+class RequestScheduler:
+    """Fair queue of fact-check requests, released at a global rate.
+
+    Each requester pubkey has its own FIFO of at most `max_per_pubkey`
+    pending requests, and requesters are served round-robin so one spammer
+    only gets its turn like everybody else. Requesters seen for the first time
+    or for which `is_priority` returns True are served before everyone else.
+    Requests beyond `max_depth` or a requester's quota are shed immediately.
+    `get` hands out at most one request per `min_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        min_interval: float,
+        max_depth: int = 100,
+        max_per_pubkey: int = 3,
+        is_priority: Callable[[str], bool] = lambda pubkey: False,
+        remembered_pubkeys: int = 100000,
+    ):
+        self.min_interval = min_interval
+        self.max_depth = max_depth
+        self.max_per_pubkey = max_per_pubkey
+        self.is_priority = is_priority
+        self.queues: Dict[str, Deque[Tuple[float, Any]]] = {}
+        # Round-robin rings of pubkeys with pending requests, per priority.
+        self.rings: Dict[bool, Deque[str]] = {True: deque(), False: deque()}
+        self.depth = 0
+        self.seen_pubkeys: LRUCache = LRUCache(maxsize=remembered_pubkeys)
+        self.available = Condition()
+        self.next_slot = 0.0
+        self.stats: Counter = Counter()
+        self.wait_times: Deque[float] = deque(maxlen=1000)
+
+    def submit(self, pubkey: str, item: Any) -> bool:
+        """Queue a request; returns False when it was shed."""
+        if self.depth >= self.max_depth:
+            self.stats["shed_queue_full"] += 1
+            return False
+        queue = self.queues.get(pubkey)
+        if queue is not None and len(queue) >= self.max_per_pubkey:
+            self.stats["shed_pubkey_quota"] += 1
+            return False
+
+        if queue is None:
+            priority = pubkey not in self.seen_pubkeys or self.is_priority(pubkey)
+            queue = self.queues[pubkey] = deque()
+            self.rings[priority].append(pubkey)
+        self.seen_pubkeys[pubkey] = True
+        queue.append((time.monotonic(), item))
+        self.depth += 1
+        self.stats["accepted"] += 1
+        self.available.notify()
+        return True
+
+    def _pop(self) -> Tuple[float, Any]:
+        ring = self.rings[True] or self.rings[False]
+        pubkey = ring.popleft()
+        queue = self.queues[pubkey]
+        entry = queue.popleft()
+        if queue:
+            ring.append(pubkey)
+        else:
+            del self.queues[pubkey]
+        self.depth -= 1
+        return entry
+
+    @gen.coroutine
+    def get(self):
+        """Wait for the next request that may be processed."""
+        while True:
+            if self.depth == 0:
+                yield self.available.wait()
+                continue
+            now = time.monotonic()
+            if now < self.next_slot:
+                yield gen.sleep(self.next_slot - now)
+                continue
+            enqueued_at, item = self._pop()
+            self.next_slot = now + self.min_interval
+            self.wait_times.append(now - enqueued_at)
+            metrics.observe("stage_seconds", now - enqueued_at, stage="queue")
+            self.stats["dispatched"] += 1
+            return item
+
+    def metrics(self) -> dict:
+        waits = sorted(self.wait_times)
+
+        def percentile(fraction: float) -> float:
+            return waits[min(len(waits) - 1, int(fraction * len(waits)))] if waits else 0.0
+
+        return {
+            "depth": self.depth,
+            "requesters": len(self.queues),
+            "wait_p50": round(percentile(0.5), 3),
+            "wait_p95": round(percentile(0.95), 3),
+            "wait_max": round(waits[-1], 3) if waits else 0.0,
+            **self.stats,
+        }
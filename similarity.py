@@ -0,0 +1,144 @@
+import random
+import re
+import zlib
+from array import array
+from typing import Dict, List, Optional, Tuple, Union
+
+from cache import normalize_claim
+
+_WORD_RE = re.compile(r"\w+")
+_TOKEN_RE = re.compile(r"\w+(?:'\w+)?")
+_NEGATIONS = {
+    "no", "not", "never", "none", "nobody", "nothing", "nowhere", "neither", "nor",
+    "without", "cannot", "false", "fake", "untrue", "myth", "hoax",
+}
+
+
+def claim_shingles(
+    claim_text: str, image_urls: Optional[List[str]] = None, size: int = 3
+) -> set:
+    """Return the hashed word `size`-grams of a claim plus one shingle per image."""
+    words = _WORD_RE.findall(normalize_claim(claim_text))
+    shingles = {
+        zlib.crc32(" ".join(words[i:i + size]).encode("utf-8"))
+        for i in range(max(0, len(words) - size + 1))
+    }
+    shingles.update(zlib.crc32(b"img:" + url.encode("utf-8")) for url in image_urls or [])
+    return shingles
+
+
+def meaning_changes(claim_text: str, other_text: str) -> bool:
+    """True if the words only one of two claims has include a negation or a number.
+
+    Shingle similarity cannot tell a claim from its negation, or from the
+    same claim about another figure.
+    """
+    def tokens(text: str) -> set:
+        return set(_TOKEN_RE.findall(normalize_claim(text).replace("\u2019", "'")))
+
+    return any(
+        word in _NEGATIONS or word.endswith("n't") or any(char.isdigit() for char in word)
+        for word in tokens(claim_text) ^ tokens(other_text)
+    )
+
+
+class ClaimIndex:
+    """In-memory MinHash/LSH index of previously fact-checked claims.
+
+    Signatures use one-permutation hashing: every CRC32 shingle hash is
+    scrambled once and kept as the minimum of one of `num_perm` bins, and
+    empty bins borrow from the next filled one. That is a single pass over the
+    shingles instead of one pass per permutation. Signatures are split into
+    `bands` LSH buckets, so a lookup only compares against claims sharing a
+    bucket. Everything runs locally; the index is rebuilt from the result
+    cache at startup.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, min_shingles: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.salt = random.Random(seed).getrandbits(32)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.min_shingles = min_shingles
+        self.signatures: Dict[str, array] = {}
+        # Band hash -> claim key, or a list of keys once a bucket is shared.
+        self.buckets: Dict[int, Union[str, List[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def signature(self, claim_text: str, image_urls: Optional[List[str]] = None) -> Optional[array]:
+        shingles = claim_shingles(claim_text, image_urls)
+        if len(shingles) < self.min_shingles:
+            return None
+
+        num_perm = self.num_perm
+        salt = self.salt
+        empty = 0xFFFFFFFF
+        bins = [empty] * num_perm
+        for shingle in shingles:
+            value = ((shingle ^ salt) * 0x9E3779B1) & 0xFFFFFFFF
+            index = value % num_perm
+            if value < bins[index]:
+                bins[index] = value
+
+        # Densify: walk the ring backwards so each empty bin copies the
+        # closest filled bin after it.
+        last = empty
+        for _ in range(2):
+            for index in range(num_perm - 1, -1, -1):
+                if bins[index] == empty:
+                    bins[index] = last
+                else:
+                    last = bins[index]
+        return array("I", bins)
+
+    def _band_keys(self, signature: array) -> List[int]:
+        rows = self.rows
+        return [
+            hash((band,) + tuple(signature[band * rows:(band + 1) * rows]))
+            for band in range(self.bands)
+        ]
+
+    def add(self, key: str, claim_text: str, image_urls: Optional[List[str]] = None) -> None:
+        signature = self.signature(claim_text, image_urls)
+        if signature is None or key in self.signatures:
+            return
+        self.signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is None:
+                self.buckets[band_key] = key
+            elif isinstance(bucket, list):
+                bucket.append(key)
+            else:
+                self.buckets[band_key] = [bucket, key]
+
+    def query(
+        self, claim_text: str, image_urls: Optional[List[str]] = None, threshold: float = 0.5
+    ) -> Optional[Tuple[str, float]]:
+        """Return the most similar stored claim key and its estimated Jaccard similarity."""
+        signature = self.signature(claim_text, image_urls)
+        if signature is None:
+            return None
+
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is None:
+                continue
+            if isinstance(bucket, list):
+                candidates.update(bucket)
+            else:
+                candidates.add(bucket)
+
+        best: Optional[Tuple[str, float]] = None
+        num_perm = len(signature)
+        for key in candidates:
+            other = self.signatures[key]
+            similarity = sum(a == b for a, b in zip(signature, other)) / num_perm
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
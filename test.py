@@ -1,6 +1,62 @@
+import asyncio
 import json
+import struct
 import unittest
-from factchecker import FactChecker
+import zlib
+import tempfile
+from collections import Counter
+from unittest import mock
+from queue import Queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+from mistralai import CompletionChunk, FunctionCall, ToolCall
+from mistralai.models import SDKError
+from factchecker import (
+    AsyncFactChecker,
+    FactChecker,
+    StreamedResponse,
+    extract_paragraph_text,
+    extract_paragraph_text_streaming,
+)
+from http_pool import AsyncPooledSession, PooledSession
+from cache import ResultCache, ToolCache, canonicalize_url, claim_cache_key
+from similarity import ClaimIndex, meaning_changes
+from event_resolver import EventResolver
+from prefilter import FramePrefilter
+from scheduler import RequestScheduler
+from checkpoint import BloomFilter, EventLog
+from jobqueue import JobQueue
+from metrics import Metrics, metrics_app
+from budget import ConversationBudget
+from images import PIL_AVAILABLE, ImagePrefetcher, sniff_image_type
+from loadtest import FakeServices, LoadTestAsyncFactChecker, LoadTestFactChecker
+from batch import claim_fields, run_batch
+from relay_pool import RelayPool, probe_relay
+from publisher import ReplyPublisher
+from pynostr.base_relay import RelayPolicy
+from pynostr.filters import Filters, FiltersList
+from pynostr.key import PrivateKey
+from pynostr.relay_manager import RelayManager
+from pynostr.subscription import Subscription
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+import tornado.web
+from tornado.web import Application
+from tornado.websocket import WebSocketHandler
+from tornado.testing import AsyncHTTPTestCase
+from pynostr.event import Event
+from tornado import gen
+from tornado.ioloop import IOLoop
+from ratelimit import (
+    IMAGE_TOKENS,
+    ApiRateLimiter,
+    TokenBucket,
+    estimate_tokens,
+    is_rate_limit_error,
+    retry_after_seconds,
+)
 import os
 import logging
 import sys
@@ -72,9 +128,1327 @@ Astrology is a science that uses the positions of stars and planets to predict h
             print("Fact check result:", result)
         except Exception as e:
             self.fail(f"FactChecker.check_fact raised an exception: {e}")
-            
-            
-            
+
+
+
+class SleepyFactChecker(FactChecker):
+    def perform_web_search(self, query: str, num_results: int = 7) -> str:
+        time.sleep(float(query))
+        return json.dumps([{"query": query}])
+
+
+class TestHandleToolCalls(unittest.TestCase):
+    def test_tool_calls_run_concurrently_in_order(self):
+        factchecker = SleepyFactChecker(agent_id="ag_test", api_key="test", tool_turn_timeout=1.0)
+        tool_calls = [
+            ToolCall(id=str(i), function=FunctionCall(name="web_search", arguments=json.dumps({"query": delay})))
+            for i, delay in enumerate(["0.3", "0.1", "3", "0.2"])
+        ]
+        started = time.monotonic()
+        messages = factchecker.handle_tool_calls(tool_calls, [])
+        elapsed = time.monotonic() - started
+
+        self.assertLess(elapsed, 2.0)
+        self.assertEqual([m["tool_call_id"] for m in messages], ["0", "1", "2", "3"])
+        self.assertEqual(json.loads(messages[1]["content"]), [{"query": "0.1"}])
+        self.assertIn("timed out", json.loads(messages[2]["content"])["error"])
+
+
+class TestAsyncFactChecker(unittest.TestCase):
+    def test_get_webpage_content(self):
+        def handler(request):
+            return httpx.Response(200, html="<html><body><p>The Earth</p><p>is round.</p></body></html>")
+
+        factchecker = AsyncFactChecker(agent_id="ag_test", api_key="test")
+        factchecker.http_session = AsyncPooledSession(transport=httpx.MockTransport(handler))
+        result = asyncio.run(factchecker.get_webpage_content("https://example.com/", max_length=12))
+        content_dict = json.loads(result)
+        self.assertEqual(content_dict["url"], "https://example.com/")
+        self.assertEqual(content_dict["content"], "The Earth is")
+
+    def test_get_webpage_content_skips_non_html(self):
+        def handler(request):
+            return httpx.Response(200, content=b"%PDF-1.7", headers={"Content-Type": "application/pdf"})
+
+        factchecker = AsyncFactChecker(agent_id="ag_test", api_key="test")
+        factchecker.http_session = AsyncPooledSession(transport=httpx.MockTransport(handler))
+        result = asyncio.run(factchecker.get_webpage_content("https://example.com/paper.pdf"))
+        self.assertIn("Unsupported content type", json.loads(result)["error"])
+
+    def test_get_webpage_content_uses_tool_cache(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, html="<html><body><p>The Earth is round.</p></body></html>")
+
+        factchecker = AsyncFactChecker(agent_id="ag_test", api_key="test", tool_cache=ToolCache(":memory:"))
+        factchecker.http_session = AsyncPooledSession(transport=httpx.MockTransport(handler))
+        self.assertIsNone(factchecker.tool_executor)
+        first = asyncio.run(factchecker.get_webpage_content("https://example.com/"))
+        second = asyncio.run(factchecker.get_webpage_content("https://example.com/"))
+        self.assertEqual(first, second)
+        self.assertEqual(len(requests), 1)
+
+    def test_rate_limited_call_is_retried(self):
+        factchecker = AsyncFactChecker(
+            agent_id="ag_test", api_key="test", rate_limiter=ApiRateLimiter(requests_per_minute=60000)
+        )
+        error = SDKError("rate limited", httpx.Response(429, headers={"Retry-After": "0"}))
+        complete = mock.AsyncMock(side_effect=[error, "response"])
+        with mock.patch.object(factchecker.client.agents, "complete_async", complete), \
+                mock.patch.object(factchecker, "_record_usage"), \
+                self.assertLogs("NostrFactCheckerBot", "WARNING") as logs:
+            response = asyncio.run(factchecker._call_api_with_retry([]))
+        self.assertEqual(response, "response")
+        self.assertEqual(complete.call_count, 2)
+        self.assertIn("Rate limited", logs.output[0])
+
+
+class TestParagraphExtraction(unittest.TestCase):
+    HTML = (
+        "<html><head><script>var p = '<p>no</p>';</script></head><body>"
+        "<nav>Menu</nav><p>First <b>bold</b>\nline.</p><div><p>Second</div>"
+        "<p>Caf\u00e9 third</p></body></html>"
+    )
+
+    def test_streaming_matches_full_parse(self):
+        html = self.HTML.encode("utf-8")
+        chunks = [html[i:i + 7] for i in range(0, len(html), 7)]
+        self.assertEqual(
+            extract_paragraph_text_streaming(chunks, 10000, 1024 * 1024, "utf-8"),
+            extract_paragraph_text(self.HTML),
+        )
+
+    def test_streaming_stops_at_max_length(self):
+        html = ("<html><body>" + "<p>0123456789</p>" * 1000 + "</body></html>").encode("utf-8")
+        chunks = iter([html[i:i + 64] for i in range(0, len(html), 64)])
+        text = extract_paragraph_text_streaming(chunks, 25, 1024 * 1024)
+        self.assertEqual(text, "0123456789 0123456789 012")
+        self.assertGreater(len(list(chunks)), 0)
+
+
+
+class TestApiRateLimiter(unittest.TestCase):
+    def test_requests_are_spaced_by_quota(self):
+        limiter = ApiRateLimiter(requests_per_minute=600)
+        self.assertEqual(limiter.reserve(), 0.0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(limiter.reserve(), 0.2, places=2)
+
+    def test_token_quota(self):
+        limiter = ApiRateLimiter(requests_per_minute=6000, tokens_per_minute=600, burst=10)
+        self.assertEqual(limiter.reserve(600), 0.0)
+        self.assertAlmostEqual(limiter.reserve(60), 6.0, places=1)
+
+    def test_backoff_blocks_all_callers(self):
+        limiter = ApiRateLimiter(requests_per_minute=6000, burst=10)
+        limiter.backoff(0, retry_after=3.0)
+        self.assertGreater(limiter.reserve(), 2.9)
+
+    def test_retry_after_header(self):
+        error = SDKError("rate limited", httpx.Response(429, headers={"Retry-After": "7"}))
+        self.assertTrue(is_rate_limit_error(error))
+        self.assertEqual(retry_after_seconds(error), 7.0)
+
+    def test_images_count_a_fixed_cost(self):
+        text = [{"role": "user", "content": [{"type": "text", "text": "Is this real?"}]}]
+        with_image = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Is this real?"},
+                {"type": "image_url", "image_url": "data:image/jpeg;base64," + "A" * 500000},
+            ],
+        }]
+        self.assertEqual(estimate_tokens(with_image), estimate_tokens(text) + IMAGE_TOKENS)
+
+
+
+class TestResultCache(unittest.TestCase):
+    def test_hit_by_event_id_and_by_claim(self):
+        cache = ResultCache(":memory:")
+        cache.put("event1", "The  Earth is FLAT ", ["https://x/a.png"], "verdict")
+        self.assertEqual(cache.get("event1", "", None), "verdict")
+        self.assertEqual(cache.get("event2", "the earth is flat", ["https://x/a.png"]), "verdict")
+        self.assertIsNone(cache.get("event2", "the earth is flat", None))
+
+    def test_expired_entries_are_ignored(self):
+        cache = ResultCache(":memory:", ttl=0)
+        cache.put("event1", "claim", None, "verdict")
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("event1", "claim", None))
+
+
+
+MMR_CLAIM = (
+    "A large study published in 2019 by researchers who followed hundreds of thousands of "
+    "children born in Denmark over many years found that the MMR vaccine does cause autism "
+    "in children who received it, according to a viral post that has been shared widely "
+    "across social media platforms by parents and activists this week"
+)
+
+
+class TestClaimIndex(unittest.TestCase):
+    def test_finds_edited_copy(self):
+        index = ClaimIndex()
+        claim = "Scientists confirmed that drinking two litres of sea water every day cures the common cold within a week"
+        index.add("claim:1", claim)
+        index.add("claim:2", "The moon landing in 1969 was filmed in a studio by a famous movie director")
+
+        match = index.query(claim.replace("two", "three") + "!!", threshold=0.5)
+        self.assertIsNotNone(match)
+        self.assertEqual(match[0], "claim:1")
+        self.assertIsNone(index.query("Vaccines contain microchips that track people through the 5G network", threshold=0.5))
+
+    def test_images_are_part_of_the_claim(self):
+        index = ClaimIndex()
+        claim = "This photo shows the largest wave ever recorded off the coast of Portugal"
+        index.add("claim:1", claim, ["https://example.com/wave.jpg"])
+        self.assertEqual(index.query(claim, ["https://example.com/wave.jpg"])[1], 1.0)
+        self.assertLess(index.query(claim, ["https://example.com/other.jpg"], threshold=0.0)[1], 1.0)
+
+    def test_negation_changes_meaning(self):
+        self.assertTrue(meaning_changes(MMR_CLAIM, MMR_CLAIM.replace("does cause", "does not cause")))
+        self.assertTrue(meaning_changes(MMR_CLAIM, MMR_CLAIM.replace("does cause", "doesn\u2019t cause")))
+        self.assertTrue(meaning_changes(MMR_CLAIM, MMR_CLAIM.replace("2019", "2021")))
+        self.assertFalse(meaning_changes(MMR_CLAIM, MMR_CLAIM.replace("researchers", "scientists") + "!!"))
+
+
+
+class TestToolCache(unittest.TestCase):
+    def test_memory_then_disk_tier(self):
+        cache = ToolCache(":memory:", memory_ttl=0)
+        cache.put("search:7:earth", "results")
+        entry, fresh = cache.lookup("search:7:earth")
+        self.assertTrue(fresh)
+        self.assertEqual(entry.value, "results")
+        self.assertEqual(cache.stats["disk_hits"], 1)
+        self.assertEqual(cache.lookup("search:7:moon"), (None, False))
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_stale_entries_with_validators_can_be_revalidated(self):
+        cache = ToolCache(":memory:", memory_ttl=0, disk_ttl=0)
+        cache.put("page:a", "text", etag='"v1"')
+        cache.put("page:b", "text")
+        entry, fresh = cache.lookup("page:a")
+        self.assertFalse(fresh)
+        self.assertEqual(entry.validators(), {"If-None-Match": '"v1"'})
+        self.assertEqual(cache.lookup("page:b"), (None, False))
+
+    def test_byte_limits_evict_least_recently_used(self):
+        cache = ToolCache(":memory:", memory_max_bytes=10, disk_max_bytes=10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        cache.lookup("a")
+        cache.put("c", "12345")
+        self.assertNotIn("b", cache.memory)
+        self.assertLessEqual(cache.disk_bytes, 10)
+
+    def test_canonicalize_url(self):
+        self.assertEqual(
+            canonicalize_url("HTTPS://Example.com:443/page?b=2&utm_source=x&a=1#top"),
+            "https://example.com/page?a=1&b=2",
+        )
+
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"<html><body><p>Local page.</p></body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPooledSession(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://localhost:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        factchecker = FactChecker(agent_id="ag_test", api_key="test")
+        for path in ("/a", "/b", "/c"):
+            content_dict = json.loads(factchecker.get_webpage_content(self.base_url + path))
+            self.assertEqual(content_dict["content"], "Local page.")
+        stats = factchecker.http_session.stats.as_dict()
+        factchecker.close()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["connections_reused"], 2)
+        self.assertEqual(stats["http_versions"], {"HTTP/1.1": 3})
+
+    def test_unresolvable_host_is_a_connect_error(self):
+        session = PooledSession()
+        with self.assertRaises(httpx.ConnectError):
+            with session.stream("GET", "https://no-such-host.invalid/"):
+                pass
+        session.close()
+
+        async def fetch():
+            session = AsyncPooledSession()
+            try:
+                async with session.stream("GET", "https://no-such-host.invalid/"):
+                    pass
+            finally:
+                await session.aclose()
+
+        with self.assertRaises(httpx.ConnectError):
+            asyncio.run(fetch())
+
+        factchecker = FactChecker(agent_id="ag_test", api_key="test")
+        content_dict = json.loads(factchecker.get_webpage_content("https://no-such-host.invalid/"))
+        factchecker.close()
+        self.assertIn("error", content_dict)
+
+
+
+class FakeRelayManager:
+    def __init__(self):
+        self.subscriptions = {}
+        self.closed = []
+
+    def add_subscription_on_all_relays(self, id, filters):
+        self.subscriptions[id] = filters.to_json_array()[0]["ids"]
+
+    def close_subscription_on_all_relays(self, id):
+        self.closed.append(id)
+
+
+class TestEventResolver(unittest.TestCase):
+    def test_batches_lookups_and_closes_when_resolved(self):
+        relay_manager = FakeRelayManager()
+        resolver = EventResolver(relay_manager, timeout=1.0, batch_window=0.01)
+        events = [Event(f"note {i}") for i in range(3)]
+
+        @gen.coroutine
+        def answer():
+            yield gen.sleep(0.05)
+            self.assertEqual(len(relay_manager.subscriptions), 1)
+            subscription_id, ids = next(iter(relay_manager.subscriptions.items()))
+            self.assertEqual(sorted(ids), sorted(event.id for event in events))
+            for event in events:
+                self.assertTrue(resolver.on_event(subscription_id, event))
+            self.assertEqual(relay_manager.closed, [subscription_id])
+
+        @gen.coroutine
+        def run():
+            resolved, _ = yield [gen.multi([resolver.resolve(event.id) for event in events]), answer()]
+            return resolved
+
+        resolved = IOLoop.current().run_sync(run)
+        self.assertEqual([event.id for event in resolved], [event.id for event in events])
+        # Already seen events resolve from the local store.
+        cached = IOLoop.current().run_sync(lambda: resolver.resolve(events[0].id))
+        self.assertIs(cached, events[0])
+        self.assertEqual(resolver.stats["batches"], 1)
+
+    def test_timeout_resolves_to_none_and_closes(self):
+        relay_manager = FakeRelayManager()
+        resolver = EventResolver(relay_manager, timeout=0.05, batch_window=0.01)
+        result = IOLoop.current().run_sync(lambda: resolver.resolve("00" * 32))
+        self.assertIsNone(result)
+        self.assertEqual(len(relay_manager.closed), 1)
+
+
+
+class TestFramePrefilter(unittest.TestCase):
+    BOT_PUBKEY = "41351e3166e7b6ddddc4c0ad48e69351ec34502771a216dbe08ba9c683c4fe1c"
+
+    def frame(self, content, tags=None):
+        event = Event(content=content, pubkey="ab" * 32, tags=tags or [])
+        event.compute_id()
+        return event.id, json.dumps(["EVENT", "sub", event.to_dict()])
+
+    def test_drops_duplicates_and_irrelevant_frames(self):
+        handled = {"seen"}
+        dropped = []
+        prefilter = FramePrefilter(
+            pubkey=self.BOT_PUBKEY,
+            mention_texts=["@factchecker"],
+            is_duplicate=lambda event_id: event_id in handled,
+            is_wanted=lambda event_id: event_id == "wanted",
+            on_dropped=lambda event_id, frame: dropped.append(event_id),
+        )
+        mention_id, mention = self.frame("Hey @FactChecker is this true?")
+        tagged_id, tagged = self.frame("nostr:npub1...", [["p", self.BOT_PUBKEY]])
+        noise_id, noise = self.frame("good morning")
+
+        self.assertTrue(prefilter.accept(mention))
+        self.assertTrue(prefilter.accept(tagged))
+        self.assertFalse(prefilter.accept(noise))
+        self.assertEqual(dropped, [noise_id])
+        self.assertTrue(prefilter.accept('["EOSE", "sub"]'))
+
+        handled.add(mention_id)
+        self.assertFalse(prefilter.accept(mention))
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def test_round_robin_with_priority_and_shedding(self):
+        scheduler = RequestScheduler(min_interval=0, max_depth=5, max_per_pubkey=3)
+        # "spammer" is served first as a first-time requester; it has to
+        # earn priority again once its queue has drained.
+        scheduler.submit("spammer", "s0")
+        IOLoop.current().run_sync(scheduler.get)
+        for i in range(1, 5):
+            scheduler.submit("spammer", f"s{i}")
+        scheduler.submit("alice", "a1")
+        scheduler.submit("alice", "a2")
+        self.assertFalse(scheduler.submit("bob", "b1"))
+        self.assertEqual(scheduler.stats["shed_pubkey_quota"], 1)
+        self.assertEqual(scheduler.stats["shed_queue_full"], 1)
+
+        @gen.coroutine
+        def drain():
+            items = []
+            while scheduler.depth:
+                item = yield scheduler.get()
+                items.append(item)
+            return items
+
+        self.assertEqual(IOLoop.current().run_sync(drain), ["a1", "a2", "s1", "s2", "s3"])
+
+    def test_global_rate(self):
+        scheduler = RequestScheduler(min_interval=0.05, is_priority=lambda pubkey: True)
+        for i in range(3):
+            scheduler.submit(f"user{i}", i)
+
+        @gen.coroutine
+        def drain():
+            start = time.monotonic()
+            yield [scheduler.get() for _ in range(3)]
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(IOLoop.current().run_sync(drain), 0.1)
+        self.assertEqual(scheduler.metrics()["dispatched"], 3)
+
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.path = "test_event_log.sqlite3"
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"in{i}")
+        self.assertTrue(all(f"in{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"out{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_survives_restart_and_replays_unfinished(self):
+        now = time.time()
+        log = EventLog(self.path)
+        self.assertEqual(log.catch_up_since(300, 3600, now=now), int(now))
+        self.assertTrue(log.add("a" * 64, now - 100))
+        self.assertFalse(log.add("a" * 64, now - 100))
+        log.done("a" * 64)
+        log.add("b" * 64, now - 1000)
+        log.save_checkpoint(int(now - 10))
+        log.close()
+
+        log = EventLog(self.path)
+        self.assertIn("a" * 64, log)
+        # "b" was never answered: it is forgotten and the catch-up starts
+        # early enough for the relays to deliver it again.
+        self.assertNotIn("b" * 64, log)
+        self.assertEqual(log.catch_up_since(300, 3600, now=now), int(now - 1300))
+        self.assertEqual(log.catch_up_since(300, 600, now=now), int(now - 600))
+        log.close()
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = "test_jobs.sqlite3"
+        self.tearDown()
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_each_job_is_claimed_once(self):
+        producer = JobQueue(self.path)
+        for i in range(200):
+            producer.enqueue(f"job{i}", {"n": i})
+        self.assertFalse(producer.enqueue("job0", {"n": 0}))
+
+        claimed = []
+
+        def work():
+            # One connection per worker, like separate processes.
+            queue = JobQueue(self.path)
+            while True:
+                job = queue.claim()
+                if job is None:
+                    break
+                claimed.append(job.payload["n"])
+                self.assertTrue(queue.ack(job))
+            queue.close()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), list(range(200)))
+        self.assertEqual(producer.counts(), {"done": 200})
+        producer.close()
+
+    def test_expired_lease_is_retried_then_failed(self):
+        queue = JobQueue(self.path, visibility_timeout=0.05, max_attempts=2, retry_delay=0)
+        queue.enqueue("job", {})
+        first = queue.claim()
+        self.assertIsNone(queue.claim())
+        time.sleep(0.06)
+        second = queue.claim()
+        self.assertEqual(second.attempts, 2)
+        # The first worker lost its lease.
+        self.assertFalse(queue.ack(first))
+        self.assertTrue(queue.fail(second, "boom"))
+        self.assertIsNone(queue.claim())
+        self.assertEqual(queue.counts(), {"failed": 1})
+        queue.close()
+
+    def test_retry_delay_is_capped(self):
+        queue = JobQueue(self.path, max_attempts=20, retry_delay=60, max_retry_delay=3600)
+        queue.enqueue("job", {})
+        job = queue.claim()
+        job.attempts = 19
+        self.assertTrue(queue.fail(job, "boom"))
+        available_at, = queue.db.execute("SELECT available_at FROM jobs").fetchone()
+        self.assertLessEqual(available_at, time.time() + 3600)
+        queue.close()
+
+
+class TestMetrics(AsyncHTTPTestCase):
+    def get_app(self):
+        self.registry = Metrics(enabled=True)
+        return metrics_app(self.registry)
+
+    def test_disabled_metrics_record_nothing(self):
+        registry = Metrics()
+        with registry.stage("api_call"):
+            registry.inc("api_tokens_total", 10, direction="prompt")
+        self.assertEqual(registry.render(), "\n")
+
+    def test_endpoint_renders_prometheus_text(self):
+        with self.registry.stage("tool", tool="web_search"):
+            pass
+        self.registry.inc("api_tokens_total", 120, direction="prompt")
+        self.registry.gauge("queue_depth", lambda: 3)
+
+        response = self.fetch("/metrics")
+        body = response.body.decode()
+        self.assertEqual(response.code, 200)
+        self.assertIn('factchecker_api_tokens_total{direction="prompt"} 120', body)
+        self.assertIn('factchecker_stage_seconds_bucket{stage="tool",tool="web_search",le="+Inf"} 1', body)
+        self.assertIn('factchecker_stage_seconds_count{stage="tool",tool="web_search"} 1', body)
+        self.assertIn("factchecker_queue_depth 3", body)
+
+
+def import_main():
+    """Import `main`, which reads its settings at import time, with test settings."""
+    directory = tempfile.mkdtemp(prefix="factchecker-test-")
+    settings = {
+        "FACTCHECKER_PRIVATE_KEY": PrivateKey().hex(),
+        "MISTRAL_API_KEY": "test",
+        "RESULT_CACHE_PATH": os.path.join(directory, "results.sqlite3"),
+        "TOOL_CACHE_PATH": os.path.join(directory, "tools.sqlite3"),
+        "EVENT_LOG_PATH": os.path.join(directory, "events.sqlite3"),
+        "JOB_QUEUE_PATH": os.path.join(directory, "jobs.sqlite3"),
+        "REPUBLISH_QUEUE_PATH": os.path.join(directory, "republish.sqlite3"),
+    }
+    with mock.patch.dict(os.environ, settings):
+        import main
+    return main
+
+
+def event_message(subscription_id, content):
+    event = Event(content)
+    event.sign(PrivateKey().hex())
+    return ["EVENT", subscription_id, event.to_dict()]
+
+
+class TestRelayStats(AsyncTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.main = import_main()
+
+    def setUp(self):
+        super().setUp()
+        self.main.setup_pipeline(RelayPool(FakePoolManager(["wss://a", "wss://b"])))
+        self.main.relay_stats.clear()
+
+    def test_counts_received_and_handled_per_relay(self):
+        main = self.main
+        mention = event_message(main.mention_subscription_id, "@factchecker is this true?")
+        main.on_message(mention, "wss://a")
+        main.on_message(mention, "wss://b")
+        main.on_message(event_message(main.firehose_subscription_id, "gm"), "wss://b")
+        with mock.patch.object(main, "firehose_bucket", TokenBucket(0, 0)):
+            main.on_message(event_message(main.firehose_subscription_id, "@factchecker?"), "wss://b")
+
+        self.assertEqual(main.relay_stats["wss://a"], Counter(received=1, handled=1))
+        self.assertEqual(
+            main.relay_stats["wss://b"],
+            Counter(received=3, duplicates=1, firehose=2, firehose_dropped=1),
+        )
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.published = []
+
+    @gen.coroutine
+    def publish(self, event):
+        self.published.append(event)
+        return ["wss://a"]
+
+
+class TestCachedRequests(AsyncTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.main = import_main()
+
+    def setUp(self):
+        super().setUp()
+        self.main.setup_pipeline(RelayPool(FakePoolManager(["wss://a"])))
+        self.main.reply_publisher = RecordingPublisher()
+        self.main.cached_reply_pubkey_buckets.clear()
+        self.main.cached_reply_bucket = TokenBucket(1, 30)
+
+    @gen_test
+    def test_answers_checked_notes_without_queueing(self):
+        main = self.main
+        target = Event("The moon is made of cheese.")
+        target.sign(PrivateKey().hex())
+        main.event_resolver.remember(target)
+        main.result_cache.put(target.id, target.content, [], "Verdict: false")
+
+        request = Event("@factchecker is this true?")
+        request.tags.append(["e", target.id, "", "reply"])
+        request.sign(PrivateKey().hex())
+        with mock.patch.object(main.factcheck_scheduler, "submit") as submit:
+            main.on_message(["EVENT", main.mention_subscription_id, request.to_dict()], "wss://a")
+            yield gen.sleep(0.01)
+        submit.assert_not_called()
+
+        reply, = main.reply_publisher.published
+        self.assertTrue(reply.content.startswith("Verdict: false"))
+        self.assertIn(["e", target.id, "", "reply"], reply.tags)
+        self.assertIn(["p", target.pubkey, "mention"], reply.tags)
+
+    @gen_test
+    def test_cached_replies_are_rate_limited_per_pubkey(self):
+        main = self.main
+        target = Event("The earth is flat.")
+        target.sign(PrivateKey().hex())
+        main.event_resolver.remember(target)
+        main.result_cache.put(target.id, target.content, [], "Verdict: false")
+
+        requester = PrivateKey()
+        with mock.patch.object(main.factcheck_scheduler, "submit", return_value=True) as submit:
+            for number in range(3):
+                request = Event(f"@factchecker is this true? #{number}")
+                request.tags.append(["e", target.id, "", "reply"])
+                request.sign(requester.hex())
+                main.on_message(["EVENT", main.mention_subscription_id, request.to_dict()], "wss://a")
+            yield gen.sleep(0.01)
+        self.assertEqual(len(main.reply_publisher.published), main.CACHED_REPLIES_PER_PUBKEY_PER_MINUTE)
+        # Beyond the quota the request takes the normal queue.
+        self.assertEqual(submit.call_count, 1)
+
+    @gen_test
+    def test_negated_near_duplicate_is_checked_again(self):
+        main = self.main
+        key = claim_cache_key(MMR_CLAIM)
+        main.result_cache.put(None, MMR_CLAIM, [], "Verdict: false")
+        main.claim_index.add(key, MMR_CLAIM)
+        negated = MMR_CLAIM.replace("does cause", "does not cause")
+        self.assertGreaterEqual(main.claim_index.query(negated)[1], main.NEAR_DUPLICATE_REUSE_THRESHOLD)
+
+        checks = []
+
+        @gen.coroutine
+        def run_factcheck(claim_text, image_urls, context=None):
+            checks.append(context)
+            return "Verdict: true"
+
+        with mock.patch.object(main, "run_factcheck", run_factcheck), \
+                mock.patch.object(main, "ENABLE_NEAR_DUPLICATE_REUSE", True):
+            result = yield main.get_factcheck_result("negated", negated, [])
+        self.assertEqual(result, "Verdict: true")
+        self.assertEqual(checks, ["Verdict: false"])
+
+
+class TestJobWorker(AsyncTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.main = import_main()
+
+    @gen_test
+    def test_failed_target_lookup_is_retried(self):
+        main = self.main
+        queue = JobQueue(os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"), retry_delay=60)
+        request = Event("@factchecker is this true?")
+        request.tags.append(["e", "ab" * 32, "", "reply"])
+        request.sign(PrivateKey().hex())
+        queue.enqueue(request.id, request.to_dict())
+
+        @gen.coroutine
+        def fetch_event_by_id(event_id):
+            return None
+
+        with mock.patch.object(main, "job_queue", queue), \
+                mock.patch.object(main, "fetch_event_by_id", fetch_event_by_id), \
+                mock.patch.object(main, "JOB_POLL_INTERVAL", 0.01):
+            worker = main.job_worker()
+            while queue.db.execute("SELECT error FROM jobs").fetchone()[0] is None:
+                yield gen.sleep(0.01)
+            # Stop the worker at its next poll.
+            queue.claim = mock.Mock(side_effect=RuntimeError("stop"))
+            with self.assertRaises(RuntimeError):
+                yield worker
+
+        attempts, error = queue.db.execute("SELECT attempts, error FROM jobs").fetchone()
+        self.assertEqual(attempts, 1)
+        self.assertIn("Could not fetch target event", error)
+        queue.close()
+
+
+class TestLoadTestServices(unittest.TestCase):
+    def test_fake_agent_runs_tool_rounds(self):
+        services = FakeServices(rounds=2, api_latency=0, search_latency=0, page_latency=0)
+        services.start()
+        try:
+            checker = LoadTestFactChecker(
+                search_url=f"{services.url}/search",
+                api_key="test",
+                agent_id="agent",
+                server_url=services.url,
+            )
+            result = checker.check_fact("The moon is made of cheese.")
+            checker.close()
+        finally:
+            services.stop()
+        self.assertIn("Verdict: unverified", result)
+
+    def test_budget_forces_final_answer(self):
+        services = FakeServices(rounds=5, api_latency=0, search_latency=0, page_latency=0)
+        services.start()
+        try:
+            checker = LoadTestFactChecker(
+                search_url=f"{services.url}/search",
+                api_key="test",
+                agent_id="agent",
+                server_url=services.url,
+                context_max_tokens=2000,
+                max_rounds=2,
+            )
+            result = checker.check_fact("The moon is made of cheese.")
+            checker.close()
+        finally:
+            services.stop()
+        self.assertIn("Verdict: unverified", result)
+        self.assertEqual(checker.context_stats["forced_answers"], 1)
+        self.assertGreater(checker.context_stats["tokens_saved"], 0)
+
+
+    def test_streamed_responses_start_tools_early(self):
+        services = FakeServices(rounds=1, api_latency=0.4, search_latency=0, page_latency=0)
+        services.start()
+        try:
+            for checker_class in (LoadTestFactChecker, LoadTestAsyncFactChecker):
+                checker = checker_class(
+                    search_url=f"{services.url}/search",
+                    api_key="test",
+                    agent_id="agent",
+                    server_url=services.url,
+                    rate_limiter=ApiRateLimiter(requests_per_minute=60000),
+                    stream_responses=True,
+                )
+                budget = checker.new_budget("The moon is made of cheese.")
+                pieces = []
+                check = checker.check_fact("The moon is made of cheese.", budget=budget, on_content=pieces.append)
+                result = asyncio.run(check) if asyncio.iscoroutine(check) else check
+                self.assertIn("Verdict: unverified", result)
+                self.assertEqual("".join(pieces), "Verdict: unverified (load test).")
+                # The search starts before the response with both tool calls is complete.
+                self.assertLess(budget.first_tool_seconds, 0.35)
+                self.assertEqual(budget.api_calls, 2)
+        finally:
+            services.stop()
+
+
+class TestStreamedResponse(unittest.TestCase):
+    def chunk(self, delta, finish_reason=None):
+        return CompletionChunk.model_validate({
+            "id": "1",
+            "model": "m",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        })
+
+    def test_tool_calls_complete_when_arguments_parse(self):
+        streamed = StreamedResponse()
+        call = {"id": "a", "index": 0, "function": {"name": "web_search", "arguments": '{"query": '}}
+        self.assertEqual(streamed.add(self.chunk({"tool_calls": [call]}))[1], [])
+        rest = {"id": "null", "index": 0, "function": {"name": "", "arguments": '"moon"}'}}
+        text, completed = streamed.add(self.chunk({"tool_calls": [rest]}))
+        self.assertEqual([tool_call.id for tool_call in completed], ["a"])
+        self.assertEqual(json.loads(completed[0].function.arguments), {"query": "moon"})
+        streamed.add(self.chunk({"content": "Done"}, finish_reason="tool_calls"))
+
+        message = streamed.response().choices[0].message
+        self.assertEqual(message.content, "Done")
+        self.assertEqual([tool_call.function.name for tool_call in message.tool_calls], ["web_search"])
+
+
+class TestConversationBudget(unittest.TestCase):
+    def tool_message(self, content):
+        return {"role": "tool", "content": json.dumps(content), "tool_call_id": "1", "name": "tool"}
+
+    def test_compacts_older_results_to_relevant_passages(self):
+        filler = "Unrelated sentence about gardening and the weather. " * 40
+        page = filler + "The moon is made of rock, not cheese. " + filler
+        messages = [
+            {"role": "user", "content": "'The moon is made of cheese.'"},
+            {"role": "assistant", "content": "", "tool_calls": []},
+            self.tool_message({"url": "https://a", "content": page}),
+            {"role": "assistant", "content": "", "tool_calls": []},
+            self.tool_message({"url": "https://b", "content": page}),
+        ]
+        budget = ConversationBudget("The moon is made of cheese.", max_tokens=1500, keep_passages=1)
+        budget.fit(messages)
+
+        older = json.loads(messages[2]["content"])
+        self.assertTrue(older["compacted"])
+        self.assertIn("made of rock", older["content"])
+        self.assertLess(len(older["content"]), 500)
+        # The latest result still fits and is left alone.
+        self.assertEqual(json.loads(messages[4]["content"])["content"], page)
+        self.assertGreater(budget.tokens_saved, 0)
+
+        saved = budget.tokens_saved
+        budget.fit(messages)
+        self.assertEqual(budget.tokens_saved, 2 * saved)
+
+    def test_inlined_images_do_not_force_compaction(self):
+        filler = "Unrelated sentence about gardening and the weather. " * 40
+        page = filler + "The moon is made of rock, not cheese. " + filler
+        messages = [
+            {"role": "user", "content": [
+                {"type": "text", "text": "'The moon is made of cheese.'"},
+                {"type": "image_url", "image_url": "data:image/jpeg;base64," + "A" * 500000},
+            ]},
+            {"role": "assistant", "content": "", "tool_calls": []},
+            self.tool_message({"url": "https://a", "content": page}),
+        ]
+        budget = ConversationBudget("The moon is made of cheese.", max_tokens=IMAGE_TOKENS + 2000)
+        budget.fit(messages)
+        self.assertEqual(json.loads(messages[2]["content"])["content"], page)
+        self.assertEqual(budget.tokens_saved, 0)
+
+    def test_compacts_search_results_and_runs_out(self):
+        results = [{"url": f"https://{i}", "title": f"Result {i}", "body": "x " * 200} for i in range(7)]
+        results[5]["title"] = "Moon cheese myth"
+        budget = ConversationBudget("The moon is made of cheese.", max_rounds=1, keep_results=2)
+        compacted = json.loads(budget.compact_tool_result(json.dumps(results)))
+        self.assertEqual([result["url"] for result in compacted], ["https://5", "https://0"])
+        self.assertEqual(len(compacted[0]["body"]), budget.snippet_chars)
+
+        self.assertFalse(budget.exhausted)
+        budget.rounds += 1
+        self.assertTrue(budget.exhausted)
+
+
+def tiny_png(top: bytes = b"\xff\x00\x00") -> bytes:
+    """2x2 PNG with a `top` coloured row over a blue one."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", 2, 2, 8, 2, 0, 0, 0)
+    pixels = zlib.compress(b"\x00" + top * 2 + b"\x00" + b"\x00\x00\xff" * 2)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", pixels) + chunk(b"IEND", b"")
+
+
+class ImageHandler(tornado.web.RequestHandler):
+    def get(self, name):
+        if name == "missing.png":
+            self.set_status(404)
+        elif name == "page.png":
+            self.set_header("Content-Type", "text/html")
+            self.write("<html></html>")
+        elif name == "big.png":
+            self.set_header("Content-Type", "image/png")
+            self.write(tiny_png() + b"\x00" * 5000)
+        elif name == "green.png":
+            self.set_header("Content-Type", "image/png")
+            self.write(tiny_png(top=b"\x00\xff\x00"))
+        else:
+            self.set_header("Content-Type", "image/png")
+            self.write(tiny_png())
+
+
+class TestImagePrefetcher(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r"/(.*)", ImageHandler)])
+
+    @gen_test
+    def test_drops_bad_images_and_duplicates(self):
+        prefetcher = ImagePrefetcher(max_bytes=4096)
+        names = ["a.png", "b.png", "missing.png", "page.png", "big.png", "a.png"]
+        images = yield prefetcher.prepare([self.get_url(f"/{name}") for name in names])
+        self.assertEqual([image.url for image in images], [self.get_url("/a.png")])
+        self.assertTrue(images[0].agent_input.startswith("data:image/"))
+        self.assertEqual(prefetcher.stats["duplicates"], 1)
+        self.assertEqual(prefetcher.stats["failed"], 1)
+        self.assertEqual(prefetcher.stats["not_image"], 1)
+        self.assertEqual(prefetcher.stats["too_large"], 1)
+
+        again = yield prefetcher.prepare([self.get_url("/b.png")])
+        self.assertEqual(again[0].key, images[0].key)
+        self.assertEqual(prefetcher.stats["known"], 1)
+        yield prefetcher.aclose()
+
+    @gen_test
+    def test_remembered_images_are_bounded_by_size(self):
+        probe = ImagePrefetcher()
+        image, = yield probe.prepare([self.get_url("/a.png")])
+        yield probe.aclose()
+        prefetcher = ImagePrefetcher(remembered_bytes=2 * len(image.data_uri) + 2)
+        for name in ("a.png", "b.png", "c.png", "d.png"):
+            yield prefetcher.prepare([self.get_url(f"/{name}")])
+        self.assertLessEqual(prefetcher.known.currsize, prefetcher.known.maxsize)
+        self.assertEqual(len(prefetcher.known), 2)
+        yield prefetcher.aclose()
+
+    @gen_test
+    def test_unreachable_images_are_dropped(self):
+        prefetcher = ImagePrefetcher()
+        images = yield prefetcher.prepare([
+            "https://no-such-host.invalid/a.png",
+            self.get_url("/a.png"),
+        ])
+        self.assertEqual([image.url for image in images], [self.get_url("/a.png")])
+        self.assertEqual(prefetcher.stats["failed"], 1)
+        yield prefetcher.aclose()
+
+    @unittest.skipUnless(PIL_AVAILABLE, "needs Pillow")
+    @gen_test
+    def test_keys_by_content_not_perceptual_hash(self):
+        prefetcher = ImagePrefetcher()
+        # Both pictures have uniform rows, so their dHashes are the same.
+        red = yield prefetcher.prepare([self.get_url("/a.png")])
+        green = yield prefetcher.prepare([self.get_url("/green.png")])
+        self.assertEqual(red[0].perceptual_hash, green[0].perceptual_hash)
+        self.assertNotEqual(red[0].key, green[0].key)
+        self.assertTrue(red[0].key.startswith("sha256:"))
+
+        both = yield prefetcher.prepare([self.get_url("/a.png"), self.get_url("/green.png")])
+        self.assertEqual(len(both), 1)
+        yield prefetcher.aclose()
+
+    def test_sniff_image_type(self):
+        self.assertEqual(sniff_image_type(tiny_png()), "image/png")
+        self.assertEqual(sniff_image_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp")
+        self.assertIsNone(sniff_image_type(b"<html>"))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.input_path = "test_batch_input.jsonl"
+        self.output_path = "test_batch_output.jsonl"
+        with open(self.input_path, "w") as file:
+            for i in range(6):
+                file.write(json.dumps({"id": f"note{i}", "content": f"Claim number {i} is true."}) + "\n")
+        # An earlier run finished line 1 and crashed while writing line 2.
+        with open(self.output_path, "w") as file:
+            file.write(json.dumps({"line": 1, "id": "note0", "result": "done", "error": None}) + "\n")
+            file.write('{"line": 2, "id": "no')
+
+    def tearDown(self):
+        for path in (self.input_path, self.output_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run_batch(self, runs=1):
+        services = FakeServices(rounds=1, api_latency=0.01, search_latency=0, page_latency=0)
+        services.start()
+        try:
+            checker = LoadTestAsyncFactChecker(
+                search_url=f"{services.url}/search",
+                api_key="test",
+                agent_id="agent",
+                server_url=services.url,
+                rate_limiter=ApiRateLimiter(requests_per_minute=60000),
+            )
+            return [
+                asyncio.run(run_batch(checker, self.input_path, self.output_path, concurrency=3))
+                for _ in range(runs)
+            ]
+        finally:
+            services.stop()
+
+    def test_resumes_and_reports_usage(self):
+        summary, again = self.run_batch(runs=2)
+
+        with open(self.output_path) as file:
+            results = [json.loads(line) for line in file]
+        self.assertEqual(sorted(result["line"] for result in results), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(summary["checked"], 5)
+        self.assertEqual(summary["skipped"], 1)
+        self.assertEqual(summary["api_calls"], 10)
+        self.assertGreater(results[-1]["prompt_tokens"], 0)
+        self.assertEqual(again["skipped"], 6)
+        self.assertEqual(again["checked"], 0)
+
+    def test_reports_malformed_lines_and_continues(self):
+        os.remove(self.output_path)
+        with open(self.input_path, "w") as file:
+            file.write(json.dumps({"claim": "The moon is made of cheese."}) + "\n")
+            file.write('{"claim": "truncated\n')
+            file.write("[1, 2]\n")
+            file.write(json.dumps({"claim": "Water boils at 100 C at sea level."}) + "\n")
+        summary, = self.run_batch()
+
+        with open(self.output_path) as file:
+            results = {result["line"]: result for result in map(json.loads, file)}
+        self.assertEqual(sorted(results), [1, 2, 3, 4])
+        self.assertTrue(results[2]["error"].startswith("invalid JSON"))
+        self.assertTrue(results[3]["error"].startswith("invalid claim"))
+        self.assertIsNone(results[4]["error"])
+        self.assertEqual((summary["checked"], summary["failed"], summary["invalid"]), (2, 2, 2))
+
+    def test_claim_fields(self):
+        record = {"content": "Look https://example.com/a.png at this", "image_urls": ["https://example.com/b.jpg"]}
+        self.assertEqual(
+            claim_fields(record),
+            (None, "Look  at this", ["https://example.com/b.jpg", "https://example.com/a.png"]),
+        )
+
+
+class FakeWebSocket:
+    def __init__(self, written):
+        self.written = written
+
+    def write_message(self, message):
+        self.written.append(message)
+
+
+class FakePoolRelay:
+    def __init__(self, url):
+        self.url = url
+        self.policy = RelayPolicy()
+        self.subscriptions = {}
+        self.published = []
+        self.sessions = []
+        self.written = []
+        self.outgoing_messages = Queue()
+        self.ws = FakeWebSocket(self.written)
+        self.num_sent_events = 0
+        self.is_connected = True
+        self._on_message = lambda message: None
+
+    def add_subscription(self, id, filters):
+        self.subscriptions[id] = Subscription(id, filters)
+        self.publish(self.subscriptions[id].to_message())
+
+    def close_subscription(self, id):
+        self.subscriptions.pop(id, None)
+
+    def publish(self, message):
+        self.published.append(message)
+        self.outgoing_messages.put(message)
+
+    def connect(self):
+        session = Future()
+        self.sessions.append(session)
+        return session
+
+
+class FakePoolManager:
+    def __init__(self, urls):
+        self.relays = {url: FakePoolRelay(url) for url in urls}
+        self.io_loop = IOLoop.current()
+
+
+class TestRelayPool(unittest.TestCase):
+    def setUp(self):
+        self.manager = FakePoolManager(["wss://a", "wss://b", "wss://c"])
+        self.pool = RelayPool(self.manager, lookup_fanout=2, publish_fanout=2, reconnect_base=10)
+        self.pool.install()
+        self.filters = FiltersList([Filters(kinds=[1])])
+
+    def test_routes_to_fastest_connected_relays(self):
+        self.pool.add_subscription_on_all_relays("mentions", self.filters)
+        self.pool.pending_eose[("wss://a", "mentions")] -= 0.5
+        self.pool.pending_eose[("wss://b", "mentions")] -= 0.01
+        self.pool.pending_eose[("wss://c", "mentions")] -= 0.2
+        for relay in self.manager.relays.values():
+            relay._on_message('["EOSE","mentions"]')
+        self.assertEqual(self.pool.ranked(), ["wss://b", "wss://c", "wss://a"])
+
+        self.manager.relays["wss://c"].is_connected = False
+        self.pool.lookups.add_subscription_on_all_relays("lookup", self.filters)
+        subscribed = sorted(url for url, relay in self.manager.relays.items() if "lookup" in relay.subscriptions)
+        self.assertEqual(subscribed, ["wss://a", "wss://b"])
+        self.pool.lookups.close_subscription_on_all_relays("lookup")
+        self.assertFalse(any("lookup" in relay.subscriptions for relay in self.manager.relays.values()))
+
+        event = Event("reply")
+        event.sign(PrivateKey().hex())
+        self.assertEqual(self.pool.publish_event(event), ["wss://b", "wss://a"])
+        self.assertIn(event.to_message(), self.manager.relays["wss://b"].written)
+        self.assertNotIn(event.to_message(), self.manager.relays["wss://c"].published)
+        self.manager.relays["wss://b"]._on_message(json.dumps(["OK", event.id, False, "blocked"]))
+        self.assertGreater(self.pool.scores["wss://b"].error_rate, 0)
+
+    def test_lookups_fall_back_to_remaining_relays(self):
+        self.pool.lookups.add_subscription_on_all_relays("lookup", self.filters)
+        asked = sorted(url for url, relay in self.manager.relays.items() if "lookup" in relay.subscriptions)
+        self.assertEqual(len(asked), 2)
+        for url in asked:
+            self.manager.relays[url]._on_message('["EOSE","lookup"]')
+        # Both fast relays are done without the event; the last one is asked.
+        self.assertTrue(all("lookup" in relay.subscriptions for relay in self.manager.relays.values()))
+
+        pool = RelayPool(self.manager, lookup_fanout=1, lookup_fallback=0.01)
+        pool.add_subscription_on_fastest_relays("slow", self.filters)
+        self.assertEqual(sum("slow" in relay.subscriptions for relay in self.manager.relays.values()), 1)
+        IOLoop.current().run_sync(lambda: gen.sleep(0.05))
+        self.assertTrue(all("slow" in relay.subscriptions for relay in self.manager.relays.values()))
+
+        pool.add_subscription_on_fastest_relays("found", self.filters)
+        pool.close_subscription_on_all_relays("found")
+        IOLoop.current().run_sync(lambda: gen.sleep(0.05))
+        self.assertFalse(any("found" in relay.subscriptions for relay in self.manager.relays.values()))
+
+    def test_reconnects_with_backoff_and_resubscribes(self):
+        relay = self.manager.relays["wss://a"]
+        self.pool.add_subscription_on_all_relays("mentions", self.filters)
+        self.pool.check_connections()
+        self.assertEqual(len(relay.sessions), 1)
+
+        relay.sessions[0].set_result(None)
+        IOLoop.current().run_sync(lambda: gen.sleep(0))
+        self.assertGreater(self.pool.scores["wss://a"].next_retry, time.monotonic() + 4)
+        self.pool.check_connections()
+        self.assertEqual(len(relay.sessions), 1)
+
+        self.pool.scores["wss://a"].next_retry = 0
+        self.pool.check_connections()
+        self.assertEqual(len(relay.sessions), 2)
+        self.assertIn(Subscription("mentions", self.filters).to_message(), relay.published)
+
+
+class EoseRelayHandler(WebSocketHandler):
+    def on_message(self, message):
+        self.write_message(json.dumps(["EOSE", json.loads(message)[1]]))
+
+
+class QuietRelayHandler(WebSocketHandler):
+    """Answers REQ with EOSE and EVENT with OK, and sends nothing else."""
+
+    received = []
+
+    def on_message(self, message):
+        message_json = json.loads(message)
+        QuietRelayHandler.received.append(message_json)
+        if message_json[0] == "REQ":
+            self.write_message(json.dumps(["EOSE", message_json[1]]))
+        elif message_json[0] == "EVENT":
+            self.write_message(json.dumps(["OK", message_json[1]["id"], True, ""]))
+
+
+class QuietRelayTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r"/", QuietRelayHandler)])
+
+    def setUp(self):
+        super().setUp()
+        QuietRelayHandler.received = []
+        self.url = f"ws://127.0.0.1:{self.get_http_port()}/"
+        self.manager = RelayManager(timeout=0)
+        self.manager.add_relay(self.url, close_on_eose=False)
+        self.pool = RelayPool(self.manager, connect_timeout=2)
+        self.pool.install()
+        self.filters = FiltersList([Filters(kinds=[1])])
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.manager.relays[self.url].close)
+        super().tearDown()
+
+    @gen.coroutine
+    def wait_for(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            yield gen.sleep(0.01)
+
+
+class TestRelayPoolQuietRelay(QuietRelayTestCase):
+    @gen_test
+    def test_sends_to_relay_that_stays_silent(self):
+        self.pool.add_subscription_on_all_relays("mentions", self.filters)
+        self.pool.check_connections()
+        yield self.wait_for(lambda: not self.pool.pending_eose)
+
+        # The relay sends nothing after EOSE; every frame below has to be
+        # written without waiting for an incoming one.
+        acknowledged = []
+        self.pool.on_ok = lambda url, id, accepted, reason: acknowledged.append(id)
+        self.pool.add_subscription_on_all_relays("lookup", self.filters)
+        yield self.wait_for(lambda: len(QuietRelayHandler.received) == 2)
+        self.pool.close_subscription_on_all_relays("lookup")
+        event = Event("reply")
+        event.sign(PrivateKey().hex())
+        self.pool.publish_event(event)
+        yield self.wait_for(lambda: acknowledged == [event.id])
+        self.assertEqual(
+            [message[:2] for message in QuietRelayHandler.received[:3]],
+            [["REQ", "mentions"], ["REQ", "lookup"], ["CLOSE", "lookup"]],
+        )
+        self.assertEqual(QuietRelayHandler.received[3][0], "EVENT")
+
+
+class TestProbeRelay(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r"/", EoseRelayHandler)])
+
+    @gen_test
+    def test_probe(self):
+        result = yield probe_relay(f"ws://127.0.0.1:{self.get_http_port()}/", 2)
+        self.assertEqual(len(result), 2)
+        failed = yield probe_relay("ws://127.0.0.1:1/", 2)
+        self.assertIsNone(failed)
+
+
+class FakePublishRelays:
+    """Relays that acknowledge publishes only from `acking` urls."""
+
+    def __init__(self, urls, acking):
+        self.urls = urls
+        self.acking = acking
+        self.sent = []
+        self.timed_out = []
+        self.on_ok = None
+
+    def ranked(self):
+        return list(self.urls)
+
+    def publish_event(self, event, urls=None):
+        urls = urls or self.urls[:2]
+        for url in urls:
+            self.sent.append(url)
+            if url in self.acking:
+                IOLoop.current().add_callback(self.on_ok, url, event.id, True, "")
+        return urls
+
+    def publish_timed_out(self, url, event_id):
+        self.timed_out.append(url)
+
+
+class TestReplyPublisher(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = "test_republish.sqlite3"
+        self.remove_queue()
+        self.event = Event("reply")
+        self.event.sign(PrivateKey().hex())
+
+    def tearDown(self):
+        self.remove_queue()
+        super().tearDown()
+
+    def remove_queue(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    @gen_test
+    def test_reaches_quorum_on_other_relays(self):
+        relays = FakePublishRelays(["a", "b", "c", "d"], acking={"a", "c", "d"})
+        publisher = ReplyPublisher(relays, quorum=2, ack_timeout=0.05)
+        accepted = yield publisher.publish(self.event)
+        self.assertEqual(accepted, ["a", "c", "d"])
+        self.assertEqual(relays.sent, ["a", "b", "c", "d"])
+        self.assertEqual(relays.timed_out, ["b"])
+        self.assertEqual(publisher.stats["b"]["timeouts"], 1)
+        self.assertEqual(publisher.pending, {})
+
+    @gen_test
+    def test_queues_and_republishes_undelivered_replies(self):
+        queue = JobQueue(self.path, retry_delay=0)
+        relays = FakePublishRelays(["a", "b", "c"], acking={"a"})
+        publisher = ReplyPublisher(relays, quorum=2, ack_timeout=0.02, max_rounds=2, retry_queue=queue)
+        accepted = yield publisher.publish(self.event)
+        self.assertIsNone(accepted)
+        self.assertEqual(queue.counts(), {"queued": 1})
+
+        relays.acking = {"a", "b", "c"}
+        delivered = yield publisher.republish_pending()
+        self.assertEqual(delivered, 1)
+        self.assertEqual(queue.counts(), {"done": 1})
+        queue.close()
+
+    @gen_test
+    def test_drops_replies_too_old_to_republish(self):
+        queue = JobQueue(self.path, retry_delay=0)
+        relays = FakePublishRelays(["a", "b"], acking={"a", "b"})
+        publisher = ReplyPublisher(relays, quorum=1, ack_timeout=0.02, retry_queue=queue, max_age=3600)
+        stale = Event("stale reply", created_at=int(time.time()) - 7200)
+        stale.sign(PrivateKey().hex())
+        queue.enqueue(stale.id, stale.to_dict())
+
+        delivered = yield publisher.republish_pending()
+        self.assertEqual(delivered, 0)
+        self.assertEqual(relays.sent, [])
+        self.assertEqual(queue.counts(), {"failed": 1})
+        queue.close()
+
+
+class TestReplyPublisherQuietRelay(QuietRelayTestCase):
+    @gen_test
+    def test_publishes_to_relay_that_stays_silent(self):
+        queue = JobQueue(os.path.join(tempfile.mkdtemp(), "republish.sqlite3"), retry_delay=0)
+        publisher = ReplyPublisher(self.pool, quorum=1, ack_timeout=2, retry_queue=queue)
+        self.pool.add_subscription_on_all_relays("mentions", self.filters)
+        self.pool.check_connections()
+        yield self.wait_for(lambda: not self.pool.pending_eose)
+
+        reply = Event("reply")
+        reply.sign(PrivateKey().hex())
+        accepted = yield publisher.publish(reply)
+        self.assertEqual(accepted, [self.url])
+
+        queued = Event("queued reply")
+        queued.sign(PrivateKey().hex())
+        queue.enqueue(queued.id, queued.to_dict())
+        delivered = yield publisher.republish_pending()
+        self.assertEqual(delivered, 1)
+        self.assertEqual(queue.counts(), {"done": 1})
+        self.assertEqual(publisher.stats[self.url]["timeouts"], 0)
+        queue.close()
+
+
 if __name__ == "__main__":
     logging.basicConfig(
     level=logging.DEBUG,